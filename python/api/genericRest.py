@@ -1,25 +1,59 @@
 import logging
 import json
 import os
+import threading
 from argparse import ArgumentParser
-from hashlib import sha256
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import blake2b
 
-from google.cloud.exceptions import Forbidden
-from google.cloud.pubsub_v1 import PublisherClient
-from google.cloud import storage
-from google.oauth2 import service_account
-
-# This file has code that accesses a URL and does basic parsing of the response.
+# This file has code that accesses one or more URLs and does basic parsing of the responses.
 # When deployed as a Cloud Function, the entry point would be cloudFunctionMain.
+# Example message that polls two endpoints, at most 2 requests at a time and 5 requests per second against each host:
+#   {"endpoints":[{"url":"https://example.p.rapidapi.com/stock/GOOG/quote","headers":{"X-RapidAPI-Key":"..."}},
+#                 {"url":"https://example.p.rapidapi.com/stock/CRM/quote","headers":{"X-RapidAPI-Key":"..."},"params":{"range":"1d"}}],
+#    "maxPerHost":2,"requestsPerSecond":5,"bucket":"prof-big-data_data","path":"rest"}
+# Example message that follows all the pages of an API that takes start and limit parameters, outputting each record:
+#   {"url":"https://example.com/v1/listings","parameters":{"convert":"USD"},
+#    "pagination":{"type":"offset","startParam":"start","limitParam":"limit","limit":100,"recordsPath":"data"}}
+# The pagination type can also be "cursor" (with cursorPath and cursorParam) or "link" (follows Link: rel="next").
+# Set "recordsPath" to a JSONPath, such as "$.data[*]", to split each response into records. Records are published as
+# separate messages and stored in gzip-compressed JSONL files instead of storing and publishing each response whole.
+# Responses and records identical to ones output recently are skipped; set "dedupe" to false to output everything.
+# Add a "cache" to answer triggers that hit the same URL within seconds of each other from cached responses, for example
+#   "cache":{"ttl":30,"staleWhileRevalidate":60,"location":"gs://prof-big-data_data/rest/_cache"}
+# A response's own Cache-Control header takes precedence over ttl and staleWhileRevalidate. Without "location", the
+# responses are only cached in the memory of the instance. A cached response only answers requests with the same URL,
+# parameters and headers, API keys included; list headers that never change the response, such as a request ID, in
+# "ignoreHeaders" to leave them out of the comparison.
+# Add "profile":true (or "sample") to profile the invocation; the results are written to gs://{bucket}/profiles (see
+# common.profiling).
+
+from api.pagination import extractRecords, getPagination, paginate
+from common import lazy, logs, metrics, profiling, timing
+from common.cache import LRUCache
+from common.httpClient import HostLimiter, HttpClient, ResponseCache
+from common.sinks import BatchPublisher, JsonlWriter, encode, toAttributes
 
-from requests import Session
+try:
+  import xxhash
+except ImportError:
+  xxhash=None  # blake2b from hashlib is used instead.
 
 logging.basicConfig(
   format='%(asctime)s.%(msecs)03dZ,%(pathname)s:%(lineno)d,%(levelname)s,%(module)s,%(funcName)s: %(message)s',
   datefmt="%Y-%m-%d %H:%M:%S")
 _logger=logging.getLogger(__name__)
 
-_expectedFieldsInFunctionCall=[]  # Fields to send as parameters to the REST API.
+# Imported when first used, so that a cold start does not load clients and libraries the invocation does not need.
+storage=lazy.module('google.cloud.storage')
+exceptions=lazy.module('google.cloud.exceptions')
+
+_expectedFieldsInFunctionCall=['url', 'endpoints']  # Fields that identify the message within a request.
+_maxWorkers=16  # Number of endpoints fetched at the same time.
+# Response caches by their options (see _getResponseCache), kept between invocations of a warm instance.
+_responseCaches={}
+_responseCachesLock=threading.Lock()
 
 class RequestTemplate(object):
   '''
@@ -61,13 +95,13 @@ def _getMessageJSON(request):
   request_json=request.get_json(force=True)
   message=None
   if request.args is not None:
-    _logger.info('request is '+str(request)+' with args '+str(request.args))
+    logs.info(_logger, 'request is %s with args %s', request, request.args)
     if 'message' in request.args:
       message=request.args.get('message')
     elif any(map(lambda field:field in request.args, _expectedFieldsInFunctionCall)):
       message=request.args
   if message is None and request_json is not None:
-    _logger.debug('request_json is '+str(request_json))
+    logs.debug(_logger, 'request_json is %s', request_json)
     if 'message' in request_json:
       message=request_json['message']
     elif any(map(lambda field:field in request_json, _expectedFieldsInFunctionCall)):
@@ -86,25 +120,55 @@ def _getMessageJSON(request):
                     exc_info=True, stack_info=True)
   else:
     messageJSON=message
-  return messageJSON
+  return profiling.start(messageJSON)
 
 class DataProcessor():
+  # IDs of the responses and records output recently by this instance, each with the destination it was output to.
+  # Slow-moving APIs often return the same content poll after poll, which is then skipped instead of being uploaded and
+  # published again. An ID is only added once its output has succeeded: records output while a write or a publish
+  # failed are output again by the next poll rather than lost.
+  _seenIDs=LRUCache(maxSize=100000)
+  
   @staticmethod
   def _createID(values):
     '''
     Create a unique ID given values.
-    :param values: a string or a list of strings.
+    :param values: a string, bytes, or anything that can be converted into JSON. Dicts with the same keys and values get
+                   the same ID whatever the order of their keys.
     :return: a string with a unique ID created from the given values.
     '''
-    if type(values)==str:
+    if type(values)==bytes:
       contents=values
-    elif type(values)==list:
-      contents=chr(1).join(map(str, values))
+    elif type(values)==str:
+      contents=values.encode()
     else:
-      contents=str(values)
-    return sha256(contents.encode()).hexdigest()
+      contents=json.dumps(values, sort_keys=True, separators=(',', ':'), default=str).encode()
+    if xxhash is not None: return xxhash.xxh3_128_hexdigest(contents)
+    return blake2b(contents, digest_size=16).hexdigest()
+  
+  def _isNew(self, values):
+    '''
+    Claim values for output unless they have been output recently, or are being output, to the same destination.
+    :param values: a response or a record.
+    :return: returns (True if values has not been output recently or deduplication is off, the ID of values). A claimed
+             ID is added to _seenIDs by close() once the outputs have succeeded, or dropped by _release() if they fail.
+    '''
+    recordId=self._createID(values)
+    if not self._dedupe: return (True, recordId)
+    key=self._destination+(recordId,)
+    with self._lock:
+      if key in self._pending or key in self._seenIDs: return (False, recordId)
+      self._pending.add(key)
+    return (True, recordId)
+  
+  def _release(self, recordId):
+    '''
+    Drop the claim of _isNew on an ID whose output failed, so that it is output again.
+    '''
+    with self._lock:
+      self._pending.discard(self._destination+(recordId,))
   
-  def __init__(self, projectId=None, topic=None, bucket=None, path=None, debug=None):
+  def __init__(self, projectId=None, topic=None, bucket=None, path=None, debug=None, recordsPath=None, dedupe=True):
     '''
 
     :param projectId:
@@ -112,18 +176,29 @@ class DataProcessor():
     :param bucket:
     :param path:
     :param debug:
+    :param recordsPath: a JSONPath (see pagination.extractRecords) to the records within a response, or None to output
+                        each response as a single record.
+    :param dedupe: skip responses and records that are identical to ones output recently.
     '''
+    self._recordsPath=recordsPath
+    self._dedupe=dedupe
     self._bucket=bucket
     self._path=path
     self._topic=topic
     self._projectId=projectId
-    if bucket is not None: _logger.debug(
-      'Output will be written to {path} in {bucket}.'.format(path=self._path, bucket=self._bucket))
-    if topic is not None and projectId is not None: _logger.debug(
-      'Output will be published to {topic} in project {projectId}.'.format(topic=topic, projectId=projectId))
+    self._destination=(projectId, topic, bucket, path)
+    self._lock=threading.Lock()  # processRecords is called from several threads by callAPI.
+    self._pending=set()  # Keys (see _isNew) of the responses and records output since the last call to close.
+    self._numBuffered=0  # Number of records handed to _recordWriter since the last call to close.
+    if bucket is not None: logs.debug(_logger, 'Output will be written to %s in %s.', self._path, self._bucket)
+    if topic is not None and projectId is not None: logs.debug(
+      _logger, 'Output will be published to %s in project %s.', topic, projectId)
     
-    self._publisher=PublisherClient() if topic is not None and projectId is not None else None
     self._bucketClient=storage.Client().bucket(bucket) if bucket is not None else None
+    # Messages are published in batches and followed until they are acknowledged. Records split out of responses are
+    # also stored in batches: many records per JSONL file.
+    self._batchPublisher=BatchPublisher(projectId, topic) if topic is not None and projectId is not None else None
+    self._recordWriter=JsonlWriter(bucket, path, prefix='records') if bucket is not None else None
   
   def _writeToBucket(self, data, filename=None):
     '''
@@ -136,9 +211,12 @@ class DataProcessor():
     recordKey=None
     try:
       recordKey=self._createID(data) if filename is None else filename
-      self._bucketClient.blob(recordKey).upload_from_string(json.dumps(data))
+      contents=json.dumps(data)
+      with timing.span('store'):
+        self._bucketClient.blob(recordKey).upload_from_string(contents)
+      metrics.uploadBytes.labels(self._bucket).inc(len(contents))
       return 1
-    except Forbidden as fe:
+    except exceptions.Forbidden as fe:
       try:
         _logger.error(
           'Failed to write to GCS bucket {bucket} because access to object {objectName} is forbidden. Error code={code}, response content={response}'.format(
@@ -154,33 +232,23 @@ class DataProcessor():
             objectName=recordKey
           ), exc_info=True, stack_info=True)
     except:
-      _logger.error('Failed to write to GCS bucket {bucket}, object {objectName}.'.format(
-        bucket=self._bucket,
-        objectName=recordKey
-      ), exc_info=True, stack_info=True)
+      logs.error(_logger, 'Failed to write to GCS bucket %s, object %s.', self._bucket, recordKey, perSecond=1,
+                 exc_info=True, stack_info=True)
     return 0
   
   def _publish(self, data):
-    attributes=None
-    if type(data)==dict:
-      attributes={}
-      for key, value in data.items():
-        if type(value) in [int, float, str, bool]:
-          attributes[key]=value
-    if attributes is not None and len(attributes)>0:
-      # Try to include key-values of data as attributes in the published message.
-      try:
-        self._publisher.publish('projects/'+self._projectId+'/topics/'+self._topic,
-                                data=json.dumps(data).encode("utf-8"), **attributes)
-        return 1
-      except:
-        _logger.debug('Cannot include '+str(attributes)+' as attributes to the message.', exc_info=True)
+    '''
+    Publish the data as one message, with its scalar fields as attributes. Delivery is counted by close().
+    :return: returns True if the message was handed to the publisher.
+    '''
     try:
-      self._publisher.publish('projects/'+self._projectId+'/topics/'+self._topic, data=json.dumps(data).encode("utf-8"))
-      return 1
+      attributes=toAttributes(data) if type(data)==dict else {}
+      self._batchPublisher.publish(json.dumps(data).encode('utf-8'), **attributes)
+      return True
     except:
-      _logger.error('Cannot publish message "'+str(json.dumps(data))+'".', exc_info=True, stack_info=True)
-      return 0
+      logs.error(_logger, 'Cannot publish message "%s".', logs.lazy(lambda:json.dumps(data)), perSecond=1,
+                 exc_info=True, stack_info=True)
+      return False
   
   def _parse(self, data):
     '''
@@ -191,54 +259,238 @@ class DataProcessor():
     try:
       return json.loads(data)
     except:
-      _logger.error('Error parsing data as JSON string. '+str(data), exc_info=True, stack_info=True)
+      logs.error(_logger, 'Error parsing data as JSON string. %s', data, perSecond=1, exc_info=True, stack_info=True)
       return {'error':str(data)}  # Return the record in a field named "error".
   
-  def process(self, data):
+  def processRecords(self, records, source=None):
+    '''
+    Output records in batches: each record is published as its own message and appended to a rolled JSONL file. Call
+    close() to send whatever is still buffered.
+    :param records: an iterable of dicts, such as the generator returned by pagination.paginate.
+    :param source: the URL the records came from, which is attached to each message as an attribute.
+    :return: returns the number of records output.
+    '''
+    # The attributes are the same for every record of the batch, so they are only computed once.
+    attributes={'batch':datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
+    if source is not None: attributes['source']=source
+    numRecords=0
+    numDuplicates=0
+    for record in records:
+      isNew, recordId=self._isNew(record)
+      if not isNew:
+        numDuplicates+=1
+        continue
+      try:
+        encoded=encode(record)  # Serialize once for both outputs.
+        if self._recordWriter is not None:
+          self._recordWriter.write(encoded)
+          with self._lock:
+            self._numBuffered+=1
+        if self._batchPublisher is not None: self._batchPublisher.publish(encoded, **attributes)
+      except:
+        self._release(recordId)
+        raise
+      numRecords+=1
+    if numDuplicates>0: logs.debug(_logger, 'Skipped %d records that were already output.', numDuplicates)
+    return numRecords
+  
+  def close(self):
+    '''
+    Upload the records still buffered for storage and wait until all published messages have been acknowledged. If
+    every record was stored and every message acknowledged, what was output is skipped from now on.
+    :return: returns (number of records written by processRecords, number of messages acknowledged).
+    '''
+    numWritten=self._recordWriter.close() if self._recordWriter is not None else 0
+    numPublished=0
+    with self._lock:
+      succeeded=numWritten==self._numBuffered
+      pending,self._pending,self._numBuffered=self._pending,set(),0
+    if self._batchPublisher is not None:
+      numPublished=self._batchPublisher.wait()
+      stats=self._batchPublisher.stats()
+      _logger.info('Publishing: '+json.dumps(stats))
+      succeeded=succeeded and stats['failed']==0
+    # A failed upload or publish is not traced back to its records, so none are marked as seen: the next poll outputs
+    # them all again, and duplicates are preferred over records lost.
+    if succeeded:
+      for key in pending:
+        self._seenIDs.add(key)
+    elif pending:
+      logs.warning(_logger, 'Not all of %d responses and records were output; they will not be skipped next time.',
+                   len(pending))
+    return (numWritten, numPublished)
+  
+  def process(self, data, source=None):
     '''
-    :param data:
-    :return: returns (number of records written, number of records published)
+    :param data: a JSON string.
+    :param source: the URL the data came from.
+    :return: returns (number of records written, 0). Records split out of the data and published messages are counted
+             by close().
     '''
     parsed=None
     try:
-      _logger.debug('Received data. '+str(data)[:100]+('...' if len(str(data))>100 else ''))
-      parsed=self._parse(data)
+      logs.debug(_logger, 'Received data. %s', logs.truncated(data, 100))
+      with timing.span('decode'):
+        parsed=self._parse(data)
     except:
-      _logger.error('Error processing data. '+str(data), exc_info=True, stack_info=True)
+      logs.error(_logger, 'Error processing data. %s', data, perSecond=1, exc_info=True, stack_info=True)
     
     numWritten=0
     numPublished=0
-    if parsed is not None:
+    if parsed is None: return (numWritten, numPublished)
+    isNew, recordId=self._isNew(parsed)
+    if not isNew:
+      logs.debug(_logger, 'Skipped response from %s that is identical to one already output.', source)
+    elif self._recordsPath is not None:
+      with timing.span('convert') as converting:
+        records=extractRecords(parsed, self._recordsPath)
+        converting.items=len(records)
+      metrics.rowsFetched.labels('genericRest').inc(len(records))
+      self.processRecords(records, source=source)
+    else:
+      metrics.rowsFetched.labels('genericRest').inc()
       # Output the data.
-      if self._bucket is not None: numWritten+=self._writeToBucket(parsed)
-      if self._publisher is not None: numPublished+=self._publish(parsed)
+      succeeded=True
+      if self._bucket is not None:
+        written=self._writeToBucket(parsed, filename=recordId)
+        numWritten+=written
+        succeeded=written==1
+      if self._batchPublisher is not None: succeeded=self._publish(parsed) and succeeded
+      if not succeeded: self._release(recordId)
     return (numWritten, numPublished)
 
-def callAPI(url,headers,parameters,projectId,topic,bucket,pathInBucket,debug):
-  # Access API.
-  _logger.info('Calling {url} with {params}.'.format(url=url, params=str(parameters)))
-  
-  data=None
-  try:
-    session=Session()
-    session.headers.update(headers)
-    response=session.get(url, params=parameters)
-    data=json.loads(response.text)
-  except:
-    _logger.error('Error retrieving data.', exc_info=True, stack_info=True)
-  
-  if data is not None:
-    processor=DataProcessor(projectId=projectId, topic=topic, bucket=bucket, path=pathInBucket, debug=debug)
-    numWritten, numPublished=processor.process(data)
-    _logger.info(
-      'Wrote {numWritten:d} records to gs://{bucket}/{path}, published {numPublished:d} messages to {topic}.'.format(
-        numWritten=numWritten,
-        numPublished=numPublished,
-        bucket=bucket,
-        path=pathInBucket,
-        topic=topic
-      ))
+def _toEndpoints(url, headers=None, parameters=None, pagination=None):
+  '''
+  Args:
+    url: either one URL or a list of endpoint specs, each a dict with a "url" and optionally "headers", "params", and
+         "pagination" (see pagination.getPagination).
+    headers: headers to use for every endpoint that does not give its own.
+    parameters: query parameters to use for every endpoint that does not give its own.
+    pagination: how to page through every endpoint that does not give its own, or None to request one page.
+  Returns: returns a list of endpoint specs.
+  '''
+  if type(url)==str: url=[{'url':url}]
+  endpoints=[]
+  for endpoint in url:
+    if type(endpoint)==str: endpoint={'url':endpoint}
+    endpoints.append({'url':endpoint['url'],
+                      'headers':endpoint.get('headers', headers) or {},
+                      'params':endpoint.get('params', endpoint.get('parameters', parameters)),
+                      'pagination':endpoint.get('pagination', pagination)})
+  return endpoints
+
+def fetchAll(endpoints, client, processPages=None):
+  '''
+  Fetch all the endpoints concurrently.
+  Args:
+    endpoints: a list of endpoint specs (see _toEndpoints).
+    client: the HttpClient to make the requests with.
+    processPages: a function called with each endpoint that has pagination, which pages through it and outputs its
+                  records. Each such endpoint is one task of the same pool as the other endpoints, so endpoints are
+                  paged through at the same time as each other and as the single pages; the pages of one endpoint are
+                  still requested one after the other. None to fetch every endpoint as a single page.
+  Returns: yields (endpoint, response text) in the order the responses arrive, for the endpoints fetched as a single
+           page. Endpoints that fail are logged and skipped.
+  '''
+  def submit(executor, endpoint):
+    if processPages is not None and endpoint['pagination'] is not None: return executor.submit(processPages, endpoint)
+    return executor.submit(client.get, endpoint['url'], params=endpoint['params'], headers=endpoint['headers'])
+  
+  with ThreadPoolExecutor(max_workers=max(1, min(_maxWorkers, len(endpoints)))) as executor:
+    futures=dict((submit(executor, endpoint), endpoint) for endpoint in endpoints)
+    for future in as_completed(futures):
+      endpoint=futures[future]
+      try:
+        response=future.result()
+        if processPages is not None and endpoint['pagination'] is not None: continue
+        response.raise_for_status()
+        yield endpoint, response.text
+      except:
+        logs.error(_logger, 'Error retrieving data from %s', endpoint['url'], perSecond=1, exc_info=True, stack_info=True)
+
+def _getResponseCache(spec):
+  '''
+  Args:
+    spec: a dict with optional "location", "maxEntries" and "ignoreHeaders" (see httpClient.ResponseCache).
+  Returns: returns the response cache for the location and options, which is kept between invocations of a warm
+           instance.
+  '''
+  options={name:spec[name] for name in ['location', 'maxEntries', 'ignoreHeaders'] if name in spec}
+  cacheKey=json.dumps(options, sort_keys=True)
+  with _responseCachesLock:
+    if cacheKey not in _responseCaches: _responseCaches[cacheKey]=ResponseCache(**options)
+    return _responseCaches[cacheKey]
+
+def callAPI(url,headers,parameters,projectId,topic,bucket,pathInBucket,debug,maxPerHost=4,requestsPerSecond=None,
+            pagination=None,recordsPath=None,dedupe=True,cache=None):
+  '''
+  Access one or more endpoints and output each response as it arrives. Endpoints with pagination have the records of
+  all their pages output one at a time instead.
+  Args:
+    url: one URL or a list of endpoint specs, each a dict with a "url" and optionally "headers" and "params".
+    headers: headers sent to every endpoint that does not give its own.
+    parameters: query parameters sent to every endpoint that does not give its own.
+    projectId:
+    topic:
+    bucket:
+    pathInBucket:
+    debug:
+    maxPerHost: the most requests to run against one host at the same time.
+    requestsPerSecond: the most requests to start against one host per second, or None for no limit.
+    pagination: how to page through endpoints that do not give their own pagination (see pagination.getPagination).
+    recordsPath: a JSONPath to the records within each response; if given, records are output instead of responses.
+                 Also the path to the records within each page of endpoints whose pagination does not give its own.
+    dedupe: skip responses and records identical to ones output recently by this instance.
+    cache: None to not cache responses, True to cache them in memory, or a dict with optional "ttl",
+           "staleWhileRevalidate", "location", "maxEntries" and "ignoreHeaders".
+  Returns: returns (number of records written, number of records published).
+  '''
+  endpoints=_toEndpoints(url, headers, parameters, pagination)
+  _logger.info('Calling {num:d} endpoints.'.format(num=len(endpoints)))
+  
+  limiter=HostLimiter(maxConcurrent=maxPerHost, requestsPerSecond=requestsPerSecond)
+  if cache:
+    cacheSpec=cache if type(cache)==dict else {}
+    responseCache=_getResponseCache(cacheSpec)
+    client=HttpClient(limiter=limiter, cache=responseCache, cacheTTL=int(cacheSpec.get('ttl', 0)),
+                      staleWhileRevalidate=int(cacheSpec.get('staleWhileRevalidate', 0)))
+  else:
+    responseCache=None
+    client=HttpClient(limiter=limiter)
+  processor=DataProcessor(projectId=projectId, topic=topic, bucket=bucket, path=pathInBucket, debug=debug,
+                          recordsPath=recordsPath, dedupe=dedupe)
+  totalWritten=0
+  totalPublished=0
+  
+  # Called from the threads of fetchAll. processRecords can be: the dedupe cache, the writer and the publisher are
+  # thread-safe.
+  def processPages(endpoint):
+    fetch=lambda pageURL, pageParams:client.get(pageURL, params=pageParams, headers=endpoint['headers'])
+    records=paginate(fetch, endpoint['url'], endpoint['params'], getPagination(endpoint['pagination'], recordsPath=recordsPath))
+    return processor.processRecords(records, source=endpoint['url'])
+  
+  for endpoint, data in fetchAll(endpoints, client, processPages=processPages):
+    logs.debug(_logger, 'Received response from %s', endpoint['url'])
+    numWritten, numPublished=processor.process(data, source=endpoint['url'])
+    totalWritten+=numWritten
+    totalPublished+=numPublished
+  numWritten, numPublished=processor.close()
+  totalWritten+=numWritten
+  totalPublished+=numPublished
+  client.wait()  # Let stale responses finish revalidating so that the next trigger finds them fresh.
+  if responseCache is not None: _logger.info('Response cache: '+json.dumps(responseCache.stats()))
+  _logger.info(
+    'Wrote {numWritten:d} records to gs://{bucket}/{path}, published {numPublished:d} messages to {topic}.'.format(
+      numWritten=totalWritten,
+      numPublished=totalPublished,
+      bucket=bucket,
+      path=pathInBucket,
+      topic=topic
+    ))
+  return totalWritten, totalPublished
 
+@profiling.profiled('genericRest')
+@timing.timed('genericRest', _logger)
 def cloudFunctionMain(request):
   """Responds to any HTTP request.
   Args:
@@ -274,10 +526,26 @@ def cloudFunctionMain(request):
       return 'Error attempting to access Pub/Sub topic with no project ID.'
     _logger.info('Will submit to {topic}.'.format(topic=topic))
   
-  # Grab the parameters and headers from the message.
+  # Grab the endpoints, or a single url with its parameters and headers, from the message.
+  endpoints=messageJSON.get('endpoints', messageJSON.get('url', None))
+  if endpoints is None:
+    _logger.error('Must include a url or a list of endpoints.')
+    return 'Error no url or endpoints given.'
   parameters=messageJSON.get('parameters',None)
   headers=messageJSON.get('headers',None)
-  callAPI(parameters,projectId,topic,bucket,pathInBucket,debug)
+  maxPerHost=int(messageJSON.get('maxPerHost', 4))
+  requestsPerSecond=messageJSON.get('requestsPerSecond', None)
+  if requestsPerSecond is not None: requestsPerSecond=float(requestsPerSecond)
+  pagination=messageJSON.get('pagination',None)
+  recordsPath=messageJSON.get('recordsPath',None)
+  # The field may come as text, such as "false", from query parameters.
+  dedupe=str(messageJSON.get('dedupe', True)).strip().lower() not in ['false', '0', 'no', '', 'none']
+  cache=messageJSON.get('cache',None)
+  # Either options for the cache or, like dedupe, a flag that may come as text.
+  if type(cache)!=dict: cache=str(cache).strip().lower() not in ['false', '0', 'no', '', 'none']
+  callAPI(endpoints,headers,parameters,projectId,topic,bucket,pathInBucket,debug,
+          maxPerHost=maxPerHost,requestsPerSecond=requestsPerSecond,pagination=pagination,recordsPath=recordsPath,
+          dedupe=dedupe,cache=cache)
   
   return json.dumps(messageJSON)+' completed.'
 
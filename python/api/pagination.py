@@ -0,0 +1,197 @@
+# Pagination strategies for REST APIs that return their results one page at a time.
+# A strategy knows where the records are within a page and how to request the page that follows:
+#   cursor: the page holds a token (or the URL) of the next page, such as {"data":[...],"next":"abc"}.
+#   offset: pages are requested with a start and a limit parameter, such as ?start=1&limit=50, until a short page.
+#   link: the response has a Link header with rel="next", as used by GitHub and many other APIs.
+# paginate() streams the records of all the pages as a generator. It requests the next page while the records of the
+# current page are being processed, and never holds more than two pages in memory.
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from common import logs
+
+_logger=logging.getLogger(__name__)
+_pathTokens=re.compile(r'\[(\*|\d+)\]|\.?([^.\[\]]+)')
+
+def getField(data, path):
+  '''
+  Args:
+    data: a dict parsed from JSON.
+    path: names of nested fields separated by periods, such as "data.items", or None for the data itself.
+  Returns: returns the value found at the path or None if the path does not exist.
+  '''
+  if path is None or path=='': return data
+  for field in path.split('.'):
+    if type(data)==dict:
+      data=data.get(field, None)
+    elif type(data)==list and field.isdigit() and int(field)<len(data):
+      data=data[int(field)]
+    else:
+      return None
+  return data
+
+def extractRecords(data, path):
+  '''
+  Find the records within a response using a simple JSONPath, such as "$.data[*]", "$.results[*].items[*]" or
+  "data.items". Supported are field names, [n] indexes, and [*] (or .*) wildcards that step into every element of a list.
+  Args:
+    data: a response parsed from JSON.
+    path: the JSONPath, or None for the data itself.
+  Returns: returns a list of records. A path that ends on a list without a wildcard returns the elements of the list, and
+           a path that does not exist returns an empty list.
+  '''
+  matches=[data]
+  token=None
+  if path is not None and path not in ['', '$']:
+    for index, field in _pathTokens.findall(path[1:] if path.startswith('$') else path):
+      token=index if index!='' else field
+      found=[]
+      for match in matches:
+        if token=='*':
+          if type(match)==list: found.extend(match)
+          elif type(match)==dict: found.extend(match.values())
+        elif type(match)==list and token.isdigit():
+          if int(token)<len(match): found.append(match[int(token)])
+        elif type(match)==dict and token in match:
+          found.append(match[token])
+      matches=found
+  if token=='*': return matches  # Each element matched by a trailing wildcard is a record, even if it is a list.
+  records=[]
+  for match in matches:
+    if match is None: continue
+    if type(match)==list:
+      records.extend(match)
+    else:
+      records.append(match)
+  return records
+
+class Pagination(object):
+  '''
+  Requests only one page. The subclasses follow the pages of an API.
+  '''
+
+  def __init__(self, recordsPath=None, maxPages=None):
+    '''
+    :param recordsPath: path to the records within a page (see extractRecords). If None, a page that is a list is
+                        treated as a list of records and any other page is one record.
+    :param maxPages: stop after this many pages, or None to follow all the pages.
+    '''
+    self.recordsPath=recordsPath
+    self.maxPages=maxPages
+
+  def records(self, data):
+    '''
+    :param data: a page parsed from JSON.
+    :return: returns the list of records in the page.
+    '''
+    return extractRecords(data, self.recordsPath)
+
+  def firstRequest(self, url, params):
+    return url, params
+
+  def nextRequest(self, response, data, url, params):
+    '''
+    :param response: the response for the current page.
+    :param data: the current page parsed from JSON.
+    :param url: the URL the current page was requested from.
+    :param params: the parameters the current page was requested with.
+    :return: returns (url, params) for the next page or None if this was the last page.
+    '''
+    return None
+
+class CursorPagination(Pagination):
+  def __init__(self, cursorPath='next', cursorParam='cursor', recordsPath=None, maxPages=None):
+    '''
+    :param cursorPath: path to the token of the next page within a page. A token that is a URL is requested as is.
+    :param cursorParam: the query parameter that passes the token to the API.
+    '''
+    super().__init__(recordsPath=recordsPath, maxPages=maxPages)
+    self.cursorPath=cursorPath
+    self.cursorParam=cursorParam
+
+  def nextRequest(self, response, data, url, params):
+    cursor=getField(data, self.cursorPath)
+    if cursor is None or cursor=='': return None
+    if type(cursor)==str and (cursor.startswith('http://') or cursor.startswith('https://')): return cursor, None
+    nextParams=dict(params or {})
+    nextParams[self.cursorParam]=cursor
+    return url, nextParams
+
+class OffsetPagination(Pagination):
+  def __init__(self, startParam='start', limitParam='limit', start=1, limit=50, recordsPath=None, maxPages=None):
+    '''
+    :param startParam: the query parameter giving the position of the first record in a page.
+    :param limitParam: the query parameter giving the number of records in a page.
+    :param start: the position of the first record, usually 0 or 1.
+    :param limit: the number of records to request per page if the parameters do not already give it.
+    '''
+    super().__init__(recordsPath=recordsPath, maxPages=maxPages)
+    self.startParam=startParam
+    self.limitParam=limitParam
+    self.start=start
+    self.limit=limit
+
+  def firstRequest(self, url, params):
+    firstParams=dict(params or {})
+    firstParams.setdefault(self.startParam, self.start)
+    firstParams.setdefault(self.limitParam, self.limit)
+    return url, firstParams
+
+  def nextRequest(self, response, data, url, params):
+    limit=int(params[self.limitParam])
+    if len(self.records(data))<limit: return None  # A short page is the last page.
+    nextParams=dict(params)
+    nextParams[self.startParam]=int(params[self.startParam])+limit
+    return url, nextParams
+
+class LinkHeaderPagination(Pagination):
+  def nextRequest(self, response, data, url, params):
+    nextLink=response.links.get('next', {}).get('url', None)
+    if nextLink is None: return None
+    return nextLink, None  # The link already includes the query parameters.
+
+_strategies={'cursor':CursorPagination, 'offset':OffsetPagination, 'link':LinkHeaderPagination}
+
+def getPagination(spec, recordsPath=None):
+  '''
+  :param spec: None, a strategy name, or a dict such as {"type":"offset","limit":100,"recordsPath":"data"} whose other
+               fields are passed to the strategy.
+  :param recordsPath: the path to the records within a page when spec does not give its own.
+  :return: returns a Pagination instance.
+  '''
+  if spec is None: return Pagination(recordsPath=recordsPath)
+  if isinstance(spec, Pagination): return spec
+  if type(spec)==str: spec={'type':spec}
+  options=dict(spec)
+  if options.get('recordsPath', None) is None: options['recordsPath']=recordsPath
+  strategy=_strategies.get(options.pop('type', None), Pagination)
+  return strategy(**options)
+
+def paginate(fetch, url, params, pagination):
+  '''
+  Stream the records from every page.
+  :param fetch: a function taking (url, params) and returning a requests.Response.
+  :param url:
+  :param params: the query parameters of the first page.
+  :param pagination: a Pagination strategy.
+  :return: yields each record of each page in order.
+  '''
+  url, params=pagination.firstRequest(url, params)
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    pending=executor.submit(fetch, url, params)
+    numPages=0
+    while pending is not None:
+      response=pending.result()
+      response.raise_for_status()
+      data=response.json()
+      numPages+=1
+      logs.debug(_logger, 'Received page %d from %s.', numPages, url)
+      pending=None
+      if pagination.maxPages is None or numPages<pagination.maxPages:
+        nextRequest=pagination.nextRequest(response, data, url, params)
+        if nextRequest is not None:
+          url, params=nextRequest
+          pending=executor.submit(fetch, url, params)  # Request the next page while this page is processed.
+      for record in pagination.records(data):
+        yield record
@@ -11,6 +11,7 @@
 #   period: defaults to 10y.
 #   interval: defaults to 1 day ("1d").
 #   addTimestamp: if "true" then place all the files within a folder named by a timestamp, otherwise will overwrite any file with the same name in the path you give.
+#   profile: profiles the invocation and writes the results to the bucket (see common.profiling).
 #
 # You can test out this code from the command-line:
 #   Make sure to set your PYTHONPATH to include the code, such as the following for a LINUX system, such as from Cloud Shell:
@@ -80,20 +81,23 @@ test=[
   }
 ]
 
-import yfinance as yf
 from argparse import ArgumentParser
 import functions_framework
 import os
 import json
 import logging
 from datetime import datetime
-from google.cloud import storage
-from google.cloud.pubsub_v1 import PublisherClient
+from common import lazy, logs, metrics, profiling, timing
 
 logging.basicConfig(format='%(asctime)s.%(msecs)03dZ,%(pathname)s:%(lineno)d,%(levelname)s,%(module)s,%(funcName)s: %(message)s',
                     datefmt="%Y-%m-%d %H:%M:%S")
 _logger = logging.getLogger(__name__)
 
+# Imported when first used, so that a cold start does not load clients and libraries, such as yfinance with pandas, the invocation does not need.
+yf=lazy.module('yfinance')
+storage=lazy.module('google.cloud.storage')
+pubsub_v1=lazy.module('google.cloud.pubsub_v1')
+
 _allStocksFile='allStocks.csv'
 _storageClient=None
 _yahooColumns=['date','open','high','low','close','adj_close','volume','symbol']
@@ -158,7 +162,10 @@ def _store(bucket,path,data):
   Returns:
   '''
   try:
-    return _getStorageClient(bucket).blob(path).upload_from_string(data)
+    with timing.span('store'):
+      result=_getStorageClient(bucket).blob(path).upload_from_string(data)
+    metrics.uploadBytes.labels(bucket).inc(len(data))
+    return result
   except:
     _logger.error('Cannot write to '+path+' in '+bucket,exc_info=True,stack_info=True)
 
@@ -173,18 +180,21 @@ def _publish(projectId,topic,data,additional=None):
                 such as _publish(..., additional=",SYMBOL" )
   '''
   try:
-    pubsubClient=PublisherClient()
+    pubsubClient=pubsub_v1.PublisherClient()
     topicPath='projects/'+projectId+'/topics/'+topic
     publishingFutures=[] # Will collect all the future publish calls in this list.
-    for row in data.split('\n')[1:]:  # Split will break out each line as a separate row. [1:] will skip the header row.:
-      # Don't publish a message that only has empty entries or is an empty line.
-      if len(row.replace(',','').strip())>0:
-        if additional is not None: row+=additional
-        # Convert row into JSON.
-        jsonRow=convertToJson(row,_yahooColumns)
-        publishingFutures.append(pubsubClient.publish(topicPath,jsonRow.encode())) # Encode the data as bytes.
-    for publishing in publishingFutures:
-      publishing.result() # Calling the result() method will cause the future command to actually execute if it hasn't already done so.
+    with timing.span('publish') as publishing:
+      for row in data.split('\n')[1:]:  # Split will break out each line as a separate row. [1:] will skip the header row.:
+        # Don't publish a message that only has empty entries or is an empty line.
+        if len(row.replace(',','').strip())>0:
+          if additional is not None: row+=additional
+          # Convert row into JSON.
+          jsonRow=convertToJson(row,_yahooColumns)
+          publishingFutures.append(metrics.trackPublish(pubsubClient.publish(topicPath,jsonRow.encode()),topicPath)) # Encode the data as bytes.
+      publishing.items=len(publishingFutures)
+    with timing.span('ack', items=len(publishingFutures)):
+      for publishing in publishingFutures:
+        publishing.result() # Calling the result() method will cause the future command to actually execute if it hasn't already done so.
   except:
     _logger.error('Cannot publish to '+topic,exc_info=True,stack_info=True)
     
@@ -198,8 +208,11 @@ def _parse(stock,period,interval,action):
     action: a function that takes the data returned by the API and acts on it.
   Returns:
   '''
-  yahooResponse=yf.download(tickers=stock, period=period, interval=interval)
-  data=yahooResponse.to_csv()
+  with timing.span('fetch'):
+    yahooResponse=yf.download(tickers=stock, period=period, interval=interval)
+  with timing.span('convert'):
+    data=yahooResponse.to_csv()
+  metrics.rowsFetched.labels('yahooFinance').inc(max(0, data.count('\n')-1))  # Less the header.
   return action(data)
 
 def parseAll(allStocksFile,period,interval,bucket=None,path=None,projectId=None,topic=None,store=True,publish=True):
@@ -213,7 +226,7 @@ def parseAll(allStocksFile,period,interval,bucket=None,path=None,projectId=None,
   for symbol in symbols:
     try:
       cleanedSymbol=symbol.strip()
-      _logger.debug('Parsing '+cleanedSymbol)
+      logs.debug(_logger, 'Parsing %s', cleanedSymbol)
       actions=[]
       if store: actions.append(lambda data: _store(bucket,'{path}/symbol={symbol}/{symbol}.csv'.format(path=path,symbol=cleanedSymbol),data))
       if publish: actions.append(lambda data: _publish(projectId,topic,data,additional=','+cleanedSymbol))
@@ -221,7 +234,7 @@ def parseAll(allStocksFile,period,interval,bucket=None,path=None,projectId=None,
         _parse(cleanedSymbol,period,interval,action)
       numStocks+=1
     except:
-      _logger.error('Cannot parse stocks for symbol '+symbol)
+      logs.error(_logger, 'Cannot parse stocks for symbol %s', symbol, perSecond=1)
   return numStocks
 
 def _getMessageJSON(request):
@@ -235,7 +248,7 @@ def _getMessageJSON(request):
   message=None
   
   if request.args is not None:
-    _logger.debug('request is '+str(request)+' with args '+str(request.args))
+    logs.debug(_logger, 'request is %s with args %s', request, request.args)
     if 'message' in request.args: message=request.args.get('message')
     
     if any(map(lambda param:param in request.args, ['bucket', 'path', 'topic', 'projectId'])):
@@ -243,14 +256,14 @@ def _getMessageJSON(request):
       message=request.args
   if message is None and request_json is not None:
     # If message remains unset (None) then assuming that the request_json holds the contents of the message we are looking for.
-    _logger.debug('request_json is '+str(request_json))
+    logs.debug(_logger, 'request_json is %s', request_json)
     if 'message' in request_json:
       message=request_json['message']
     else:
       message=request_json
   
   if message is None:
-    _logger.warning('message is empty. request='+str(request)+' request_json='+str(request_json))
+    logs.warning(_logger, 'message is empty. request=%s request_json=%s', request, request_json)
     message='{}'
   
   if type(message)==str:
@@ -266,9 +279,11 @@ def _getMessageJSON(request):
   else:
     # Else, assuming messageJSON was decoded from a JSON object.
     messageJSON=message
-  return messageJSON
+  return profiling.start(messageJSON)
 
 @functions_framework.http
+@profiling.profiled('yahooFinance')
+@timing.timed('yahooFinance', _logger)
 def entry(request):
   '''
   Args:
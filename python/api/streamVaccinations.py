@@ -5,14 +5,17 @@ import os
 import json
 import logging
 from datetime import datetime,date
-from google.cloud import storage
-from google.cloud.pubsub_v1 import PublisherClient
+from common import lazy, logs, metrics, profiling, timing
 
 logging.basicConfig(
   format='%(asctime)s.%(msecs)03dZ,%(pathname)s:%(lineno)d,%(levelname)s,%(module)s,%(funcName)s: %(message)s',
   datefmt="%Y-%m-%d %H:%M:%S")
 _logger=logging.getLogger(__name__)
 
+# Imported when first used, so that a cold start does not load clients and libraries the invocation does not need.
+storage=lazy.module('google.cloud.storage')
+pubsub_v1=lazy.module('google.cloud.pubsub_v1')
+
 _storageClient=None
 _columns=[
   'date',
@@ -107,7 +110,10 @@ def _store(bucket, path, data):
   Returns:
   '''
   try:
-    return _getStorageClient(bucket).blob(path).upload_from_string(data)
+    with timing.span('store'):
+      result=_getStorageClient(bucket).blob(path).upload_from_string(data)
+    metrics.uploadBytes.labels(bucket).inc(len(data))
+    return result
   except:
     _logger.error('Cannot write to '+path+' in '+bucket, exc_info=True, stack_info=True)
 
@@ -122,17 +128,20 @@ def _publish(projectId, topic, row, additional=None):
                 such as _publish(..., additional=",SYMBOL" )
   '''
   try:
-    pubsubClient=PublisherClient()
+    pubsubClient=pubsub_v1.PublisherClient()
     topicPath='projects/'+projectId+'/topics/'+topic
     publishingFutures=[]  # Will collect all the future publish calls in this list.
     # Don't publish a message that only has empty entries or is an empty line.
     if len(row.replace('\t', '').strip())>0:
       if additional is not None: row+=additional
       # Convert row into JSON.
-      jsonRow=convertToJson(row, _columns, delimiter='\t')
-      publishingFutures.append(pubsubClient.publish(topicPath, jsonRow.encode()))  # Encode the data as bytes.
-    for publishing in publishingFutures:
-      publishing.result()  # Calling the result() method will cause the future command to actually execute if it hasn't already done so.
+      with timing.span('convert'):
+        jsonRow=convertToJson(row, _columns, delimiter='\t')
+      with timing.span('publish'):
+        publishingFutures.append(metrics.trackPublish(pubsubClient.publish(topicPath, jsonRow.encode()), topicPath))  # Encode the data as bytes.
+    with timing.span('ack', items=len(publishingFutures)):
+      for publishing in publishingFutures:
+        publishing.result()  # Calling the result() method will cause the future command to actually execute if it hasn't already done so.
   except:
     _logger.error('Cannot publish to '+topic, exc_info=True, stack_info=True)
 
@@ -147,7 +156,7 @@ def _getMessageJSON(request):
   message=None
   
   if request.args is not None:
-    _logger.debug('request is '+str(request)+' with args '+str(request.args))
+    logs.debug(_logger, 'request is %s with args %s', request, request.args)
     if 'message' in request.args: message=request.args.get('message')
     
     if any(map(lambda param:param in request.args, ['bucket', 'path', 'topic', 'projectId'])):
@@ -155,14 +164,14 @@ def _getMessageJSON(request):
       message=request.args
   if message is None and request_json is not None:
     # If message remains unset (None) then assuming that the request_json holds the contents of the message we are looking for.
-    _logger.debug('request_json is '+str(request_json))
+    logs.debug(_logger, 'request_json is %s', request_json)
     if 'message' in request_json:
       message=request_json['message']
     else:
       message=request_json
   
   if message is None:
-    _logger.warning('message is empty. request='+str(request)+' request_json='+str(request_json))
+    logs.warning(_logger, 'message is empty. request=%s request_json=%s', request, request_json)
     message='{}'
   
   if type(message)==str:
@@ -178,7 +187,7 @@ def _getMessageJSON(request):
   else:
     # Else, assuming messageJSON was decoded from a JSON object.
     messageJSON=message
-  return messageJSON
+  return profiling.start(messageJSON)
 
 def _parse(row,action):
   '''
@@ -196,7 +205,12 @@ def parseAll(inputPath,bucket=None,path=None,projectId=None,topic=None,store=Tru
   rowNum=0
   dataFile=_getStorageClient(bucket).blob(inputPath)
   if dataFile.exists():
-    dataRows=dataFile.download_as_bytes().decode('utf-8').split('\n')
+    with timing.span('fetch'):
+      contents=dataFile.download_as_bytes()
+    with timing.span('decode') as decoding:
+      dataRows=contents.decode('utf-8').split('\n')
+      decoding.items=len(dataRows)
+    metrics.rowsFetched.labels('streamVaccinations').inc(len(dataRows))
     for row in dataRows:
       try:
         actions=[]
@@ -207,12 +221,14 @@ def parseAll(inputPath,bucket=None,path=None,projectId=None,topic=None,store=Tru
           _parse(row, action)
         rowNum+=1
       except:
-        _logger.error('Cannot parse row '+str(rowNum))
+        logs.error(_logger, 'Cannot parse row %d', rowNum, perSecond=1)
   else:
     _logger.error('Cannot read data from '+inputPath+' in bucket '+bucket)
   return rowNum
 
 @functions_framework.http
+@profiling.profiled('streamVaccinations')
+@timing.timed('streamVaccinations', _logger)
 def entry(request):
   '''
   Args:
@@ -3,10 +3,13 @@ import functions_framework
 import os
 import json
 import logging
+import math
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from google.cloud import storage
-from google.cloud.pubsub_v1 import PublisherClient
-import requests
+from common import logs, metrics, profiling, timing
+from common.httpClient import HttpClient, isNotModified
+from common.sinks import BatchPublisher, JsonlWriter, getStorageClient, writeAndPublish
 
 examples=[
   {
@@ -21,6 +24,17 @@ examples=[
      "storage":"true",
      "topic":"traffic-topic",
      "pubsub":"true"
+  },
+  # Only output the incidents that are new, updated, or cleared since the previous run:
+  {
+     "bucket":"prof-big-data_data",
+     "path":"traffic",
+     "projectId":"prof-big-data",
+     "key":"NO KEY GIVEN",
+     "bounds":[[39.95,-105.25,39.52,-104.71],[40.10,-105.30,39.95,-105.05]],
+     "changesOnly":"true",
+     "topic":"traffic-topic",
+     "pubsub":"true"
   }
 ]
 
@@ -28,117 +42,210 @@ logging.basicConfig(format='%(asctime)s.%(msecs)03dZ,%(pathname)s:%(lineno)d,%(l
                     datefmt="%Y-%m-%d %H:%M:%S")
 _logger = logging.getLogger(__name__)
 
-_storageClient=None
+_httpClient=HttpClient(conditional=True)  # Remembers the last response for each tile so unchanged tiles cost a 304.
 _baseURL='http://www.mapquestapi.com/traffic/v2/incidents'
+_maxTileSize=1.0  # Largest span, in degrees of latitude or longitude, that is requested from MapQuest in one call.
+_maxWorkers=8  # Number of tiles that are requested from MapQuest at the same time.
 
-def _getStorageClient(bucket):
+def _toRegions(bounds):
   '''
+  Bounds can be given as one bounding box or as a list of bounding boxes. A bounding box is either a list of 4 numbers
+  (lat,long,lat,long) or a list of 2 tuples of (lat,long).
   Args:
-    bucket:
-  Returns: returns an existing connection to GCS or else creates a new connection to GCS.
+    bounds: one or more bounding boxes.
+  Returns: returns a list of bounding boxes, each as 2 tuples of (lat,long).
   '''
-  global _storageClient
-  if _storageClient is None:
-    # This is the first time we are hitting storage, so open a new connection.
-    _storageClient=storage.Client().bucket(bucket)
-  if not _storageClient.exists(): raise Exception('Cannot access bucket '+bucket)
-  return _storageClient
+  if len(bounds)==4 and all(map(lambda value:type(value) in [int, float], bounds)):
+    return [((bounds[0], bounds[1]), (bounds[2], bounds[3]))]
+  if len(bounds)==2 and all(map(lambda corner:len(corner)==2 and type(corner[0]) in [int, float], bounds)):
+    return [(tuple(bounds[0]), tuple(bounds[1]))]
+  regions=[]
+  for region in bounds:
+    regions.extend(_toRegions(region))
+  return regions
 
-def _store(bucket, path, data):
+def _tileBounds(bounds, maxTileSize=_maxTileSize):
   '''
-  An action that stores the data in the bucket at the given path.
+  Split a bounding box into a grid of tiles that are small enough for MapQuest to accept.
   Args:
-    bucket:
-    path:
-    data:
-  Returns:
+    bounds: 2 tuples of (lat,long) at opposite corners of the bounding box. The corners can be given in any order.
+    maxTileSize: the largest span of a tile in degrees of latitude or longitude.
+  Returns: returns a list of tiles, each as 2 tuples of (minLat,minLong),(maxLat,maxLong).
   '''
-  try:
-    return _getStorageClient(bucket).blob(path).upload_from_string(data)
-  except:
-    _logger.error('Cannot write to '+path+' in '+bucket, exc_info=True, stack_info=True)
-
-def _publishOneRow(pubsubClient,topicPath,row):
-  cleaned=row.strip()
-  if len(cleaned)>0:
-    # Don't publish an empty message.
-    return pubsubClient.publish(topicPath, cleaned.encode())  # Encode the data as bytes.
-  return None
+  minLat,maxLat=sorted((bounds[0][0], bounds[1][0]))
+  minLong,maxLong=sorted((bounds[0][1], bounds[1][1]))
+  numLat=max(1, math.ceil(round((maxLat-minLat)/maxTileSize, 9)))
+  numLong=max(1, math.ceil(round((maxLong-minLong)/maxTileSize, 9)))
+  # Compute the edges from the corners instead of adding up steps so that the last tile ends exactly on the boundary.
+  latEdges=[round(minLat+(maxLat-minLat)*index/numLat, 6) for index in range(numLat+1)]
+  longEdges=[round(minLong+(maxLong-minLong)*index/numLong, 6) for index in range(numLong+1)]
+  tiles=[]
+  for latIndex in range(numLat):
+    for longIndex in range(numLong):
+      tiles.append(((latEdges[latIndex], longEdges[longIndex]), (latEdges[latIndex+1], longEdges[longIndex+1])))
+  return tiles
 
-def _publish(projectId, topic, data, additional=None):
+def _getTiledData(key, bounds, filters, maxTileSize=_maxTileSize, maxWorkers=_maxWorkers):
   '''
-  An action that writes the data to the given topic.
+  Split the bounding boxes into tiles, query the API for all the tiles concurrently, and merge the incidents. Incidents
+  that show up in more than one tile (because the tiles or the bounding boxes overlap) are only returned once.
   Args:
-    projectId:
-    topic:
-    data:
-    additional: any additional text to add to the end of the line. If data is comma-delimited, then don't forget to add a comma to addtional,
-                such as _publish(..., additional=",SYMBOL" )
-  Returns:
+    key: mapquest key.
+    bounds: one or more bounding boxes (see _toRegions).
+    filters: a list of the types of incidents to retrieve.
+    maxTileSize: the largest span of a tile in degrees of latitude or longitude.
+    maxWorkers: the number of tiles to request at the same time.
+  Returns: returns a tuple of (list of incidents, number of tiles requested, number of tiles that failed, number of tiles
+           that have not changed since the last request).
   '''
-  try:
-    pubsubClient=PublisherClient()
-    topicPath='projects/'+projectId+'/topics/'+topic
-    publishingFutures=[]  # Will collect all the future publish calls in this list.
-    if type(data)==str:
-      if additional is not None: data+=additional
-      future=_publishOneRow(pubsubClient,topicPath,data)
-      if future is not None: publishingFutures.append(future)
-    elif type(data)==dict:
-      if additional is not None: data['additional']=additional
-      future=_publishOneRow(pubsubClient,topicPath,json.dumps(data))
-      if future is not None: publishingFutures.append(future)
-    elif type(data) in [list,tuple,set]:
-      for row in data:
-        if additional is not None: row += additional
-        future=_publishOneRow(pubsubClient,topicPath,row)
-        if future is not None: publishingFutures.append(future)
-    _logger.debug('Will publish '+str(len(publishingFutures))+' messages.')
-    for publishing in publishingFutures:
-      publishing.result()  # Calling the result() method will cause the future command to actually execute if it hasn't already done so.
-  except:
-    _logger.error('Cannot publish to '+topic, exc_info=True, stack_info=True)
+  tiles=[]
+  for region in _toRegions(bounds):
+    for tile in _tileBounds(region, maxTileSize):
+      if tile not in tiles: tiles.append(tile)
+  logs.debug(_logger, 'Requesting %d tiles from MapQuest.', len(tiles))
+  
+  incidents={}  # Incidents keyed by their id. A dict keeps the order in which incidents were first seen.
+  numFailed=0
+  numUnchanged=0
+  with ThreadPoolExecutor(max_workers=max(1, min(maxWorkers, len(tiles)))) as executor:
+    futures=[executor.submit(_getData, key, tile, filters) for tile in tiles]
+    for tile, future in zip(tiles, futures):
+      try:
+        tileIncidents,modified=future.result()
+        if not modified: numUnchanged+=1
+      except:
+        logs.error(_logger, 'Cannot retrieve incidents for tile %s', tile, perSecond=1, exc_info=True, stack_info=True)
+        numFailed+=1
+        continue
+      for incident in tileIncidents or []:
+        incidentId=incident.get('id', None)
+        if incidentId is None:
+          incidents[(None, len(incidents))]=incident  # Cannot deduplicate an incident that has no id, so always keep it.
+        elif incidentId not in incidents:
+          incidents[incidentId]=incident
+  return list(incidents.values()), len(tiles), numFailed, numUnchanged
 
 def _getData(key,bounds,filters):
   '''
-  Query the API for the data on the given stock and act on it.
+  Query the API for the incidents within one bounding box.
   Args:
     key: mapquest key.
     bounds: a list of 2 tuples, where each tuple is (latitude,longitude). These 2 tuples specify the minimum-left and maximum-right bounds.
     filters: a list of the types of incidents to retrieve.
-  Returns:
+  Returns: returns a tuple of (list of incidents or None, False if MapQuest reported that nothing changed since the last
+           request for the same bounding box).
   '''
   minLat,minLong=bounds[0]
   maxLat,maxLong=bounds[1]
-  response=requests.get('{url}?key={key}&boundingBox={minLat},{minLong},{maxLat},{maxLong}&filters={filters}'.format(
-    url=_baseURL,
-    key=key,
-    minLat=minLat,
-    minLong=minLong,
-    maxLat=maxLat,
-    maxLong=maxLong,
-    filters=','.join(filters)
-  )).json()
-  if 'incidents' in response:
-    return response['incidents']
-  return None
+  response=_httpClient.get(_baseURL, params={
+    'key':key,
+    'boundingBox':'{minLat},{minLong},{maxLat},{maxLong}'.format(minLat=minLat, minLong=minLong, maxLat=maxLat, maxLong=maxLong),
+    'filters':','.join(filters)
+  })
+  if not isNotModified(response): response.raise_for_status()
+  with timing.span('decode'):
+    data=response.json()
+  if 'incidents' in data:
+    metrics.rowsFetched.labels('mapquestIncidents').inc(len(data['incidents']))
+    return data['incidents'], not isNotModified(response)
+  return None, not isNotModified(response)
 
-def _parse(data,action):
+class IncidentState(object):
   '''
-  Query the API for the data on the given stock and act on it.
-  Args:
-    data: a string containing the data to act on. This string can be multiple lines long.
-    action: a function that takes the data returned by the API and acts on it.
-  Returns:
+  Remembers a hash of the contents of every incident that has been output so that later runs only output incidents that
+  are new, were updated, or were cleared (no longer returned by MapQuest). The state is kept in a local file or, when the
+  location starts with gs://, in an object in GCS.
   '''
-  return action(data)
+  changeTypes=['new', 'updated', 'cleared']
+  
+  @staticmethod
+  def _hash(incident):
+    '''
+    :param incident: a dict representing one incident.
+    :return: returns a short hash of the incident's contents that does not depend on the order of its fields.
+    '''
+    return blake2b(json.dumps(incident, sort_keys=True, separators=(',', ':')).encode(), digest_size=16).hexdigest()
+  
+  def __init__(self, location):
+    '''
+    :param location: a local file path or gs://bucket/path of the object that holds the state.
+    '''
+    self._location=location
+    self._blob=None
+    if location.startswith('gs://'):
+      bucket,_,objectPath=location[len('gs://'):].partition('/')
+      self._blob=getStorageClient().bucket(bucket).blob(objectPath)
+    self._hashes=self._load()
+  
+  def _load(self):
+    '''
+    :return: returns a dict mapping each incident id to the hash of its contents when it was last output.
+    '''
+    try:
+      if self._blob is not None:
+        if not self._blob.exists(): return {}
+        contents=self._blob.download_as_bytes().decode('utf-8')
+      else:
+        if not os.path.exists(self._location): return {}
+        with open(self._location) as stateFile:
+          contents=stateFile.read()
+      return json.loads(contents).get('incidents', {})
+    except:
+      _logger.error('Cannot read incident state from '+self._location+'. All incidents will be treated as new.',
+                    exc_info=True, stack_info=True)
+      return {}
+  
+  def save(self):
+    contents=json.dumps({'updated':datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), 'incidents':self._hashes})
+    try:
+      if self._blob is not None:
+        self._blob.upload_from_string(contents, content_type='application/json')
+      else:
+        with open(self._location, 'w') as stateFile:
+          stateFile.write(contents)
+    except:
+      _logger.error('Cannot write incident state to '+self._location, exc_info=True, stack_info=True)
+  
+  def changes(self, incidents, complete=True):
+    '''
+    Compare the incidents against the state, tag each changed incident with its change type, and update the state.
+    :param incidents: all the incidents currently returned by MapQuest.
+    :param complete: set to False if some of the incidents could not be retrieved; previously seen incidents are then
+                     not reported as cleared since they may just be missing from this run.
+    :return: returns a list of the new and updated incidents plus an {"id":...} record for each cleared incident. Each
+             has a "changeType" field set to one of "new", "updated", or "cleared".
+    '''
+    changed=[]
+    currentHashes={}
+    for incident in incidents:
+      incidentId=incident.get('id', None)
+      if incidentId is None:
+        changed.append(dict(incident, changeType='new'))  # Cannot track an incident without an id.
+        continue
+      incidentId=str(incidentId)  # The ids are keys in the JSON state, which are always strings.
+      currentHashes[incidentId]=self._hash(incident)
+      previousHash=self._hashes.get(incidentId, None)
+      if previousHash is None:
+        changed.append(dict(incident, changeType='new'))
+      elif previousHash!=currentHashes[incidentId]:
+        changed.append(dict(incident, changeType='updated'))
+    for incidentId in self._hashes:
+      if incidentId not in currentHashes:
+        if complete:
+          changed.append({'id':incidentId, 'changeType':'cleared'})
+        else:
+          currentHashes[incidentId]=self._hashes[incidentId]
+    self._hashes=currentHashes
+    return changed
 
-def parseAll(key,bounds,filters,bucket=None,path=None,projectId=None,topic=None,store=True,publish=True):
+def parseAll(key,bounds,filters,bucket=None,path=None,projectId=None,topic=None,store=True,publish=True,
+             maxTileSize=_maxTileSize,statePath=None):
   '''
   
   Args:
     key: your mapquest key.
     bounds: a list of 2 tuples, where each tuple is (lat,long). These are the min and max corners of the bounding box.
+            Can also be a list of bounding boxes. Large bounding boxes are split into tiles of at most maxTileSize degrees.
     filters: a list of the types of incidents to include, such as ["construction","incidents"]
     bucket:
     path:
@@ -146,22 +253,42 @@ def parseAll(key,bounds,filters,bucket=None,path=None,projectId=None,topic=None,
     topic:
     store:
     publish:
+    maxTileSize: the largest span of a tile in degrees of latitude or longitude.
+    statePath: if given, only output the incidents that changed since the last run (see IncidentState). This is a local
+               file path or gs://bucket/path that holds what was output previously.
   Returns: returns the number of items published and written.
 
   '''
   num=0
-  incidents=_getData(key,bounds,filters)
-  if incidents is not None:
-    if publish:
-      action=lambda data:_publish(projectId, topic, data)
-      for datum in incidents:
-        _parse(datum,action)
-        num+=1
-    if storage:
-      action=lambda data: _store(bucket,'{path}/incidents.json'.format(path=path),data) # Store the chunk of data as one file. This will be in JSONL format for BigQuery.
-      allIncidents='\n'.join(map(lambda datum:json.dumps(datum),incidents))
-      _parse(allIncidents,action)
-      num+=1
+  incidents,numTiles,numFailed,numUnchanged=_getTiledData(key,bounds,filters,maxTileSize=maxTileSize)
+  if numFailed>0: _logger.warning('Failed to retrieve '+str(numFailed)+' of '+str(numTiles)+' tiles.')
+  if numUnchanged==numTiles:
+    # Every tile answered 304 Not Modified, so everything was already published and stored.
+    _logger.info('No incidents changed since the last request.')
+    return num
+  if numFailed<numTiles:
+    state=None
+    if statePath is not None:
+      state=IncidentState(statePath)
+      numIncidents=len(incidents)
+      with timing.span('convert', items=numIncidents):
+        incidents=state.changes(incidents, complete=numFailed==0)
+      logs.debug(_logger, '%d of %d incidents changed since the last run.', len(incidents), numIncidents)
+    # Store the incidents as JSONL files for BigQuery while publishing each incident as a separate message.
+    writer=JsonlWriter(bucket, path, prefix='incidents') if store else None
+    publisher=BatchPublisher(projectId, topic) if publish else None
+    numWritten,numPublished=writeAndPublish(incidents, writer=writer, publisher=publisher)
+    num+=numWritten+numPublished
+    if state is not None:
+      # Failed writes and publishes are not traced back to their incidents, so the state is only saved when every
+      # changed incident was output. Otherwise the next run outputs all of them again rather than losing some.
+      if (writer is None or numWritten>=len(incidents)) and (publisher is None or numPublished>=len(incidents)):
+        state.save()
+      else:
+        _logger.warning('Wrote {numWritten:d} and published {numPublished:d} of {num:d} changed incidents. Not saving '
+                        'the state so that they are output again.'.format(numWritten=numWritten,
+                                                                          numPublished=numPublished,
+                                                                          num=len(incidents)))
   return num
 
 def _getMessageJSON(request):
@@ -175,7 +302,7 @@ def _getMessageJSON(request):
   message=None
   
   if request.args is not None:
-    _logger.debug('request is '+str(request)+' with args '+str(request.args))
+    logs.debug(_logger, 'request is %s with args %s', request, request.args)
     if 'message' in request.args: message=request.args.get('message')
     
     if any(map(lambda param:param in request.args, ['bucket', 'path', 'topic', 'projectId'])):
@@ -183,14 +310,14 @@ def _getMessageJSON(request):
       message=request.args
   if message is None and request_json is not None:
     # If message remains unset (None) then assuming that the request_json holds the contents of the message we are looking for.
-    _logger.debug('request_json is '+str(request_json))
+    logs.debug(_logger, 'request_json is %s', request_json)
     if 'message' in request_json:
       message=request_json['message']
     else:
       message=request_json
   
   if message is None:
-    _logger.warning('message is empty. request='+str(request)+' request_json='+str(request_json))
+    logs.warning(_logger, 'message is empty. request=%s request_json=%s', request, request_json)
     message='{}'
   
   if type(message)==str:
@@ -206,9 +333,11 @@ def _getMessageJSON(request):
   else:
     # Else, assuming messageJSON was decoded from a JSON object.
     messageJSON=message
-  return messageJSON
+  return profiling.start(messageJSON)
 
 @functions_framework.http
+@profiling.profiled('mapquestIncidents')
+@timing.timed('mapquestIncidents', _logger)
 def entry(request):
   '''
   Args:
@@ -229,21 +358,28 @@ def entry(request):
   key=message.get('key', None)
   if key is None: raise Exception('Must provide a mapquest key.')
   givenBounds=message.get('bounds', [39.95,-105.25,39.52,-104.71])
-  # Convert the list of bounds into a list of 2 tuples of (lat,long).
-  bounds=((givenBounds[0],givenBounds[1]),(givenBounds[2],givenBounds[3]))
+  # Convert the bounds, which may be one or a list of bounding boxes, into a list of 2 tuples of (lat,long).
+  bounds=_toRegions(givenBounds)
+  maxTileSize=float(message.get('maxTileSize', _maxTileSize))
   filters=message.get('filters',['construction','incidents'])
   addTimestamp=message.get('addTimestamp', None)
   topic=message.get('topic', None)
   store=message.get('storage',False)
   publish=message.get('pubsub',False)
+  statePath=None
+  # The field may come as text, such as "false", from a Pub/Sub payload or query parameters.
+  if str(message.get('changesOnly', False)).strip().lower() not in ['false', '0', 'no', '', 'none']:
+    # Keep the state outside of any timestamped folder so that each run can see what the previous run output.
+    statePath=message.get('statePath', 'gs://{bucket}/{path}/_state/incidents.json'.format(bucket=bucket, path=path))
   if addTimestamp=='true':
     # Append a timestamp to the path so that we don't overwrite an existing set of files.
     path+='/timestamp='+datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
   _logger.info('Will query for '+','.join(filters))
-  if storage: _logger.info('Writing to '+path+' in bucket '+bucket)
+  if statePath is not None: _logger.info('Only outputting changed incidents, tracked in '+statePath)
+  if store: _logger.info('Writing to '+path+' in bucket '+bucket)
   if publish: _logger.info('Publishing to topic '+topic)
   num=parseAll(key,bounds,filters,bucket=bucket, path=path, projectId=projectId, topic=topic,
-                     store=store, publish=publish)
+                     store=store, publish=publish, maxTileSize=maxTileSize, statePath=statePath)
   return 'Completed parsing. Wrote '+str(num)+' to '+(' storage' if store else '')+(' pub/sub' if publish else '')
 
 if __name__=='__main__':
@@ -260,19 +396,25 @@ if __name__=='__main__':
   parser.add_argument('-path', default='traffic')
   parser.add_argument('-projectId', default=None)
   parser.add_argument('-key')
-  parser.add_argument('-bounds',nargs=4,default=[39.95,-105.25,39.52,-104.71],type=float)
+  parser.add_argument('-bounds',nargs='+',default=[39.95,-105.25,39.52,-104.71],type=float,
+                      help='One or more bounding boxes, each given as 4 numbers: lat long lat long.')
+  parser.add_argument('-maxTileSize',default=_maxTileSize,type=float,
+                      help='Split bounding boxes into tiles that span at most this many degrees.')
   parser.add_argument('-filters',nargs='+',default=['construction','incidents'])
   parser.add_argument('-topic',default=None)
   parser.add_argument('-storage',action='store_true')
   parser.add_argument('-pubsub',action='store_true')
   parser.add_argument('-addTimestamp',action='store_true')
+  parser.add_argument('-statePath',default=None,
+                      help='Only output incidents that changed since the last run, tracking them in this local file or gs:// path.')
   args=parser.parse_args()
   projectId=os.environ.get('GOOGLE_CLOUD_PROJECT', 'no_project') if args.projectId is None else args.projectId
   bucket=projectId+'_data' if args.bucket is None else args.bucket
   key=args.key
   filters=args.filters
   givenBounds=args.bounds
-  bounds=((givenBounds[0], givenBounds[1]), (givenBounds[2], givenBounds[3]))
+  if len(givenBounds)%4!=0: parser.error('-bounds takes 4 numbers per bounding box.')
+  bounds=_toRegions([givenBounds[index:index+4] for index in range(0, len(givenBounds), 4)])
   path=args.path
   topic=args.topic
   store=False if bucket is None else args.storage
@@ -281,4 +423,4 @@ if __name__=='__main__':
     # Append a timestamp to the path so that we don't overwrite an existing set of files.
     path+='/timestamp='+datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
   num=parseAll(key, bounds, filters, bucket=bucket, path=path, projectId=projectId, topic=topic,
-               store=store, publish=publish)
+               store=store, publish=publish, maxTileSize=args.maxTileSize, statePath=args.statePath)
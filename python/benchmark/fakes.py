@@ -0,0 +1,116 @@
+# In-memory stand-ins for the Google Cloud Storage and Pub/Sub clients so that the ingest modules can be run and timed
+# without credentials or network. They implement only the calls that the modules make. installed() swaps them in for
+# every way the modules get hold of a client: storage.Client() and pubsub_v1.PublisherClient(), which the modules look up
+# on the real modules through common.lazy, the process-wide clients of common.sinks, and the cached buckets of the
+# yahooFinance and vaccination modules.
+import sys
+import threading
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from unittest import mock
+
+from google.cloud import storage
+from google.cloud import pubsub_v1
+
+# Modules that cache a client or a bucket in a module-level _publisherClient or _storageClient.
+_clientModules=['common.sinks', 'api.stocks.yahooFinance', 'api.streamVaccinations']
+
+class FakeBlob(object):
+  def __init__(self, bucket, name):
+    self._bucket=bucket
+    self.name=name
+
+  def exists(self):
+    return self.name in self._bucket.objects
+
+  def upload_from_string(self, data, content_type=None):
+    if type(data)==str: data=data.encode('utf-8')
+    with self._bucket.lock:
+      self._bucket.objects[self.name]=data
+      self._bucket.numUploads+=1
+      self._bucket.numBytes+=len(data)
+
+  def download_as_bytes(self):
+    return self._bucket.objects[self.name]
+
+class FakeBucket(object):
+  def __init__(self, name):
+    self.name=name
+    self.objects={}
+    self.numUploads=0
+    self.numBytes=0
+    self.lock=threading.Lock()
+
+  def exists(self):
+    return True
+
+  def blob(self, name):
+    return FakeBlob(self, name)
+
+class FakeStorageClient(object):
+  '''
+  Every client shares the same buckets, as clients of the real service do.
+  '''
+  buckets={}
+  _lock=threading.Lock()
+
+  def __init__(self, project=None, credentials=None, **kwargs):
+    self.project=project
+
+  def bucket(self, name):
+    with self._lock:
+      if name not in self.buckets: self.buckets[name]=FakeBucket(name)
+      return self.buckets[name]
+
+class FakePublisherClient(object):
+  '''
+  Acknowledges every message right away. Like the real client, it rejects data that is not bytes and attributes that
+  are not strings. Only counts are kept unless keepMessages is set, so that memory use reflects the code under test.
+  '''
+  keepMessages=False
+
+  def __init__(self, *args, **kwargs):
+    self.numMessages=0
+    self.numBytes=0
+    self.messages=[]
+    self._lock=threading.Lock()
+
+  def publish(self, topic, data, **attributes):
+    if type(data)!=bytes: raise TypeError('Data being published to Pub/Sub must be sent as a bytestring.')
+    if any(type(value)!=str for value in attributes.values()): raise TypeError('All attributes being published to '
+                                                                               'Pub/Sub must be sent as text strings.')
+    with self._lock:
+      self.numMessages+=1
+      self.numBytes+=len(data)
+      if self.keepMessages: self.messages.append((topic, data, attributes))
+      messageId=str(self.numMessages)
+    future=Future()
+    future.set_result(messageId)
+    return future
+
+def reset():
+  '''
+  Forget all stored objects.
+  '''
+  FakeStorageClient.buckets.clear()
+
+@contextmanager
+def installed(keepMessages=False):
+  '''
+  Use as a context manager while running the code under test:
+    with installed() as publisher:
+      ...
+  Yields: yields the FakePublisherClient that stands in for the process-wide PublisherClient of common.sinks.
+  '''
+  publisher=FakePublisherClient()
+  publisher.keepMessages=keepMessages
+  with ExitStack() as stack:
+    stack.enter_context(mock.patch.object(storage, 'Client', FakeStorageClient))
+    stack.enter_context(mock.patch.object(pubsub_v1, 'PublisherClient', FakePublisherClient))
+    for moduleName in _clientModules:
+      module=sys.modules.get(moduleName, None)
+      if module is None: continue
+      if hasattr(module, '_storageClient'): stack.enter_context(mock.patch.object(module, '_storageClient', None))
+      if hasattr(module, '_publisherClient'):
+        stack.enter_context(mock.patch.object(module, '_publisherClient', publisher))
+    yield publisher
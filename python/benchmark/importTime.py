@@ -0,0 +1,75 @@
+# Benchmark of the time it takes to import the entry point of each Cloud Function, which is paid on every cold start.
+# Each entry point is imported in a fresh interpreter with -X importtime, and the report gives the total import time
+# and the top-level packages that account for most of it.
+# Run from the python folder:
+#   python -m benchmark.importTime -repeat 5
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import Counter
+
+entryPoints=['main_flight-streaming', 'main_yahooFinance', 'api.streamVaccinations', 'api.traffic.mapquestIncidents',
+             'api.genericRest', 'twitter.twitterParser']
+_pythonFolder=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# A line of -X importtime output: "import time:       self |  cumulative | <indent>package".
+_importLine=re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)\s*$')
+
+def parseImportTime(output):
+  '''
+  Args:
+    output: the stderr of python -X importtime.
+  Returns: returns (total microseconds of the imports, Counter of microseconds spent in each top-level package, including
+           the packages it imports, Counter of microseconds spent importing each top-level package's own modules).
+  '''
+  total=0
+  cumulative=Counter()
+  own=Counter()
+  for line in output.splitlines():
+    match=_importLine.match(line)
+    if match is None: continue
+    selfTime, cumulativeTime, indent, package=int(match.group(1)), int(match.group(2)), match.group(3), match.group(4)
+    topLevel=package.split('.')[0]
+    own[topLevel]+=selfTime
+    if len(indent)==1:  # Imported by the entry point itself rather than by another module.
+      total+=cumulativeTime
+      cumulative[topLevel]+=cumulativeTime
+  return total, cumulative, own
+
+def measure(entryPoint, repeat=3):
+  '''
+  Import entryPoint in repeat fresh interpreters.
+  Returns: returns a dict with the entry point, the median total milliseconds, and the top-level packages that took
+           the most milliseconds in the median run, or an error if the entry point cannot be imported.
+  '''
+  runs=[]
+  for _ in range(repeat):
+    process=subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                            'import importlib; importlib.import_module("'+entryPoint+'")'],
+                           cwd=_pythonFolder, env=dict(os.environ, PYTHONPATH=_pythonFolder), capture_output=True,
+                           text=True)
+    if process.returncode!=0:
+      return {'entryPoint':entryPoint, 'error':process.stderr.strip().splitlines()[-1]}
+    runs.append(parseImportTime(process.stderr))
+  runs.sort(key=lambda run:run[0])
+  total, cumulative, own=runs[len(runs)//2]
+  return {'entryPoint':entryPoint, 'totalMs':total/1000, 'medianOfRuns':len(runs),
+          'packages':[(package, micros/1000) for package, micros in cumulative.most_common(8)],
+          'ownMs':[(package, micros/1000) for package, micros in own.most_common(8)]}
+
+def run(names=None, repeat=3):
+  return [measure(entryPoint, repeat=repeat) for entryPoint in (names if names is not None else entryPoints)]
+
+if __name__=='__main__':
+  parser=argparse.ArgumentParser(description='Measure how long each Cloud Function entry point takes to import.')
+  parser.add_argument('-entryPoints', nargs='+', default=None, help='Modules to import; all entry points by default.')
+  parser.add_argument('-repeat', default=3, type=int, help='Number of fresh interpreters per entry point; the median '
+                                                           'is reported.')
+  args=parser.parse_args()
+  for result in run(names=args.entryPoints, repeat=args.repeat):
+    if 'error' in result:
+      print('{entryPoint:<32} cannot be imported: {error}'.format(**result))
+      continue
+    print('{entryPoint:<32} {totalMs:>8.1f} ms'.format(**result))
+    print('    '+', '.join('{package} {ms:.1f}'.format(package=package, ms=ms) for package, ms in result['ownMs']))
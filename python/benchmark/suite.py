@@ -0,0 +1,237 @@
+# End-to-end throughput benchmark of the ingest modules, run against the in-memory GCS and Pub/Sub clients of
+# benchmark.fakes and synthetic upstream data, so that it needs neither credentials nor network. Each case runs one
+# entry point at several data sizes and reports:
+#   rowsPerSecond: rows output per second, from the best of the repeated runs.
+#   peakRSSMB: peak resident memory of the process that ran the case, in MB. Each case and size runs in a fresh process
+#              unless -inProcess is given, in which case the peak only ever grows from one case to the next.
+#   allocatedBytesPerRow: peak memory traced by tracemalloc during one more run, divided by the number of rows.
+# The cases:
+#   openSky: flight.stream.openSkyParser._scavengeRows, with OpenSkyApi returning size flight states.
+#   yahooFinance: api.stocks.yahooFinance.parseAll, with yfinance returning 250 daily prices per symbol.
+#   vaccinations: api.streamVaccinations.parseAll on a file of size rows in the fake bucket.
+#   mapquest: api.traffic.mapquestIncidents.parseAll, with MapQuest returning size incidents.
+#   genericRest: api.genericRest.DataProcessor.process on one response holding size records.
+#   twitter: twitter.twitterParser.MyListener.parseData on size tweets from the tweet corpus.
+# Every case outputs to both storage and Pub/Sub. Logging below WARNING is turned off so that the terminal is not timed.
+# Run from the python folder, and keep the output as a baseline to compare later runs against:
+#   python -m benchmark.suite -sizes 100 1000 10000 -output ../resources/benchmark/baseline.json
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import sys
+import time
+import tracemalloc
+import types
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from unittest import mock
+
+import requests
+
+from api import streamVaccinations
+from api.genericRest import DataProcessor
+from api.stocks import yahooFinance
+from api.traffic import mapquestIncidents
+from benchmark import fakes
+from benchmark.tweetFlattening import defaultCorpus, loadCorpus
+from flight.stream import openSkyParser
+from flight.stream.opensky_api import OpenSkyApi
+from twitter.twitterParser import MyListener
+
+try:
+  import resource
+except ImportError:
+  resource=None  # Not available on Windows.
+
+_bucket='benchmark'
+_projectId='benchmark'
+defaultSizes=[100, 1000, 10000]
+
+@contextmanager
+def _openSky(size):
+  now=int(time.time())
+  states=[[format(index, '06x'), 'FLT{num:04d}  '.format(num=index%10000), 'United States', now-5, now-1,
+           -105.0+(index%1000)/1000.0, 39.0+(index%500)/500.0, 10000.0+index%100, index%10==0, 230.5, 90.0, -1.5, None,
+           10050.0, '1200', False, 0] for index in range(size)]
+
+  def getJSON(api, url, callee, params=None):
+    return {'time':now, 'states':states}  # OpenSkyStates replaces the states of the dict, so build a new one each time.
+  with mock.patch.object(OpenSkyApi, '_get_json', getJSON):
+    # _scavengeRows counts each record once when stored and once when published.
+    yield lambda:openSkyParser._scavengeRows(bucket=_bucket, path='flights', projectId=_projectId, topic='flights')//2
+
+class _Prices(object):
+  '''
+  Stands in for the DataFrame that yf.download returns.
+  '''
+
+  def __init__(self, csv):
+    self._csv=csv
+
+  def to_csv(self):
+    return self._csv
+
+@contextmanager
+def _yahooFinance(size):
+  rowsPerSymbol=min(size, 250)  # About a year of daily prices.
+  numSymbols=max(1, size//rowsPerSymbol)
+  start=datetime.date(2021, 1, 1)
+  prices=_Prices('Date,Open,High,Low,Close,Adj Close,Volume\n'+''.join(
+    '{date},{open:.2f},{high:.2f},{low:.2f},{close:.2f},{close:.2f},{volume:d}\n'.format(
+      date=(start+datetime.timedelta(days=index)).isoformat(), open=100+index%7, high=102+index%7, low=99+index%7,
+      close=101+index%7, volume=1000000+index) for index in range(rowsPerSymbol)))
+  symbols=['S{num:04d}'.format(num=index) for index in range(numSymbols)]
+  fakes.FakeStorageClient().bucket(_bucket).blob(yahooFinance._allStocksFile).upload_from_string('\n'.join(symbols))
+  # yfinance itself is replaced, so that the case runs where it is not installed.
+  yf=types.ModuleType('yfinance')
+  yf.download=lambda tickers, period, interval:prices
+  with mock.patch.object(yahooFinance, 'yf', yf):
+    yield lambda:yahooFinance.parseAll(yahooFinance._allStocksFile, '1y', '1d', bucket=_bucket, path='stocks',
+                                       projectId=_projectId, topic='stocks')*rowsPerSymbol
+
+@contextmanager
+def _vaccinations(size):
+  rows=['\t'.join(['2021-08-{day:02d}'.format(day=1+index%31), 'State {num:d}'.format(num=index%50),
+                   str(1000000+index), str(1200000+index), str(600000+index), '45.2', '98.1', str(500000+index),
+                   '52.3', '110.4', str(10000+index), str(9800+index), '2300', '0.83', '', ''])
+        for index in range(size)]
+  fakes.FakeStorageClient().bucket(_bucket).blob('vaccinations.tsv').upload_from_string('\n'.join(rows))
+  yield lambda:streamVaccinations.parseAll('vaccinations.tsv', bucket=_bucket, path='vaccinations',
+                                           projectId=_projectId, topic='vaccinations')
+
+class _MapQuest(object):
+  '''
+  Stands in for the HttpClient of mapquestIncidents, answering every tile with the same incidents.
+  '''
+
+  def __init__(self, incidents):
+    self._content=json.dumps({'incidents':incidents, 'info':{'statuscode':0}}).encode('utf-8')
+
+  def get(self, url, params=None, **kwargs):
+    response=requests.models.Response()
+    response.status_code=200
+    response.url=url
+    response._content=self._content
+    return response
+
+@contextmanager
+def _mapquest(size):
+  incidents=[{'id':str(4000000000+index), 'type':index%4+1, 'severity':index%5, 'eventCode':0,
+              'lat':39.5+(index%400)/1000.0, 'lng':-105.2+(index%500)/1000.0,
+              'startTime':'2021-08-01T07:00:00', 'endTime':'2021-08-31T18:00:00', 'impacting':index%2==0,
+              'shortDesc':'Lane closed on road {num:d}'.format(num=index%300),
+              'fullDesc':'Lane closed due to construction on road {num:d} between exits.'.format(num=index%300),
+              'delayFromFreeFlow':0.0, 'delayFromTypical':0.0, 'distance':1.25,
+              'iconURL':'http://content.mqcdn.com/mqtraffic/const_mod.png'} for index in range(size)]
+  with mock.patch.object(mapquestIncidents, '_httpClient', _MapQuest(incidents)):
+    # parseAll counts each incident once when written and once when published.
+    yield lambda:mapquestIncidents.parseAll('key', [39.95, -105.25, 39.52, -104.71], ['construction', 'incidents'],
+                                            bucket=_bucket, path='traffic', projectId=_projectId, topic='traffic')//2
+
+@contextmanager
+def _genericRest(size):
+  response=json.dumps({'count':size, 'items':[
+    {'id':index, 'name':'item {num:d}'.format(num=index), 'price':index*1.25, 'tags':['a', 'b'],
+     'location':{'lat':39.7, 'lng':-105.0}} for index in range(size)]})
+
+  def run():
+    DataProcessor._seenIDs.clear()  # Otherwise every run after the first only finds duplicates.
+    processor=DataProcessor(projectId=_projectId, topic='records', bucket=_bucket, path='records',
+                            recordsPath='$.items[*]')
+    processor.process(response, source='https://api.example.com/items')
+    return processor.close()[0]
+  yield run
+
+@contextmanager
+def _twitter(size):
+  tweets=list(itertools.islice(itertools.cycle(loadCorpus(defaultCorpus)), size))
+
+  def run():
+    listener=MyListener('token', _projectId, 'benchmark', size, topic='tweets', userTopic='users', bucket=_bucket,
+                        userBucket=_bucket, pathInBucket='tweets')
+    numRows=0
+    for tweet in tweets:
+      numRows+=listener.parseData(tweet)[0]
+    listener.close()
+    return numRows
+  yield run
+
+cases={'openSky':_openSky, 'yahooFinance':_yahooFinance, 'vaccinations':_vaccinations, 'mapquest':_mapquest,
+       'genericRest':_genericRest, 'twitter':_twitter}
+
+def _peakRSS():
+  '''
+  Returns: returns the peak resident memory of this process in MB, or None where it cannot be measured.
+  '''
+  if resource is None: return None
+  peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak/1024/1024 if sys.platform=='darwin' else peak/1024  # Bytes on macOS, KB elsewhere.
+
+def measure(case, size, repeat=3):
+  '''
+  Run one case in this process.
+  Returns: returns a dict with the case, size, rows, best seconds, rows per second, peak RSS in MB, and bytes traced by
+           tracemalloc per row.
+  '''
+  logging.disable(logging.INFO)
+  fakes.reset()
+  try:
+    with fakes.installed(), cases[case](size) as run:
+      best=None
+      numRows=0
+      for _ in range(repeat):
+        start=time.perf_counter()
+        numRows=run()
+        elapsed=time.perf_counter()-start
+        best=elapsed if best is None else min(best, elapsed)
+      tracemalloc.start()
+      try:
+        run()
+        _, tracedPeak=tracemalloc.get_traced_memory()
+      finally:
+        tracemalloc.stop()
+  finally:
+    fakes.reset()
+    logging.disable(logging.NOTSET)
+  return {'case':case, 'size':size, 'rows':numRows, 'seconds':best,
+          'rowsPerSecond':numRows/best if best>0 else None, 'peakRSSMB':_peakRSS(),
+          'allocatedBytesPerRow':tracedPeak/numRows if numRows>0 else None}
+
+def run(names=None, sizes=defaultSizes, repeat=3, isolate=True):
+  '''
+  Args:
+    names: the cases to run, or None for all of them.
+    sizes: the data sizes to run each case at.
+    repeat: number of timed runs of each case and size; the best time is reported.
+    isolate: run each case and size in a fresh process, so that the peak RSS belongs to that case alone.
+  Returns: returns a list with the result of each case and size (see measure).
+  '''
+  results=[]
+  for case in (names if names is not None else list(cases)):
+    if case not in cases: raise ValueError('Unknown case '+str(case)+'. Choose from '+', '.join(cases))
+    for size in sizes:
+      if isolate:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+          results.append(executor.submit(measure, case, size, repeat).result())
+      else:
+        results.append(measure(case, size, repeat))
+  return results
+
+if __name__=='__main__':
+  parser=argparse.ArgumentParser(description='Measure the throughput of the ingest modules against in-memory clients.')
+  parser.add_argument('-cases', nargs='+', default=None, choices=list(cases), help='Cases to run; all by default.')
+  parser.add_argument('-sizes', nargs='+', default=defaultSizes, type=int, help='Rows of data to run each case with.')
+  parser.add_argument('-repeat', default=3, type=int, help='Number of times to run each case; the best time is reported.')
+  parser.add_argument('-inProcess', action='store_true', help='Run every case in this process instead of a fresh one.')
+  parser.add_argument('-output', default=None, help='Also write the results to this JSON file.')
+  args=parser.parse_args()
+  results=run(names=args.cases, sizes=args.sizes, repeat=args.repeat, isolate=not args.inProcess)
+  for result in results:
+    print(('{case:<13} {size:>7d} rows {rowsPerSecond:>10.0f} rows/s {peakRSSMB:>8.1f} MB peak RSS '
+           '{allocatedBytesPerRow:>8.0f} bytes/row').format(**result))
+  if args.output is not None:
+    with open(args.output, 'w') as outputFile:
+      json.dump(results, outputFile, indent=2)
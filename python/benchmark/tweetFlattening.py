@@ -0,0 +1,61 @@
+# Benchmark of MyListener.extractTweet on a synthetic corpus of tweets, one JSON tweet per line, shaped like those
+# received from the stream (some are wrapped in a "data" object and some are retweets). The corpus is generated, not
+# recorded, so the numbers compare versions of the code rather than measure production throughput.
+# Run from the python folder:
+#   python -m benchmark.tweetFlattening -repeat 50
+import argparse
+import json
+import os
+import time
+
+from twitter.twitterParser import MyListener
+
+defaultCorpus=os.path.join(os.path.dirname(__file__), '..', '..', 'resources', 'benchmark', 'tweets.jsonl')
+
+def loadCorpus(path=defaultCorpus):
+  '''
+  Returns: returns the tweets in the corpus as a list of JSON bytes.
+  '''
+  with open(path, 'rb') as corpusFile:
+    return [line.rstrip(b'\n') for line in corpusFile if line.strip()]
+
+def _measure(function, tweets, repeat):
+  '''
+  Returns: returns (the best time in seconds to run function over all tweets, number of rows produced).
+  '''
+  best=None
+  numRows=0
+  for _ in range(repeat):
+    start=time.perf_counter()
+    numRows=function(tweets)
+    elapsed=time.perf_counter()-start
+    best=elapsed if best is None else min(best, elapsed)
+  return best, numRows
+
+def run(corpus=defaultCorpus, repeat=20, query='benchmark'):
+  '''
+  Flatten the corpus one tweet at a time and as a batch, from bytes and from parsed dicts, with and without a delimiter.
+  Returns: returns a list of dicts, one per case, with the tweets and rows flattened per second.
+  '''
+  tweets=loadCorpus(corpus)
+  parsed=[json.loads(tweet) for tweet in tweets]
+  cases=[('single/bytes', tweets, lambda batch:sum(len(MyListener.extractTweet(tweet, query)) for tweet in batch)),
+         ('single/dict', parsed, lambda batch:sum(len(MyListener.extractTweet(tweet, query)) for tweet in batch)),
+         ('batch/dict', parsed, lambda batch:len(MyListener.extractTweets(batch, query))),
+         ('batch/dict/delim', parsed, lambda batch:len(MyListener.extractTweets(batch, query, delim='|')))]
+  results=[]
+  for name, batch, function in cases:
+    seconds, numRows=_measure(function, batch, repeat)
+    results.append({'case':name, 'tweets':len(batch), 'rows':numRows, 'seconds':seconds,
+                    'tweetsPerSecond':len(batch)/seconds, 'rowsPerSecond':numRows/seconds})
+  return results
+
+if __name__=='__main__':
+  parser=argparse.ArgumentParser()
+  parser.add_argument('-corpus', help='JSONL file of tweets.', default=defaultCorpus)
+  parser.add_argument('-repeat', help='Number of times to run each case; the best time is reported.', default=20,
+                      type=int)
+  args=parser.parse_args()
+  for result in run(corpus=args.corpus, repeat=args.repeat):
+    print('{case:<18} {tweets:>6d} tweets {rows:>6d} rows {tweetsPerSecond:>10.0f} tweets/s {rowsPerSecond:>10.0f} rows/s'
+          .format(**result))
@@ -0,0 +1,58 @@
+# In-memory caches shared by the ingest modules. Module-level caches live as long as the process, so in a Cloud Function
+# they are kept between invocations served by the same instance.
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+  '''
+  A thread-safe dict holding at most maxSize entries. Once full, adding an entry evicts the least recently used one.
+  '''
+
+  def __init__(self, maxSize=10000):
+    self._maxSize=maxSize
+    self._entries=OrderedDict()
+    self._lock=threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      if key not in self._entries: return default
+      self._entries.move_to_end(key)
+      return self._entries[key]
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries[key]=value
+      self._entries.move_to_end(key)
+      while len(self._entries)>self._maxSize:
+        self._entries.popitem(last=False)
+
+  def add(self, key):
+    '''
+    Use the cache as a set of recently seen keys.
+    Args:
+      key:
+    Returns: returns True if the key was not in the cache, False if it has been seen before.
+    '''
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        return False
+      self._entries[key]=True
+      while len(self._entries)>self._maxSize:
+        self._entries.popitem(last=False)
+      return True
+
+  def pop(self, key, default=None):
+    with self._lock:
+      return self._entries.pop(key, default)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._entries
+
+  def __len__(self):
+    return len(self._entries)
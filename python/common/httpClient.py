@@ -0,0 +1,409 @@
+# Shared HTTP layer for the modules that call REST APIs.
+# All requests go through one requests.Session per process, so connections to each host are pooled and kept alive
+# between calls (and between invocations of a warm Cloud Function). Every request has a bounded timeout and asks for a
+# compressed response. An HttpClient can also make conditional requests: it remembers the ETag and Last-Modified
+# validators of each response and sends them back as If-None-Match and If-Modified-Since, so that an API which has
+# nothing new to report can answer with a small 304 Not Modified response. A HostLimiter caps how many requests run
+# against each host at once and how fast they are started. With a ResponseCache, an HttpClient answers repeated
+# requests from the cache while the response is fresh according to its Cache-Control header (or a default TTL), and can
+# answer with a stale response while it fetches a fresh one in the background (stale-while-revalidate).
+import base64
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from hashlib import blake2b
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from common import logs, timing
+from common.cache import LRUCache
+
+_logger=logging.getLogger(__name__)
+
+defaultTimeout=(5, 30)  # Seconds to wait for a connection and seconds to wait between bytes of the response.
+poolSize=16  # Number of connections kept open to each host.
+
+_session=None
+_sessionLock=threading.Lock()
+
+def getSession():
+  '''
+  Returns: returns the process-wide session, creating it the first time it is needed.
+  '''
+  global _session
+  if _session is None:
+    with _sessionLock:
+      if _session is None:
+        session=requests.Session()
+        adapter=HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Accept-Encoding':'gzip, deflate'})
+        _session=session
+  return _session
+
+def isNotModified(response):
+  '''
+  Args:
+    response: a response returned by HttpClient.get.
+  Returns: returns True if the server reported that nothing changed since the previous request.
+  '''
+  return response.status_code==304
+
+def parseCacheControl(value):
+  '''
+  Args:
+    value: the value of a Cache-Control header, such as 'max-age=60, stale-while-revalidate=30', or None.
+  Returns: returns a dict mapping each directive in lower case to its argument, or to True if it has no argument.
+  '''
+  directives={}
+  for part in (value or '').split(','):
+    name,_,argument=part.strip().partition('=')
+    if name!='': directives[name.lower()]=argument.strip('"') if argument!='' else True
+  return directives
+
+def _seconds(value, default):
+  try:
+    return max(0, int(value))
+  except:
+    return default
+
+def cacheEntry(response, ttl=0, staleWhileRevalidate=0, now=None):
+  '''
+  Args:
+    response: a requests.Response.
+    ttl: seconds a response stays fresh if its Cache-Control header does not say.
+    staleWhileRevalidate: seconds a stale response may still be used while a fresh one is fetched, if its Cache-Control
+                          header does not say.
+    now: the time the response was received, in seconds since the epoch.
+  Returns: returns the response as a cache entry (a dict), or None if the response must not be cached.
+  '''
+  if response.status_code!=200 or response.headers.get('Vary', '').strip()=='*': return None
+  directives=parseCacheControl(response.headers.get('Cache-Control', None))
+  if 'no-store' in directives: return None
+  now=now if now is not None else time.time()
+  if 'no-cache' in directives:
+    maxAge=0  # The response may be stored but must be revalidated before it is used.
+  else:
+    maxAge=_seconds(directives.get('s-maxage', directives.get('max-age', None)), ttl)
+  expires=now+max(0, maxAge-_seconds(response.headers.get('Age', None), 0))
+  return {'url':response.url,
+          'headers':dict(response.headers),
+          'content':response.content,
+          'encoding':response.encoding,
+          'expires':expires,
+          'staleUntil':expires+_seconds(directives.get('stale-while-revalidate', None), staleWhileRevalidate)}
+
+def fromCacheEntry(entry, statusCode=200):
+  '''
+  Returns: returns a requests.Response holding the cached response.
+  '''
+  response=requests.Response()
+  response.status_code=statusCode
+  response.url=entry['url']
+  response.headers=CaseInsensitiveDict(entry['headers'])
+  response.encoding=entry['encoding']
+  response._content=entry['content']
+  response.fromCache=True
+  return response
+
+class ResponseCache(object):
+  '''
+  Keeps responses in memory, evicting the least recently used ones, and optionally in a second tier that survives
+  restarts and is shared between instances: a local directory or, when the location starts with gs://, a path in GCS.
+  Responses are keyed by URL, sorted query parameters, and every request header, so that requests made with different
+  API keys or other credentials never share a response.
+  '''
+  
+  def __init__(self, maxEntries=1000, location=None, ignoreHeaders=()):
+    '''
+    Args:
+      maxEntries: the most responses to keep in memory.
+      location: a directory or gs://bucket/path to also keep the responses in, or None to only keep them in memory.
+      ignoreHeaders: names of request headers to leave out of the key, such as a request ID that changes every time.
+                     Only leave out headers that cannot change the response.
+    '''
+    self._memory=LRUCache(maxSize=maxEntries)
+    self._location=location.rstrip('/') if location else None
+    self._bucket=None
+    if self._location is not None and self._location.startswith('gs://'):
+      from common.sinks import getStorageClient  # Only loaded when the cache is kept in GCS.
+      bucket,_,self._prefix=self._location[len('gs://'):].partition('/')
+      self._bucket=getStorageClient().bucket(bucket)
+    elif self._location is not None:
+      os.makedirs(self._location, exist_ok=True)
+    self._ignoreHeaders=set(name.lower() for name in ignoreHeaders)
+    self._counts={'hits':0, 'staleHits':0, 'misses':0, 'revalidated':0, 'stored':0}
+    self._lock=threading.Lock()
+  
+  def key(self, url, params=None, headers=None):
+    headers={str(name).lower():str(value) for name, value in (headers or {}).items()}
+    parts=[url,
+           sorted([str(name), str(value)] for name, value in (params or {}).items()),
+           sorted([name, value] for name, value in headers.items() if name not in self._ignoreHeaders)]
+    return blake2b(json.dumps(parts).encode(), digest_size=16).hexdigest()
+  
+  def count(self, name):
+    with self._lock:
+      self._counts[name]+=1
+  
+  def stats(self):
+    '''
+    Returns: returns a dict with the counts of hits, stale hits, misses, revalidated and stored responses, and the rate of
+             lookups answered from the cache.
+    '''
+    with self._lock:
+      stats=dict(self._counts)
+    lookups=stats['hits']+stats['staleHits']+stats['misses']
+    stats['hitRate']=(stats['hits']+stats['staleHits'])/lookups if lookups>0 else 0.0
+    return stats
+  
+  def _path(self, key):
+    return (self._prefix if self._bucket is not None else self._location)+'/'+key+'.json.gz'
+  
+  def _read(self, key):
+    try:
+      if self._bucket is not None:
+        blob=self._bucket.blob(self._path(key))
+        if not blob.exists(): return None
+        contents=blob.download_as_bytes()
+      else:
+        if not os.path.exists(self._path(key)): return None
+        with open(self._path(key), 'rb') as cacheFile:
+          contents=cacheFile.read()
+      entry=json.loads(gzip.decompress(contents))
+      entry['content']=base64.b64decode(entry['content'])
+      return entry
+    except:
+      _logger.error('Cannot read cached response from '+self._path(key), exc_info=True, stack_info=True)
+      return None
+  
+  def _write(self, key, entry):
+    stored=dict(entry)
+    stored['content']=base64.b64encode(entry['content']).decode('ascii')
+    contents=gzip.compress(json.dumps(stored).encode('utf-8'))
+    try:
+      if self._bucket is not None:
+        self._bucket.blob(self._path(key)).upload_from_string(contents, content_type='application/gzip')
+      else:
+        with open(self._path(key), 'wb') as cacheFile:
+          cacheFile.write(contents)
+    except:
+      _logger.error('Cannot write cached response to '+self._path(key), exc_info=True, stack_info=True)
+  
+  def get(self, key):
+    '''
+    Returns: returns the cache entry for the key, fresh or not, or None if there is none.
+    '''
+    entry=self._memory.get(key)
+    if entry is None and self._location is not None:
+      entry=self._read(key)
+      if entry is not None: self._memory.put(key, entry)
+    return entry
+  
+  def put(self, key, entry):
+    self._memory.put(key, entry)
+    self.count('stored')
+    if self._location is not None: self._write(key, entry)
+
+class HostLimiter(object):
+  '''
+  Limits how many requests run against each host at the same time and, optionally, how many requests per second are
+  started against each host. Use as:
+    with limiter.limit(url):
+      ...make the request...
+  '''
+  
+  def __init__(self, maxConcurrent=4, requestsPerSecond=None):
+    '''
+    Args:
+      maxConcurrent: the most requests to run against one host at the same time.
+      requestsPerSecond: the most requests to start against one host per second, or None for no rate limit.
+    '''
+    self._maxConcurrent=maxConcurrent
+    self._interval=1.0/requestsPerSecond if requestsPerSecond else 0
+    self._semaphores={}
+    self._nextStart={}  # Maps each host to the earliest time the next request may start.
+    self._lock=threading.Lock()
+  
+  def _reserve(self, host):
+    '''
+    Returns: returns the number of seconds to wait before starting a request to the host.
+    '''
+    with self._lock:
+      now=time.monotonic()
+      start=max(now, self._nextStart.get(host, now))
+      self._nextStart[host]=start+self._interval
+      return start-now
+  
+  @contextmanager
+  def limit(self, url):
+    host=urlsplit(url).netloc
+    with self._lock:
+      if host not in self._semaphores: self._semaphores[host]=threading.BoundedSemaphore(self._maxConcurrent)
+      semaphore=self._semaphores[host]
+    with semaphore:
+      if self._interval>0:
+        wait=self._reserve(host)
+        if wait>0: time.sleep(wait)
+      yield
+
+class HttpClient(object):
+  '''
+  Issues GET requests on the shared session. With conditional requests turned on, a 304 response is given the body of
+  the last full response for the same URL and parameters, so callers can always read the data and can use
+  isNotModified to skip the work of publishing and storing data they have already handled. With a ResponseCache, fresh
+  responses are returned from the cache without a request, and stale responses are revalidated with their validators.
+  Requests with a 'Cache-Control: no-cache' header always go to the server.
+  '''
+  
+  @staticmethod
+  def _key(url, params):
+    return (url, tuple(sorted((str(name), str(value)) for name, value in (params or {}).items())))
+  
+  def __init__(self, timeout=defaultTimeout, conditional=False, session=None, limiter=None, cache=None, cacheTTL=0,
+               staleWhileRevalidate=0):
+    '''
+    Args:
+      timeout: a number of seconds or a tuple of (connect, read) seconds.
+      conditional: remember validators and send conditional requests if True.
+      session: a session to use instead of the shared session.
+      limiter: a HostLimiter that every request waits on, or None to not limit requests.
+      cache: a ResponseCache, or None to not cache responses.
+      cacheTTL: seconds a cached response stays fresh if its Cache-Control header does not say.
+      staleWhileRevalidate: seconds a stale response may still be returned while a fresh one is fetched in the background,
+                            if its Cache-Control header does not say.
+    '''
+    self._cache=cache
+    self._cacheTTL=cacheTTL
+    self._staleWhileRevalidate=staleWhileRevalidate
+    self._revalidations={}  # Maps the key of each response being revalidated in the background to its future.
+    self._executor=None
+    self._timeout=timeout
+    self._limiter=limiter
+    self._conditional=conditional
+    self._session=session
+    self._validators={}  # Maps (url, params) to (etag, last modified, content of the last 200 response).
+    self._lock=threading.Lock()
+  
+  def _send(self, url, params, headers, timeout):
+    session=self._session if self._session is not None else getSession()
+    if self._limiter is not None:
+      with self._limiter.limit(url), timing.span('fetch'):
+        return session.get(url, params=params, headers=headers, timeout=timeout if timeout is not None else self._timeout)
+    with timing.span('fetch'):
+      return session.get(url, params=params, headers=headers, timeout=timeout if timeout is not None else self._timeout)
+  
+  def get(self, url, params=None, headers=None, timeout=None):
+    '''
+    Args:
+      url:
+      params: a dict of query parameters.
+      headers: a dict of headers to add to the session's headers.
+      timeout: overrides the client's timeout for this request.
+    Returns: returns the requests.Response.
+    '''
+    requestHeaders=dict(headers) if headers is not None else {}
+    if self._cache is not None:
+      requestDirectives=parseCacheControl(CaseInsensitiveDict(requestHeaders).get('Cache-Control', None))
+      if 'no-cache' not in requestDirectives and 'no-store' not in requestDirectives:
+        return self._getCached(url, params, requestHeaders, timeout)
+    
+    key=None
+    validators=None
+    if self._conditional:
+      key=self._key(url, params)
+      with self._lock:
+        validators=self._validators.get(key, None)
+      if validators is not None:
+        etag, lastModified, _=validators
+        if etag is not None: requestHeaders['If-None-Match']=etag
+        if lastModified is not None: requestHeaders['If-Modified-Since']=lastModified
+    
+    response=self._send(url, params, requestHeaders, timeout)
+    
+    if self._conditional:
+      if response.status_code==304 and validators is not None:
+        response._content=validators[2]  # Let the caller read the data it received last time.
+        logs.debug(_logger, 'Not modified: %s', url)
+      elif response.status_code==200:
+        etag=response.headers.get('ETag', None)
+        lastModified=response.headers.get('Last-Modified', None)
+        if etag is not None or lastModified is not None:
+          with self._lock:
+            self._validators[key]=(etag, lastModified, response.content)
+    return response
+  
+  def _getCached(self, url, params, headers, timeout):
+    key=self._cache.key(url, params, headers)
+    entry=self._cache.get(key)
+    now=time.time()
+    if entry is not None and now<entry['expires']:
+      self._cache.count('hits')
+      return fromCacheEntry(entry)
+    if entry is not None and now<entry['staleUntil']:
+      self._cache.count('staleHits')
+      self._revalidateLater(key, entry, url, params, headers, timeout)
+      return fromCacheEntry(entry)
+    self._cache.count('misses')
+    return self._fetch(key, entry, url, params, headers, timeout)
+  
+  def _fetch(self, key, entry, url, params, headers, timeout):
+    '''
+    Request the URL, revalidating the cache entry if there is one, and store the response in the cache.
+    '''
+    requestHeaders=dict(headers)
+    if entry is not None:
+      entryHeaders=CaseInsensitiveDict(entry['headers'])
+      if 'ETag' in entryHeaders: requestHeaders['If-None-Match']=entryHeaders['ETag']
+      if 'Last-Modified' in entryHeaders: requestHeaders['If-Modified-Since']=entryHeaders['Last-Modified']
+    response=self._send(url, params, requestHeaders, timeout)
+    if response.status_code==304 and entry is not None:
+      # The cached response is still valid: extend its freshness with the headers of the 304 response.
+      refreshed=requests.Response()
+      refreshed.status_code=200
+      refreshed.url=entry['url']
+      refreshed.headers=CaseInsensitiveDict(entry['headers'])
+      refreshed.headers.update(response.headers)
+      refreshed.encoding=entry['encoding']
+      refreshed._content=entry['content']
+      refreshedEntry=cacheEntry(refreshed, self._cacheTTL, self._staleWhileRevalidate)
+      if refreshedEntry is not None: self._cache.put(key, refreshedEntry)
+      self._cache.count('revalidated')
+      response._content=entry['content']  # Let the caller read the data it received last time.
+      logs.debug(_logger, 'Not modified: %s', url)
+    elif response.status_code==200:
+      newEntry=cacheEntry(response, self._cacheTTL, self._staleWhileRevalidate)
+      if newEntry is not None: self._cache.put(key, newEntry)
+    return response
+  
+  def _revalidateLater(self, key, entry, url, params, headers, timeout):
+    with self._lock:
+      if key in self._revalidations: return  # Already being revalidated.
+      if self._executor is None: self._executor=ThreadPoolExecutor(max_workers=2)
+      self._revalidations[key]=self._executor.submit(self._revalidate, key, entry, url, params, headers, timeout)
+  
+  def _revalidate(self, key, entry, url, params, headers, timeout):
+    try:
+      self._fetch(key, entry, url, params, headers, timeout)
+    except:
+      _logger.error('Cannot revalidate the cached response for '+url, exc_info=True, stack_info=True)
+    finally:
+      with self._lock:
+        self._revalidations.pop(key, None)
+  
+  def wait(self):
+    '''
+    Wait until the stale responses being revalidated in the background have been fetched and cached.
+    '''
+    with self._lock:
+      pending=list(self._revalidations.values())
+    wait(pending)
@@ -0,0 +1,61 @@
+# Defers importing heavy dependencies until they are first used, so that a Cloud Function instance does not pay on its
+# cold start for clients and libraries the invocation never touches. The Google Cloud client libraries (grpc, protobuf,
+# google.auth) and yfinance (pandas, numpy) take most of the import time of the entry points. To measure it:
+#   python -m benchmark.importTime
+# Use module() in place of an import statement and look attributes up on it when they are needed:
+#   storage=lazy.module('google.cloud.storage')
+#   ...
+#   client=storage.Client()  # google.cloud.storage is imported here, the first time.
+# Attributes are looked up on the real module on every access rather than copied, so patching the real module, as the
+# benchmark fakes and tests do, is seen through the lazy one.
+import importlib
+import sys
+import threading
+import types
+
+_lock=threading.Lock()
+
+class LazyModule(types.ModuleType):
+  '''
+  Stands in for a module until one of its attributes is used, then imports it.
+  '''
+
+  def __init__(self, name):
+    super().__init__(name)
+    self.__dict__['_module']=None
+
+  def _load(self):
+    module=self.__dict__['_module']
+    if module is None:
+      with _lock:
+        module=self.__dict__['_module']
+        if module is None:
+          module=importlib.import_module(self.__name__)
+          self.__dict__['_module']=module
+    return module
+
+  def __getattr__(self, attribute):
+    # Only called for attributes that are not set on the LazyModule itself.
+    return getattr(self._load(), attribute)
+
+  def __dir__(self):
+    return dir(self._load())
+
+  def __repr__(self):
+    return '<lazy module '+repr(self.__name__)+(' (imported)>' if self.__dict__['_module'] is not None else '>')
+
+def module(name):
+  '''
+  Args:
+    name: the full name of the module, such as "google.cloud.storage".
+  Returns: returns the module if it was already imported, otherwise a LazyModule that imports it on first use. An
+           ImportError for a missing module is raised then, not now.
+  '''
+  imported=sys.modules.get(name, None)
+  return imported if imported is not None else LazyModule(name)
+
+def isLoaded(module):
+  '''
+  Returns: returns True if the module, lazy or not, has been imported.
+  '''
+  return not isinstance(module, LazyModule) or module.__dict__['_module'] is not None
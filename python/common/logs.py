@@ -0,0 +1,171 @@
+# Logging for hot paths, where building a message that the level then filters out costs more than the work being logged,
+# and where one bad input can repeat the same error for every record. Instead of
+#   _logger.debug('Received data. '+str(data)[:100])
+# write
+#   logs.debug(_logger, 'Received data. %s', logs.truncated(data, 100))
+# Nothing is formatted unless the logger is enabled for the level: the arguments are only turned into text when a handler
+# writes the message, as with logging itself, and truncated(), structured() and lazy() defer the work that used to
+# happen before the call. The record keeps the file, line and function of the call site, as if _logger had been called.
+# Each call site can also be thinned out:
+#   every=100       logs the first message and then one in every 100.
+#   perSecond=1     logs a burst of messages (10 by default, see burst) and then at most one per second.
+# A message that follows suppressed ones says how many were suppressed, so that a per-record error in a loop shows up
+# once with a count instead of once per record:
+#   logs.error(_logger, 'Cannot parse row %d', rowNum, perSecond=1, exc_info=True)
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+
+defaultBurst=10
+
+class _Site(object):
+  '''
+  The sampling and rate limiting state of one call site.
+  '''
+  __slots__=('calls', 'tokens', 'updated', 'suppressed')
+
+  def __init__(self, burst):
+    self.calls=0
+    self.tokens=float(burst)
+    self.updated=time.monotonic()
+    self.suppressed=0
+
+_sites={}
+_sitesLock=threading.Lock()
+
+def _admit(frame, every, perSecond, burst):
+  '''
+  Returns: returns the number of messages suppressed at the call site since the last one logged, or None if this one is
+           suppressed too.
+  '''
+  key=(frame.f_code, frame.f_lineno)
+  capacity=burst if burst is not None else max(defaultBurst, perSecond or 0)
+  with _sitesLock:
+    site=_sites.get(key, None)
+    if site is None: site=_sites[key]=_Site(capacity)
+    site.calls+=1
+    admitted=every is None or (site.calls-1)%every==0
+    if admitted and perSecond is not None:
+      now=time.monotonic()
+      site.tokens=min(capacity, site.tokens+(now-site.updated)*perSecond)
+      site.updated=now
+      if site.tokens>=1:
+        site.tokens-=1
+      else:
+        admitted=False
+    if not admitted:
+      site.suppressed+=1
+      return None
+    suppressed,site.suppressed=site.suppressed,0
+    return suppressed
+
+class _Suppressed(object):
+  '''
+  Prefixes a message with the number of messages suppressed before it, when it is formatted.
+  '''
+  __slots__=('message', 'count')
+
+  def __init__(self, message, count):
+    self.message=message
+    self.count=count
+
+  def __str__(self):
+    return '({num:d} similar messages suppressed) '.format(num=self.count)+str(self.message)
+
+def _log(logger, level, message, args, every, perSecond, burst, exc_info, stack_info):
+  if not logger.isEnabledFor(level): return False
+  frame=sys._getframe(2)  # The caller of debug(), info(), ... or log().
+  if every is not None or perSecond is not None:
+    suppressed=_admit(frame, every, perSecond, burst)
+    if suppressed is None: return False
+    if suppressed>0: message=_Suppressed(message, suppressed)
+  if exc_info:
+    if isinstance(exc_info, BaseException):
+      exc_info=(type(exc_info), exc_info, exc_info.__traceback__)
+    elif not isinstance(exc_info, tuple):
+      exc_info=sys.exc_info()
+  else:
+    exc_info=None
+  stackInfo=None
+  if stack_info:
+    stackInfo='Stack (most recent call last):\n'+''.join(traceback.format_stack(frame)).rstrip('\n')
+  code=frame.f_code
+  logger.handle(logger.makeRecord(logger.name, level, code.co_filename, frame.f_lineno, message, args, exc_info,
+                                  code.co_name, None, stackInfo))
+  return True
+
+def log(logger, level, message, *args, every=None, perSecond=None, burst=None, exc_info=None, stack_info=False):
+  '''
+  Log message % args at level, if logger is enabled for it and the call site is not being thinned out.
+  Args:
+    logger: the logger of the module.
+    level: a logging level, such as logging.DEBUG.
+    message: the message, with % placeholders for args. It can also be the result of structured(), truncated() or
+             lazy().
+    every: log only the first of every this many calls from the call site.
+    perSecond: log at most this many messages per second from the call site, after an initial burst.
+    burst: number of messages that can be logged at once from the call site before perSecond applies. Defaults to 10,
+           or perSecond if more.
+    exc_info, stack_info: as for logging.
+  Returns: returns True if the message was logged.
+  '''
+  return _log(logger, level, message, args, every, perSecond, burst, exc_info, stack_info)
+
+def debug(logger, message, *args, every=None, perSecond=None, burst=None, exc_info=None, stack_info=False):
+  return _log(logger, logging.DEBUG, message, args, every, perSecond, burst, exc_info, stack_info)
+
+def info(logger, message, *args, every=None, perSecond=None, burst=None, exc_info=None, stack_info=False):
+  return _log(logger, logging.INFO, message, args, every, perSecond, burst, exc_info, stack_info)
+
+def warning(logger, message, *args, every=None, perSecond=None, burst=None, exc_info=None, stack_info=False):
+  return _log(logger, logging.WARNING, message, args, every, perSecond, burst, exc_info, stack_info)
+
+def error(logger, message, *args, every=None, perSecond=None, burst=None, exc_info=None, stack_info=False):
+  return _log(logger, logging.ERROR, message, args, every, perSecond, burst, exc_info, stack_info)
+
+class lazy(object):
+  '''
+  A value computed only when the message is formatted: logs.debug(_logger, 'Stats: %s', logs.lazy(queue.stats)).
+  '''
+  __slots__=('_function',)
+
+  def __init__(self, function):
+    self._function=function
+
+  def __str__(self):
+    return str(self._function())
+
+class truncated(object):
+  '''
+  The text of value, cut to limit characters with "..." appended when it is longer. The value is turned into text once,
+  when the message is formatted.
+  '''
+  __slots__=('_value', '_limit')
+
+  def __init__(self, value, limit=100):
+    self._value=value
+    self._limit=limit
+
+  def __str__(self):
+    text=str(self._value)
+    return text if len(text)<=self._limit else text[:self._limit]+'...'
+
+class structured(object):
+  '''
+  A message logged as a JSON object, {"log": message % args, ...fields}, built when the message is formatted:
+    logs.debug(_logger, logs.structured('Found %d records to process.', len(records)))
+  '''
+  __slots__=('_message', '_args', '_fields')
+
+  def __init__(self, message, *args, **fields):
+    self._message=message
+    self._args=args
+    self._fields=fields
+
+  def __str__(self):
+    record={'log':self._message%self._args if self._args else self._message}
+    record.update(self._fields)
+    return json.dumps(record, default=str)
@@ -0,0 +1,135 @@
+# Prometheus metrics of the ingest modules: rows fetched and published, publish latency, bytes uploaded to GCS, requests
+# blocked by a client-side rate limit, and the depth of the queues between stages. They are kept in their own registry.
+#   Long-running processes, such as the twitter stream run from the command line, expose them with serve(port) for
+#   Prometheus to scrape, at http://host:port/metrics.
+#   A Cloud Function does not live long enough to be scraped, so when PROMETHEUS_PUSHGATEWAY is set (host:port of a
+#   Pushgateway), the metrics are pushed at the end of every invocation (see timing.invocation).
+# prometheus_client is optional: without it, every metric does nothing.
+import logging
+import os
+import threading
+import time
+import weakref
+
+try:
+  import prometheus_client
+except ImportError:
+  prometheus_client=None
+
+_logger=logging.getLogger(__name__)
+
+class _NoMetric(object):
+  '''
+  Stands in for a metric when prometheus_client is not installed.
+  '''
+
+  def labels(self, *values, **labels):
+    return self
+
+  def inc(self, amount=1):
+    pass
+
+  def observe(self, value):
+    pass
+
+  def set(self, value):
+    pass
+
+  def set_function(self, function):
+    pass
+
+if prometheus_client is not None:
+  registry=prometheus_client.CollectorRegistry(auto_describe=True)
+  rowsFetched=prometheus_client.Counter('ingest_rows_fetched', 'Rows received from upstream APIs and files.',
+                                        ['module'], registry=registry)
+  rowsPublished=prometheus_client.Counter('ingest_rows_published', 'Messages acknowledged by Pub/Sub.', ['topic'],
+                                          registry=registry)
+  publishFailures=prometheus_client.Counter('ingest_publish_failures', 'Messages that Pub/Sub did not accept.',
+                                            ['topic'], registry=registry)
+  publishLatency=prometheus_client.Histogram('ingest_publish_latency_seconds',
+                                             'Seconds from publishing a message until Pub/Sub acknowledges it.',
+                                             ['topic'], registry=registry,
+                                             buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+  uploadBytes=prometheus_client.Counter('ingest_upload_bytes', 'Bytes uploaded to GCS.', ['bucket'], registry=registry)
+  rateLimited=prometheus_client.Counter('ingest_rate_limited', 'Requests blocked by a client-side rate limit.',
+                                        ['api', 'function'], registry=registry)
+  queueDepth=prometheus_client.Gauge('ingest_queue_depth', 'Items waiting in a queue between stages.', ['queue'],
+                                     registry=registry)
+else:
+  registry=None
+  rowsFetched=rowsPublished=publishFailures=publishLatency=uploadBytes=rateLimited=queueDepth=_NoMetric()
+
+def trackPublish(future, topic):
+  '''
+  Count the message when Pub/Sub acknowledges it and observe how long that took.
+  Args:
+    future: the future returned by PublisherClient.publish.
+    topic: the topic path the message was published to.
+  Returns: returns the future.
+  '''
+  if registry is None or not hasattr(future, 'add_done_callback'): return future
+  start=time.perf_counter()
+
+  def done(future):
+    try:
+      future.result()
+      rowsPublished.labels(topic).inc()
+      publishLatency.labels(topic).observe(time.perf_counter()-start)
+    except:
+      publishFailures.labels(topic).inc()
+  future.add_done_callback(done)
+  return future
+
+_queues={}  # Name of each queue gauge -> WeakKeyDictionary of the live queues counted in it and their depth functions.
+_queuesLock=threading.Lock()
+
+def _queueDepth(name):
+  return sum(depth(queue) for queue, depth in list(_queues[name].items()))
+
+def trackQueue(name, queue, depth):
+  '''
+  Report the depth of a queue in queueDepth, summed with the other live queues of the same name. The gauge only holds
+  weak references, so a queue that is no longer used is dropped from it instead of being kept alive.
+  Args:
+    name: the value of the queue label.
+    queue: the object holding the queue.
+    depth: a function that takes the queue and returns its depth, such as WorkQueue.depth. Not a bound method or a
+           closure over the queue, which would keep it alive.
+  '''
+  with _queuesLock:
+    if name not in _queues:
+      _queues[name]=weakref.WeakKeyDictionary()
+      queueDepth.labels(name).set_function(lambda:_queueDepth(name))
+    _queues[name][queue]=depth
+
+def serve(port):
+  '''
+  Expose the metrics over HTTP at /metrics from a background thread.
+  Returns: returns True if the metrics are served, False if prometheus_client is not installed.
+  '''
+  if registry is None:
+    _logger.warning('Cannot serve metrics on port '+str(port)+' because prometheus_client is not installed.')
+    return False
+  prometheus_client.start_http_server(int(port), registry=registry)
+  _logger.info('Serving metrics at http://localhost:'+str(port)+'/metrics')
+  return True
+
+_pushLock=threading.Lock()
+
+def push(job, gateway=None):
+  '''
+  Push the metrics to a Pushgateway, if one is configured.
+  Args:
+    job: the job to group the metrics under, such as the name of the function.
+    gateway: host:port of the Pushgateway; defaults to the PROMETHEUS_PUSHGATEWAY environment variable.
+  Returns: returns True if the metrics were pushed.
+  '''
+  gateway=gateway if gateway is not None else os.environ.get('PROMETHEUS_PUSHGATEWAY', None)
+  if registry is None or not gateway: return False
+  try:
+    with _pushLock:
+      prometheus_client.push_to_gateway(gateway, job=job, registry=registry)
+    return True
+  except:
+    _logger.error('Cannot push metrics to '+gateway, exc_info=True, stack_info=True)
+    return False
@@ -0,0 +1,229 @@
+# Profiles an invocation of a Cloud Function when its trigger message asks for it, so that a slow run can be studied
+# with the payload and on the instance where it was slow. Add a "profile" field to the message:
+#   "profile":true                 cProfile of the thread that handles the request.
+#   "profile":"sample"             samples the stacks of every thread, including workers, every 5 milliseconds.
+#   "profile":{"mode":"sample", "interval":0.01, "top":50, "frames":10, "location":"gs://my-bucket/profiles"}
+# Allocations are traced with tracemalloc in both modes. When the invocation ends, the results are uploaded to location,
+# which defaults to gs://{bucket}/profiles when the message has a bucket and can also be a local folder:
+#   {name}_{timestamp}.pstats  the cProfile statistics, to load with pstats.Stats (cProfile mode).
+#   {name}_{timestamp}.folded  the sampled stacks, one "frame;frame;... count" line each, for flame graph tools (sample
+#                              mode).
+#   {name}_{timestamp}.txt     the top functions and the top allocation sites.
+# The _getMessageJSON of each module passes the message through start(), and the entry point is decorated with
+# profiled(), which ends the profile. Without a "profile" field start() only looks up the field and profiled() only
+# checks that no profile is running.
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+
+from common.sinks import getStorageClient
+
+_logger=logging.getLogger(__name__)
+
+defaultOptions={'mode':'cprofile', 'interval':0.005, 'top':30, 'frames':10, 'location':None}
+
+def _options(value, message):
+  '''
+  Returns: returns the profiling options asked for by the value of the "profile" field, or None to not profile.
+  '''
+  if isinstance(value, str):
+    value=value.strip()
+    if value.startswith('{'):
+      try:
+        value=json.loads(value)
+      except:
+        _logger.error('Cannot parse the profile field '+value, exc_info=True, stack_info=True)
+        return None
+    elif value.lower() in ['', 'false', '0', 'no']:
+      return None
+    else:
+      value={'mode':value.lower()} if value.lower() in ['cprofile', 'sample'] else {}  # Such as "true".
+  if value is None or value is False or value==0: return None
+  options=dict(defaultOptions)
+  if isinstance(value, dict): options.update(value)
+  if options['mode'] not in ['cprofile', 'sample']:
+    _logger.error('Unknown profiling mode '+str(options['mode'])+'. Using cprofile.')
+    options['mode']='cprofile'
+  if options['location'] is None:
+    bucket=message.get('bucket', None)
+    options['location']='gs://'+bucket+'/profiles' if bucket else os.path.join(tempfile.gettempdir(), 'profiles')
+  return options
+
+class _Sampler(object):
+  '''
+  Counts the stacks of all threads but its own every interval seconds.
+  '''
+
+  def __init__(self, interval):
+    self._interval=interval
+    self.stacks=Counter()
+    self.numSamples=0
+    self._stop=threading.Event()
+    self._thread=threading.Thread(target=self._run, name='profiler', daemon=True)
+
+  def start(self):
+    self._thread.start()
+
+  def _run(self):
+    ownId=threading.get_ident()
+    while not self._stop.wait(self._interval):
+      for threadId, frame in sys._current_frames().items():
+        if threadId==ownId: continue
+        stack=[]
+        while frame is not None:
+          code=frame.f_code
+          stack.append(os.path.basename(code.co_filename)+':'+code.co_name+':'+str(frame.f_lineno))
+          frame=frame.f_back
+        self.stacks[';'.join(reversed(stack))]+=1
+      self.numSamples+=1
+
+  def stop(self):
+    self._stop.set()
+    self._thread.join()
+
+  def folded(self):
+    return ''.join(stack+' '+str(count)+'\n' for stack, count in self.stacks.most_common())
+
+  def top(self, num):
+    '''
+    Returns: returns the frames that were on top of the stack most often, with their counts.
+    '''
+    counts=Counter()
+    for stack, count in self.stacks.items():
+      counts[stack.rsplit(';', 1)[-1]]+=count
+    return counts.most_common(num)
+
+class _Profile(object):
+  def __init__(self, options):
+    self.options=options
+    self._profiler=None
+    self._sampler=None
+    self._started=time.perf_counter()
+    self._tracing=not tracemalloc.is_tracing()  # Leave tracemalloc alone if something else is using it.
+    if self._tracing: tracemalloc.start(int(options['frames']))
+    if options['mode']=='sample':
+      self._sampler=_Sampler(float(options['interval']))
+      self._sampler.start()
+    else:
+      self._profiler=cProfile.Profile()
+      self._profiler.enable()
+
+  def stop(self, name):
+    '''
+    Returns: returns a dict mapping the suffix of each output file to its contents.
+    '''
+    if self._profiler is not None: self._profiler.disable()
+    if self._sampler is not None: self._sampler.stop()
+    elapsed=time.perf_counter()-self._started
+    top=int(self.options['top'])
+    snapshot=tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+    if self._tracing: tracemalloc.stop()
+
+    outputs={}
+    summary=io.StringIO()
+    summary.write('Profile of {name} in {mode} mode over {seconds:.3f} seconds.\n\n'.format(
+      name=name, mode=self.options['mode'], seconds=elapsed))
+    if self._profiler is not None:
+      stats=pstats.Stats(self._profiler, stream=summary)
+      stats.sort_stats('cumulative').print_stats(top)
+      with tempfile.NamedTemporaryFile(suffix='.pstats', delete=False) as statsFile:
+        statsPath=statsFile.name
+      try:
+        stats.dump_stats(statsPath)
+        with open(statsPath, 'rb') as statsFile:
+          outputs['pstats']=statsFile.read()
+      finally:
+        os.remove(statsPath)
+    if self._sampler is not None:
+      summary.write('Top of the stack in {num:d} samples:\n'.format(num=self._sampler.numSamples))
+      for frame, count in self._sampler.top(top):
+        summary.write('{count:>8d}  {frame}\n'.format(count=count, frame=frame))
+      outputs['folded']=self._sampler.folded().encode('utf-8')
+    if snapshot is not None:
+      summary.write('\nTop allocation sites:\n')
+      for statistic in snapshot.statistics('lineno')[:top]:
+        summary.write(str(statistic)+'\n')
+    outputs['txt']=summary.getvalue().encode('utf-8')
+    return outputs
+
+_active=None
+_lock=threading.Lock()
+
+def start(message):
+  '''
+  Start profiling if the message has a "profile" field asking for it.
+  Args:
+    message: the trigger message as parsed by _getMessageJSON.
+  Returns: returns the message.
+  '''
+  global _active
+  if message is None or 'profile' not in message: return message
+  options=_options(message['profile'], message)
+  if options is None: return message
+  with _lock:
+    if _active is not None:
+      _logger.warning('A profile is already running.')
+      return message
+    _active=_Profile(options)
+  _logger.info('Profiling in '+options['mode']+' mode; the results will be written to '+options['location'])
+  return message
+
+def _write(location, name, contents):
+  if location.startswith('gs://'):
+    bucket,_,path=location[len('gs://'):].partition('/')
+    objectName=(path.rstrip('/')+'/' if path else '')+name
+    getStorageClient().bucket(bucket).blob(objectName).upload_from_string(contents)
+    return 'gs://'+bucket+'/'+objectName
+  os.makedirs(location, exist_ok=True)
+  fullPath=os.path.join(location, name)
+  with open(fullPath, 'wb') as outputFile:
+    outputFile.write(contents)
+  return fullPath
+
+def finish(name):
+  '''
+  Stop the profile that is running, if any, and write its results.
+  Args:
+    name: name of the function, which starts the names of the files.
+  Returns: returns the locations of the files written, or None if nothing was being profiled.
+  '''
+  global _active
+  with _lock:
+    profile,_active=_active,None
+  if profile is None: return None
+  written=[]
+  try:
+    outputs=profile.stop(name)
+    stem=name+'_'+datetime.now(timezone.utc).strftime('%Y-%m-%dT%H-%M-%S.%fZ')
+    for suffix, contents in outputs.items():
+      written.append(_write(profile.options['location'], stem+'.'+suffix, contents))
+    _logger.info('Wrote the profile to '+', '.join(written))
+  except:
+    _logger.error('Cannot write the profile of '+name+' to '+profile.options['location'], exc_info=True,
+                  stack_info=True)
+  return written
+
+def profiled(name):
+  '''
+  Decorates the entry point of a function so that a profile started by its message (see start) ends with the call.
+  '''
+  def decorate(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      try:
+        return function(*args, **kwargs)
+      finally:
+        if _active is not None: finish(name)
+    return wrapper
+  return decorate
@@ -0,0 +1,209 @@
+# Records HTTP traffic to cassette files and replays it, so that the ingest modules can run, be profiled and be
+# benchmarked without live upstreams. A Cassette patches requests' HTTPAdapter.send, which every HTTP call of the
+# modules goes through: OpenSkyApi (requests.get), mapquestIncidents and genericRest (common.httpClient), yfinance and
+# the tweepy stream. A cassette is a gzip-compressed JSONL file with one interaction per line: the request's method and
+# URL, and the response's status, headers and body, which is kept as the chunks it arrived in with the seconds at which
+# each arrived. Replay can follow the original timing, run faster by a factor, or return responses right away.
+# Credentials in query parameters (see ignoreParams) are removed from the recorded URLs and ignored when matching.
+# Run any module's command line within a cassette, from the python folder:
+#   python -m common.replay -mode record -cassette ../resources/cassettes/traffic.jsonl.gz \
+#     -module api.traffic.mapquestIncidents -- -key ... -bounds 39.7 -105.1 39.9 -104.8
+#   python -m common.replay -mode replay -speed 10 -cassette ../resources/cassettes/traffic.jsonl.gz \
+#     -module api.traffic.mapquestIncidents -- -key ... -bounds 39.7 -105.1 39.9 -104.8
+import base64
+import gzip
+import io
+import json
+import logging
+import os
+import runpy
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+_logger=logging.getLogger(__name__)
+
+ignoreParams=frozenset(['key', 'apikey', 'api_key', 'access_token', 'token', 'client_secret'])
+# The recorded bodies are already decoded, and their length can differ from what the server sent.
+_droppedHeaders=frozenset(['content-encoding', 'transfer-encoding', 'content-length'])
+
+class ReplayError(requests.exceptions.ConnectionError):
+  '''
+  Raised when a request is made during replay that is not in the cassette.
+  '''
+
+def normalizeURL(url):
+  '''
+  Returns: returns the URL with its query parameters sorted and without the parameters in ignoreParams.
+  '''
+  parts=urlsplit(url)
+  params=sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                if name.lower() not in ignoreParams)
+  return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(params), ''))
+
+class _RecordingRaw(object):
+  '''
+  Wraps the raw response of urllib3 to keep a copy of each chunk of the body as the caller reads it.
+  '''
+
+  def __init__(self, raw, interaction, start):
+    self._raw=raw
+    self._interaction=interaction
+    self._start=start
+
+  def _keep(self, chunk):
+    if chunk: self._interaction['chunks'].append([time.monotonic()-self._start, chunk])
+    return chunk
+
+  def stream(self, amt=2**16, decode_content=None):
+    for chunk in self._raw.stream(amt, decode_content=True):
+      yield self._keep(chunk)
+
+  def read(self, amt=None, decode_content=None, **kwargs):
+    return self._keep(self._raw.read(amt, decode_content=True, **kwargs))
+
+  def __getattr__(self, name):
+    return getattr(self._raw, name)
+
+class _ReplayBody(io.RawIOBase):
+  '''
+  Returns the recorded chunks of a body, waiting before each chunk until it is due at the replay speed.
+  '''
+
+  def __init__(self, chunks, speed):
+    self._chunks=list(chunks)
+    self._speed=speed
+    self._start=time.monotonic()
+    self._current=b''
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    if len(self._current)==0:
+      if len(self._chunks)==0: return 0
+      offset, self._current=self._chunks.pop(0)
+      if self._speed:
+        wait=self._start+offset/self._speed-time.monotonic()
+        if wait>0: time.sleep(wait)
+    size=min(len(buffer), len(self._current))
+    buffer[:size]=self._current[:size]
+    self._current=self._current[size:]
+    return size
+
+class Cassette(object):
+  '''
+  Use as a context manager:
+    with Cassette('traffic.jsonl.gz', mode='replay', speed=10):
+      ...code that makes HTTP requests with requests...
+  Only one cassette can be active at a time.
+  '''
+  _active=None
+
+  def __init__(self, path, mode='auto', speed=None):
+    '''
+    Args:
+      path: the cassette file.
+      mode: "record" to make real requests and save them, "replay" to answer requests from the cassette, or "auto" to
+            replay if the cassette exists and to record otherwise.
+      speed: during replay, None to return responses right away, 1 to follow the original timing, or a factor to
+             replay faster (such as 10) or slower (such as 0.5).
+    '''
+    if mode=='auto': mode='replay' if os.path.exists(path) else 'record'
+    if mode not in ['record', 'replay']: raise ValueError('Unknown cassette mode '+str(mode))
+    self.path=path
+    self.mode=mode
+    self.speed=speed
+    self._interactions=[]
+    self._pending={}  # Maps (method, normalized URL) to the recorded interactions not replayed yet.
+    self._last={}  # Maps (method, normalized URL) to the interaction replayed last, which is repeated once all are used.
+    self._lock=threading.Lock()
+    self._originalSend=None
+
+  def _load(self):
+    with gzip.open(self.path, 'rt', encoding='utf-8') as cassetteFile:
+      for line in cassetteFile:
+        if not line.strip(): continue
+        interaction=json.loads(line)
+        interaction['chunks']=[[offset, base64.b64decode(chunk)] for offset, chunk in interaction['chunks']]
+        self._interactions.append(interaction)
+        self._pending.setdefault((interaction['method'], interaction['url']), []).append(interaction)
+    _logger.info('Loaded {num:d} interactions from {path}'.format(num=len(self._interactions), path=self.path))
+
+  def save(self):
+    directory=os.path.dirname(self.path)
+    if directory: os.makedirs(directory, exist_ok=True)
+    with gzip.open(self.path, 'wt', encoding='utf-8') as cassetteFile:
+      for interaction in self._interactions:
+        stored=dict(interaction)
+        stored['chunks']=[[round(offset, 4), base64.b64encode(chunk).decode('ascii')]
+                          for offset, chunk in interaction['chunks']]
+        cassetteFile.write(json.dumps(stored)+'\n')
+    _logger.info('Saved {num:d} interactions to {path}'.format(num=len(self._interactions), path=self.path))
+
+  def _record(self, adapter, request, **kwargs):
+    start=time.monotonic()
+    response=self._originalSend(adapter, request, **kwargs)
+    interaction={'method':request.method,
+                 'url':normalizeURL(request.url),
+                 'status':response.status_code,
+                 'reason':response.reason,
+                 'headers':{name:value for name, value in response.headers.items()
+                            if name.lower() not in _droppedHeaders},
+                 'chunks':[]}
+    with self._lock:
+      self._interactions.append(interaction)
+    response.raw=_RecordingRaw(response.raw, interaction, start)
+    return response
+
+  def _replay(self, adapter, request, **kwargs):
+    key=(request.method, normalizeURL(request.url))
+    with self._lock:
+      pending=self._pending.get(key, [])
+      if len(pending)>0: self._last[key]=pending.pop(0)
+      interaction=self._last.get(key, None)
+    if interaction is None: raise ReplayError('No recorded response for '+request.method+' '+key[1], request=request)
+    body=_ReplayBody(interaction['chunks'], self.speed)
+    raw=HTTPResponse(body=body, headers=interaction['headers'], status=interaction['status'],
+                     reason=interaction['reason'], preload_content=False, decode_content=False)
+    return adapter.build_response(request, raw)
+
+  def __enter__(self):
+    if Cassette._active is not None: raise RuntimeError('Another cassette is already active.')
+    if self.mode=='replay': self._load()
+    self._originalSend=HTTPAdapter.send
+    cassette=self
+
+    def send(adapter, request, **kwargs):
+      if cassette.mode=='record': return cassette._record(adapter, request, **kwargs)
+      return cassette._replay(adapter, request, **kwargs)
+    HTTPAdapter.send=send
+    Cassette._active=self
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    HTTPAdapter.send=self._originalSend
+    Cassette._active=None
+    if self.mode=='record': self.save()
+    return False
+
+if __name__=='__main__':
+  parser=ArgumentParser(description='Run the command line of a module while recording or replaying its HTTP requests.')
+  parser.add_argument('-cassette', required=True, help='The cassette file (.jsonl.gz).')
+  parser.add_argument('-mode', default='auto', choices=['auto', 'record', 'replay'])
+  parser.add_argument('-speed', type=float, default=None,
+                      help='Replay speed: 1 follows the original timing, 10 is ten times faster. Default is no waiting.')
+  parser.add_argument('-module', required=True, help='The module to run, such as api.traffic.mapquestIncidents.')
+  parser.add_argument('moduleArgs', nargs='*', help='Arguments for the module, after --.')
+  args=parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  sys.argv=[args.module]+args.moduleArgs
+  with Cassette(args.cassette, mode=args.mode, speed=args.speed):
+    runpy.run_module(args.module, run_name='__main__', alter_sys=True)
@@ -0,0 +1,413 @@
+# Shared output stage for the ingest modules.
+# BatchPublisher publishes records to a Pub/Sub topic through one PublisherClient per process that groups messages into
+# batches, instead of creating a client and waiting on every message. A DeliveryTracker follows each message until the
+# server acknowledges it, blocks publishing while too many messages or bytes are outstanding, and counts what was
+# acknowledged, what failed and what had to be retried. JsonlWriter writes records to GCS as
+# gzip-compressed JSON lines in time-partitioned files that are rolled over once they reach a size limit, so a run never
+# overwrites the output of an earlier run or of another writer. writeAndPublish serializes each record once and feeds both sinks at the same
+# time. A BackgroundWriter moves the work of a JsonlWriter onto its own thread, so that a streaming callback only has to
+# enqueue records. The client libraries are only imported when the first client is created (see common.lazy).
+import gzip
+import io
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+from common import lazy, logs, metrics, timing
+
+storage=lazy.module('google.cloud.storage')
+pubsub_v1=lazy.module('google.cloud.pubsub_v1')
+
+_logger=logging.getLogger(__name__)
+
+# Messages are sent once a batch holds this many messages or bytes, or after it has waited this many seconds.
+batchSettings={'max_messages':500, 'max_bytes':1024*1024, 'max_latency':0.05}
+
+_publisherClient=None
+_storageClient=None
+_clientLock=threading.Lock()
+
+def getPublisherClient():
+  '''
+  Returns: returns the process-wide batching PublisherClient, creating it the first time it is needed.
+  '''
+  global _publisherClient
+  if _publisherClient is None:
+    with _clientLock:
+      if _publisherClient is None:
+        _publisherClient=pubsub_v1.PublisherClient(batch_settings=pubsub_v1.types.BatchSettings(**batchSettings))
+  return _publisherClient
+
+def getStorageClient():
+  '''
+  Returns: returns the process-wide GCS client, creating it the first time it is needed.
+  '''
+  global _storageClient
+  if _storageClient is None:
+    with _clientLock:
+      if _storageClient is None: _storageClient=storage.Client()
+  return _storageClient
+
+def encode(record):
+  '''
+  Args:
+    record: a dict, a JSON string, or JSON already encoded as bytes.
+  Returns: returns the record as UTF-8 encoded JSON.
+  '''
+  if type(record)==bytes: return record
+  if type(record)==str: return record.encode('utf-8')
+  return json.dumps(record).encode('utf-8')
+
+def toAttributes(record):
+  '''
+  Args:
+    record: a dict.
+  Returns: returns the scalar fields of the record as Pub/Sub message attributes, which must be strings of limited size.
+  '''
+  attributes={}
+  for key, value in record.items():
+    if type(value) in [int, float, str, bool] and len(key)<=256:
+      value=str(value)
+      if len(value)<=1024: attributes[key]=value
+    if len(attributes)>=100: break
+  return attributes
+
+class DeliveryTracker(object):
+  '''
+  Follows published messages until they are acknowledged by registering a callback on each publish future, instead of
+  keeping every future. publish() blocks while maxMessages messages or maxBytes bytes are outstanding, which bounds
+  memory however long the run is. flush() blocks until every message is done and is meant to be called at shutdown.
+  '''
+
+  def __init__(self, maxMessages=1000, maxBytes=10*1024*1024):
+    self._maxMessages=maxMessages
+    self._maxBytes=maxBytes
+    self._outstandingMessages=0
+    self._outstandingBytes=0
+    self._counts={'published':0, 'acked':0, 'failed':0, 'retried':0}
+    metrics.trackQueue('publish', self, lambda tracker:tracker._outstandingMessages)
+    self._condition=threading.Condition()
+
+  def _reserve(self, numBytes):
+    with self._condition:
+      # A message larger than maxBytes is let through once nothing else is outstanding.
+      while self._outstandingMessages>0 and (self._outstandingMessages>=self._maxMessages or
+                                             self._outstandingBytes+numBytes>self._maxBytes):
+        self._condition.wait()
+      self._outstandingMessages+=1
+      self._outstandingBytes+=numBytes
+      self._counts['published']+=1
+
+  def _release(self, numBytes, outcome):
+    with self._condition:
+      self._outstandingMessages-=1
+      self._outstandingBytes-=numBytes
+      if outcome is not None: self._counts[outcome]+=1
+      else: self._counts['published']-=1  # The message was never handed to the client.
+      self._condition.notify_all()
+
+  def countRetry(self):
+    with self._condition:
+      self._counts['retried']+=1
+
+  def publish(self, client, topicPath, data, **attributes):
+    '''
+    Publish a message, waiting first if too many messages are outstanding.
+    Args:
+      client: a PublisherClient.
+      topicPath:
+      data: the message as bytes.
+      attributes: string attributes to attach to the message.
+    Returns: returns the publish future. Exceptions raised by the client while publishing are raised again.
+    '''
+    numBytes=len(data)
+    self._reserve(numBytes)
+    try:
+      future=client.publish(topicPath, data, **attributes)
+    except:
+      self._release(numBytes, None)
+      raise
+    
+    def done(future):
+      try:
+        future.result()
+        self._release(numBytes, 'acked')
+      except:
+        logs.error(_logger, 'Error while publishing a message to %s', topicPath, perSecond=1, exc_info=True,
+                   stack_info=True)
+        self._release(numBytes, 'failed')
+    future.add_done_callback(done)
+    metrics.trackPublish(future, topicPath)
+    return future
+
+  def flush(self, timeout=None):
+    '''
+    Block until every published message has been acknowledged or has failed.
+    Args:
+      timeout: seconds to wait at most, or None to wait as long as it takes.
+    Returns: returns the counts (see stats).
+    '''
+    with self._condition:
+      self._condition.wait_for(lambda:self._outstandingMessages==0, timeout=timeout)
+    return self.stats()
+
+  def stats(self):
+    '''
+    Returns: returns a dict with the numbers of messages published, acked, failed and retried, and the numbers of
+             messages and bytes still outstanding.
+    '''
+    with self._condition:
+      stats=dict(self._counts)
+      stats['outstandingMessages']=self._outstandingMessages
+      stats['outstandingBytes']=self._outstandingBytes
+    return stats
+
+class BatchPublisher(object):
+  '''
+  Publishes messages to one topic. publish() returns right away unless too many messages are outstanding; wait()
+  blocks until every message has been sent.
+  '''
+
+  def __init__(self, projectId, topic, client=None, tracker=None):
+    self._topicPath='projects/{project}/topics/{topic}'.format(project=projectId, topic=topic)
+    self._client=client if client is not None else getPublisherClient()
+    self._tracker=tracker if tracker is not None else DeliveryTracker()
+    self._numAcked=0  # Number of messages acknowledged as of the last call to wait.
+
+  def publish(self, record, **attributes):
+    '''
+    Args:
+      record: a dict, a JSON string, or encoded bytes.
+      attributes: string attributes to attach to the message. If the client rejects them, the message is published
+                  again without attributes and counted as retried.
+    Returns: returns the publish future.
+    '''
+    with timing.span('publish'):
+      data=encode(record)
+      try:
+        return self._tracker.publish(self._client, self._topicPath, data, **attributes)
+      except:
+        if len(attributes)==0: raise
+        logs.debug(_logger, 'Cannot include %s as attributes to the message.', attributes, perSecond=1, exc_info=True)
+        self._tracker.countRetry()
+        return self._tracker.publish(self._client, self._topicPath, data)
+
+  def publishAll(self, records):
+    for record in records:
+      self.publish(record)
+    return self.wait()
+
+  def wait(self):
+    '''
+    Returns: returns the number of messages acknowledged since the last call to wait.
+    '''
+    with timing.span('ack'):
+      numAcked=self._tracker.flush()['acked']
+    numAcked,self._numAcked=numAcked-self._numAcked,numAcked
+    return numAcked
+
+  def stats(self):
+    return self._tracker.stats()
+
+class JsonlWriter(object):
+  '''
+  Writes records as gzip-compressed JSON lines to GCS. Files are placed in a partition for the hour in which they are
+  written, {path}/dt=YYYY-MM-DD/hour=HH/{prefix}_{timestamp}_{writer}_{sequence}.jsonl.gz, which BigQuery can load or
+  query as hive-partitioned data; {writer} is random to each writer. A new file is started when the current one reaches
+  maxRecords or maxBytes (uncompressed), when it is older than maxSeconds, or when the hour changes. Uploads that fail
+  are retried with exponential backoff.
+  '''
+
+  def __init__(self, bucket, path, prefix='part', maxRecords=100000, maxBytes=64*1024*1024, client=None,
+               maxSeconds=None, uploadThreads=0, retries=3):
+    '''
+    Args:
+      maxSeconds: seconds after which a file is uploaded even if it is not full, checked by rollIfDue, or None.
+      uploadThreads: number of files to upload at the same time in the background, or 0 to upload while writing.
+      retries: number of times to retry a failed upload.
+    '''
+    self._bucketName=bucket
+    self._bucket=(client if client is not None else getStorageClient()).bucket(bucket)
+    self._path=path.rstrip('/') if path else ''
+    self._prefix=prefix
+    self._maxRecords=maxRecords
+    self._maxBytes=maxBytes
+    self._maxSeconds=maxSeconds
+    self._retries=retries
+    self._uploader=ThreadPoolExecutor(max_workers=uploadThreads) if uploadThreads>0 else None
+    self._uploads=[]  # Uploads running in the background.
+    self._sequence=0
+    # Tells apart the files of writers started in the same second, such as concurrent Cloud Function instances.
+    self._writerId=uuid.uuid4().hex[:8]
+    self._lock=threading.Lock()
+    self._countLock=threading.Lock()
+    self._objectNames=[]  # Names of the files uploaded so far.
+    self._numWritten=0
+    self._buffer=None
+
+  def _partition(self, now):
+    return '{path}dt={date}/hour={hour}'.format(path=self._path+'/' if self._path else '',
+                                                date=now.strftime('%Y-%m-%d'), hour=now.strftime('%H'))
+
+  def _open(self, now):
+    self._buffer=io.BytesIO()
+    self._gzip=gzip.GzipFile(fileobj=self._buffer, mode='wb')
+    self._objectName='{partition}/{prefix}_{timestamp}_{writer}_{sequence:04d}.jsonl.gz'.format(
+      partition=self._partition(now), prefix=self._prefix, timestamp=now.strftime('%Y%m%dT%H%M%S'),
+      writer=self._writerId, sequence=self._sequence)
+    self._sequence+=1
+    self._partitionOpened=self._partition(now)
+    self._openedAt=time.monotonic()
+    self._bufferRecords=0
+    self._bufferBytes=0
+
+  def _upload(self, objectName, contents, numRecords):
+    for attempt in range(self._retries+1):
+      try:
+        with timing.span('store', items=numRecords):
+          self._bucket.blob(objectName).upload_from_string(contents, content_type='application/gzip')
+        metrics.uploadBytes.labels(self._bucketName).inc(len(contents))
+        with self._countLock:
+          self._objectNames.append(objectName)
+          self._numWritten+=numRecords
+        logs.debug(_logger, 'Wrote %d records to gs://%s/%s', numRecords, self._bucketName, objectName)
+        return
+      except:
+        if attempt<self._retries:
+          _logger.warning('Retrying the upload of gs://'+self._bucketName+'/'+objectName, exc_info=True)
+          time.sleep(0.5*2**attempt)
+        else:
+          _logger.error('Cannot write to gs://'+self._bucketName+'/'+objectName, exc_info=True, stack_info=True)
+
+  def _roll(self):
+    '''
+    Upload the current file, if it has any records, and start over with an empty buffer.
+    '''
+    if self._buffer is None: return
+    self._gzip.close()
+    if self._bufferRecords>0:
+      if self._uploader is not None:
+        self._uploads=[upload for upload in self._uploads if not upload.done()]
+        self._uploads.append(self._uploader.submit(self._upload, self._objectName, self._buffer.getvalue(),
+                                                   self._bufferRecords))
+      else:
+        self._upload(self._objectName, self._buffer.getvalue(), self._bufferRecords)
+    self._buffer=None
+
+  def write(self, record):
+    '''
+    Args:
+      record: a dict, a JSON string, or encoded bytes holding one record.
+    '''
+    line=encode(record)+b'\n'
+    now=datetime.now(timezone.utc)
+    with self._lock:
+      if self._buffer is not None and (self._bufferRecords>=self._maxRecords or
+                                       self._bufferBytes+len(line)>self._maxBytes and self._bufferRecords>0 or
+                                       self._partitionOpened!=self._partition(now)):
+        self._roll()
+      if self._buffer is None: self._open(now)
+      self._gzip.write(line)
+      self._bufferRecords+=1
+      self._bufferBytes+=len(line)
+
+  def rollIfDue(self):
+    '''
+    Upload the current file if it is older than maxSeconds.
+    '''
+    with self._lock:
+      if self._buffer is not None and self._maxSeconds is not None and \
+          time.monotonic()-self._openedAt>=self._maxSeconds:
+        self._roll()
+
+  def writeAll(self, records):
+    for record in records:
+      self.write(record)
+    return self.close()
+
+  def close(self):
+    '''
+    Upload whatever is buffered and wait for the uploads running in the background.
+    Returns: returns the number of records written to GCS since the last call to close.
+    '''
+    with self._lock:
+      self._roll()
+      uploads,self._uploads=self._uploads,[]
+    wait(uploads)
+    with self._countLock:
+      numWritten,self._numWritten=self._numWritten,0
+    return numWritten
+
+  def objectNames(self):
+    with self._countLock:
+      return list(self._objectNames)
+
+class BackgroundWriter(object):
+  '''
+  Passes records to a JsonlWriter on a background thread. write() only puts the record in a queue, and blocks only when
+  maxQueued records are waiting. While no records arrive, the thread uploads files that are older than the writer's
+  maxSeconds.
+  '''
+  _stop=object()
+
+  def __init__(self, writer, maxQueued=10000, pollSeconds=1.0):
+    self._writer=writer
+    self._pollSeconds=pollSeconds
+    self._queue=queue.Queue(maxsize=maxQueued)
+    metrics.trackQueue('writer', self, BackgroundWriter.queued)
+    self._thread=threading.Thread(target=self._run, name='BackgroundWriter', daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      try:
+        record=self._queue.get(timeout=self._pollSeconds)
+      except queue.Empty:
+        record=None
+      try:
+        if record is self._stop: return
+        if record is not None: self._writer.write(record)
+        self._writer.rollIfDue()
+      except:
+        logs.error(_logger, 'Cannot write a record.', perSecond=1, exc_info=True, stack_info=True)
+
+  def write(self, record):
+    self._queue.put(record)
+
+  def queued(self):
+    '''
+    Returns: returns the number of records waiting to be written.
+    '''
+    return self._queue.qsize()
+
+  def close(self):
+    '''
+    Write the queued records, upload everything, and stop the thread.
+    Returns: returns the number of records written to GCS.
+    '''
+    self._queue.put(self._stop)
+    self._thread.join()
+    return self._writer.close()
+
+def writeAndPublish(records, writer=None, publisher=None):
+  '''
+  Serialize each record once and send it to both the writer and the publisher, storing and publishing at the same time.
+  Args:
+    records: a list of dicts.
+    writer: a JsonlWriter or None to skip storage.
+    publisher: a BatchPublisher or None to skip publishing.
+  Returns: returns a tuple of (number of records written, number of records published).
+  '''
+  with timing.span('serialize', items=len(records)):
+    encoded=[encode(record) for record in records]
+  with ThreadPoolExecutor(max_workers=2) as executor:
+    writing=executor.submit(writer.writeAll, encoded) if writer is not None else None
+    publishing=executor.submit(publisher.publishAll, encoded) if publisher is not None else None
+    numWritten=writing.result() if writing is not None else 0
+    numPublished=publishing.result() if publishing is not None else 0
+  return numWritten, numPublished
@@ -0,0 +1,164 @@
+# Per-stage latency of an invocation. An entry point is decorated with timed(), or wraps its work in invocation(), and
+# the code it calls marks its stages with span(), such as fetch, decode, convert, serialize, store and publish:
+#   @timing.timed('mapquestIncidents', _logger)
+#   def entry(request):
+#     with timing.span('fetch'):
+#       ...
+#     return 'Wrote 10 items.'
+# Each stage gets a count, a total, a maximum and a histogram of its latencies. When the invocation ends they are logged
+# as one JSON line, and the response of the function becomes JSON with the message it returned and a "timings" field.
+# A Cloud Function instance handles one request at a time, so the invocation is kept in a module variable instead of
+# being passed around: spans on worker threads (tile requests, tweet workers, background uploads) count towards it too.
+# Outside of an invocation, span() does nothing.
+import functools
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from common import metrics
+
+_logger=logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in milliseconds. Slower spans go in a last "inf" bucket.
+bucketBounds=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+class Timings(object):
+  '''
+  The latencies of the stages of one invocation. Safe to use from several threads.
+  '''
+
+  def __init__(self, name):
+    self.name=name
+    self._stages={}
+    self._lock=threading.Lock()
+    self._start=time.perf_counter()
+
+  def record(self, stage, seconds, items=None):
+    '''
+    Args:
+      stage: name of the stage, such as "fetch".
+      seconds: how long one pass through the stage took.
+      items: the number of items the pass handled, if the stage counts them.
+    '''
+    milliseconds=seconds*1000
+    bucket=bisect_left(bucketBounds, milliseconds)
+    with self._lock:
+      stats=self._stages.get(stage, None)
+      if stats is None:
+        stats=self._stages[stage]={'count':0, 'items':0, 'totalMs':0.0, 'maxMs':0.0,
+                                   'histogram':[0]*(len(bucketBounds)+1)}
+      stats['count']+=1
+      if items is not None: stats['items']+=items
+      stats['totalMs']+=milliseconds
+      if milliseconds>stats['maxMs']: stats['maxMs']=milliseconds
+      stats['histogram'][bucket]+=1
+
+  def summary(self):
+    '''
+    Returns: returns a dict with the elapsed milliseconds of the invocation and, for each stage, its count, items (if
+             counted), total, mean and maximum milliseconds and a histogram that maps the upper bound of each non-empty
+             bucket, in milliseconds, to the number of spans in it.
+    '''
+    with self._lock:
+      stages={}
+      for stage, stats in self._stages.items():
+        summary={'count':stats['count'], 'totalMs':round(stats['totalMs'], 3),
+                 'meanMs':round(stats['totalMs']/stats['count'], 3), 'maxMs':round(stats['maxMs'], 3),
+                 'histogram':{(str(bucketBounds[index]) if index<len(bucketBounds) else 'inf'):count
+                              for index, count in enumerate(stats['histogram']) if count>0}}
+        if stats['items']>0: summary['items']=stats['items']
+        stages[stage]=summary
+    return {'elapsedMs':round((time.perf_counter()-self._start)*1000, 3), 'stages':stages}
+
+_current=None
+
+def current():
+  '''
+  Returns: returns the Timings of the invocation in progress, or None.
+  '''
+  return _current
+
+class _Span(object):
+  __slots__=('_timings', '_stage', '_start', 'items')
+
+  def __init__(self, timings, stage, items):
+    self._timings=timings
+    self._stage=stage
+    self.items=items
+
+  def __enter__(self):
+    self._start=time.perf_counter()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self._timings.record(self._stage, time.perf_counter()-self._start, self.items)
+    return False
+
+class _NoSpan(object):
+  '''
+  Returned by span() outside of an invocation.
+  '''
+  __slots__=('items',)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    return False
+
+_noSpan=_NoSpan()
+
+def span(stage, items=None):
+  '''
+  Time a stage of the invocation in progress:
+    with span('convert') as converting:
+      rows=...
+      converting.items=len(rows)
+  Args:
+    stage: name of the stage.
+    items: the number of items handled, which can also be set on the span before it ends.
+  '''
+  timings=_current
+  if timings is None: return _noSpan
+  return _Span(timings, stage, items)
+
+@contextmanager
+def invocation(name, logger=None):
+  '''
+  Collect the timings of the spans run until the block ends, and log them as one JSON line.
+  Args:
+    name: name of the function being invoked.
+    logger: the logger of the function, so that the line shows up with its other logs.
+  Yields: yields the Timings.
+  '''
+  global _current
+  timings=Timings(name)
+  previous,_current=_current,timings
+  try:
+    yield timings
+  finally:
+    _current=previous
+    (logger if logger is not None else _logger).info(json.dumps({'invocation':name, 'timings':timings.summary()}))
+    metrics.push(name)  # Only if a Pushgateway is configured.
+
+def respond(message, timings):
+  '''
+  Returns: returns the response of a function as JSON, with the message it used to return and its timings.
+  '''
+  return json.dumps({'message':message, 'timings':timings.summary()})
+
+def timed(name, logger=None):
+  '''
+  Decorates the entry point of a function so that each call is an invocation (see invocation) and its response, the text
+  the entry point returns, is turned into JSON with the timings (see respond).
+  '''
+  def decorate(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with invocation(name, logger=logger) as timings:
+        return respond(function(*args, **kwargs), timings)
+    return wrapper
+  return decorate
@@ -0,0 +1,106 @@
+# A bounded producer/consumer queue. A producer, such as the callback of a stream, only puts items in the queue, and a
+# pool of worker threads takes them out and handles them. When the workers fall behind, put() waits for room for up to
+# maxWait seconds and then drops the item, so the producer is slowed down but never stalled indefinitely. Counts of what
+# was queued, handled, failed and dropped, and of how long producers had to wait, show how close the pipeline is to its
+# capacity.
+import logging
+import queue
+import threading
+import time
+
+from common import logs, metrics
+
+_logger=logging.getLogger(__name__)
+
+class WorkQueue(object):
+  _stop=object()
+
+  def __init__(self, handler, numWorkers=4, maxQueued=1000, maxWait=5.0, name='worker'):
+    '''
+    Args:
+      handler: a function called with each item by one of the workers. Exceptions it raises are logged and counted.
+      numWorkers: number of worker threads.
+      maxQueued: the most items waiting in the queue.
+      maxWait: seconds put() waits for room in a full queue before dropping the item.
+      name: prefix of the names of the worker threads.
+    '''
+    self._handler=handler
+    self._maxWait=maxWait
+    self._queue=queue.Queue(maxsize=maxQueued)
+    self._counts={'queued':0, 'handled':0, 'failed':0, 'dropped':0, 'blockedPuts':0, 'blockedSeconds':0.0,
+                  'maxDepth':0}
+    self._lock=threading.Lock()
+    metrics.trackQueue(name, self, WorkQueue.depth)
+    self._workers=[threading.Thread(target=self._run, name=name+'-'+str(index), daemon=True)
+                   for index in range(numWorkers)]
+    for worker in self._workers:
+      worker.start()
+
+  def _count(self, name, amount=1):
+    with self._lock:
+      self._counts[name]+=amount
+
+  def put(self, item):
+    '''
+    Args:
+      item: the item to hand to the handler.
+    Returns: returns True if the item was queued, False if it was dropped because the queue stayed full.
+    '''
+    try:
+      self._queue.put_nowait(item)
+    except queue.Full:
+      start=time.monotonic()
+      try:
+        self._queue.put(item, timeout=self._maxWait)
+      except queue.Full:
+        self._count('dropped')
+        logs.error(_logger, 'Dropped an item because the work queue stayed full for %s seconds.', self._maxWait,
+                   perSecond=1)
+        return False
+      finally:
+        with self._lock:
+          self._counts['blockedPuts']+=1
+          self._counts['blockedSeconds']+=time.monotonic()-start
+    with self._lock:
+      self._counts['queued']+=1
+      self._counts['maxDepth']=max(self._counts['maxDepth'], self._queue.qsize())
+    return True
+
+  def _run(self):
+    while True:
+      item=self._queue.get()
+      if item is self._stop: return
+      try:
+        self._handler(item)
+        self._count('handled')
+      except:
+        self._count('failed')
+        logs.error(_logger, 'Error while handling an item from the work queue.', perSecond=1, exc_info=True,
+                   stack_info=True)
+
+  def depth(self):
+    '''
+    Returns: returns the number of items waiting to be handled.
+    '''
+    return self._queue.qsize()
+
+  def stats(self):
+    '''
+    Returns: returns a dict with the numbers of items queued, handled, failed and dropped, the number of puts that had
+             to wait and the seconds they waited, the deepest the queue has been, and its current depth.
+    '''
+    with self._lock:
+      stats=dict(self._counts)
+    stats['depth']=self.depth()
+    return stats
+
+  def close(self):
+    '''
+    Handle the items still in the queue and stop the workers.
+    Returns: returns the counts (see stats).
+    '''
+    for _ in self._workers:
+      self._queue.put(self._stop)
+    for worker in self._workers:
+      worker.join()
+    return self.stats()
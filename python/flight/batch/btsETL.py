@@ -0,0 +1,421 @@
+# Loads the monthly On-Time Performance data of the Bureau of Transportation Statistics (BTS) into GCS, for the batch
+# part of the flights project (see bts_batch_etl.ipynb), several months at a time.
+# Each month is streamed from the download to the upload without touching the disk: the zip file is read as it arrives
+# and its CSV member is inflated, cleaned (the trailing comma of each line and all double quotes are removed, as the
+# sed command of sh/downloadFlightsETL.sh used to do) and gzip-compressed straight into a resumable upload to
+#   gs://{bucket}/{folder}/{year}-{month}.csv.gz
+# BigQuery loads gzip-compressed CSV files as they are. With -format parquet, each month is stored instead as a typed
+# Parquet file partitioned by year and month (see flight.batch.btsParquet), which BigQuery scans far less of.
+# An upload that fails is cancelled, so a month is either stored whole or not at all.
+# The months stored are recorded in a manifest in the folder (see flight.batch.btsManifest), and a later run skips the
+# months whose BTS file has not changed since, unless -force is given. Re-running a range only fetches what is new.
+# Months are processed on a pool of threads. Inflating and compressing release the GIL, so the months also share the
+# CPU work, not only the waiting on the network.
+# Run from the python folder, for example from Cloud Shell (dates are month-year or just a year):
+#   python -m flight.batch.btsETL -start 1-2019 -end 4-2022 -bucket ${GOOGLE_CLOUD_PROJECT}_data -workers 6
+#   python -m flight.batch.btsETL -start 2024 -end 2024 -format parquet
+import argparse
+import gzip
+import logging
+import os
+import re
+import ssl
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import logs, metrics, timing
+from common.sinks import getStorageClient
+from flight.batch import btsManifest, btsParquet
+
+logging.basicConfig(
+  format='%(asctime)s.%(msecs)03dZ,%(pathname)s:%(lineno)d,%(levelname)s,%(module)s,%(funcName)s: %(message)s',
+  datefmt="%Y-%m-%d %H:%M:%S")
+_logger=logging.getLogger(__name__)
+
+urlTemplate='https://transtats.bts.gov/PREZIP/On_Time_Reporting_Carrier_On_Time_Performance_1987_present_{year}_{month}.zip'
+defaultFolder='data/flightsETL'
+formats=('csv', 'parquet')
+defaultWorkers=4
+defaultCompressLevel=6  # Most of the size reduction of level 9 for a fraction of the CPU.
+downloadTimeout=(10, 120)  # Seconds to connect and seconds to wait between bytes of the download.
+chunkSize=1024*1024  # Bytes read from the download at a time.
+uploadChunkSize=8*1024*1024  # Bytes sent per request of the resumable upload; a multiple of 256 KB.
+
+class _BTSAdapter(HTTPAdapter):
+  '''
+  Offers the ciphers that curl --ciphers 'HIGH:!DH:!aNULL' did in sh/downloadFlightsETL.sh, as the Diffie-Hellman
+  parameters of the BTS server are rejected by current versions of OpenSSL.
+  '''
+
+  def __init__(self, verify, **kwargs):
+    self._verify=verify
+    super().__init__(**kwargs)
+
+  def init_poolmanager(self, *args, **kwargs):
+    context=ssl.create_default_context()
+    context.set_ciphers('HIGH:!DH:!aNULL')
+    if not self._verify:
+      context.check_hostname=False
+      context.verify_mode=ssl.CERT_NONE
+    kwargs['ssl_context']=context
+    return super().init_poolmanager(*args, **kwargs)
+
+def createSession(verify=False, poolSize=defaultWorkers):
+  '''
+  Args:
+    verify: verify the certificate of the server. The shell script and the notebook did not (curl -k, verify=False).
+    poolSize: number of connections kept open, at least the number of months downloaded at once.
+  Returns: returns a requests.Session for downloading from BTS.
+  '''
+  session=requests.Session()
+  session.verify=verify
+  session.mount('https://', _BTSAdapter(verify, pool_connections=1, pool_maxsize=poolSize))
+  if not verify: requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+  return session
+
+def parseMonth(text, end=False):
+  '''
+  Args:
+    text: a month as "month-year", such as "4-2022", or only a year, such as "2022".
+    end: True if the month ends a range, in which case a year alone means its December instead of its January.
+  Returns: returns (year, month).
+  '''
+  parts=str(text).strip().split('-')
+  if len(parts)==2 and int(parts[0])<13: return (int(parts[1]), int(parts[0]))
+  return (int(parts[-1]), 12 if end else 1)
+
+def monthRange(start, end):
+  '''
+  Args:
+    start, end: (year, month) of the first and last month, both included.
+  Returns: returns the list of (year, month) from start to end.
+  '''
+  months=[]
+  year, month=start
+  while (year, month)<=tuple(end):
+    months.append((year, month))
+    year, month=(year+1, 1) if month==12 else (year, month+1)
+  return months
+
+class _Chunks(object):
+  '''
+  Reads an iterable of byte chunks either a number of bytes at a time or a chunk at a time, and takes back bytes read too
+  far.
+  '''
+
+  def __init__(self, chunks):
+    self._chunks=iter(chunks)
+    self._pending=b''
+    self.numBytes=0  # Bytes taken from the iterable.
+
+  def next(self):
+    '''
+    Returns: returns the next chunk, or b'' at the end.
+    '''
+    if self._pending:
+      chunk,self._pending=self._pending,b''
+      return chunk
+    for chunk in self._chunks:
+      if chunk:
+        self.numBytes+=len(chunk)
+        return chunk
+    return b''
+
+  def read(self, size):
+    '''
+    Returns: returns the next size bytes, or fewer at the end.
+    '''
+    parts=[]
+    while size>0:
+      chunk=self.next()
+      if not chunk: break
+      if len(chunk)>size: self.unread(chunk[size:])
+      parts.append(chunk[:size])
+      size-=len(parts[-1])
+    return b''.join(parts)
+
+  def unread(self, data):
+    if data: self._pending=data+self._pending
+
+# The fixed part of a local file header of a zip file. See section 4.3.7 of
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT
+_localHeader=struct.Struct('<4sHHHHHIIIHH')
+_localHeaderSignature=b'PK\x03\x04'
+_dataDescriptorSignature=b'PK\x07\x08'
+_zip64ExtraId=0x0001
+
+def _isZip64(extra):
+  while len(extra)>=4:
+    headerId, size=struct.unpack('<HH', extra[:4])
+    if headerId==_zip64ExtraId: return True
+    extra=extra[4+size:]
+  return False
+
+def streamZipMembers(chunks, accept=lambda name:True):
+  '''
+  Inflate the members of a zip file as its bytes arrive, by following the local header in front of each member instead
+  of the central directory at the end of the file. Only stored and deflated members are supported.
+  Args:
+    chunks: an iterable of the bytes of the zip file, such as response.iter_content().
+    accept: a function of the name of a member that returns True for the members to output. The others are skipped.
+  Yields: yields (name, bytes) for the contents of the accepted members, in pieces.
+  Raises: raises ValueError if the zip file is truncated, uses an unsupported compression method or fails a CRC check.
+  '''
+  stream=_Chunks(chunks)
+  numMembers=0
+  while True:
+    header=stream.read(_localHeader.size)
+    if not header.startswith(_localHeaderSignature):
+      if numMembers==0: raise ValueError('Not a zip file: '+repr(header[:16]))
+      return  # The central directory, which is not needed.
+    numMembers+=1
+    if len(header)<_localHeader.size: raise ValueError('The zip file is truncated.')
+    (_, _, flags, method, _, _, crc, compressedSize, _, nameLength, extraLength)=_localHeader.unpack(header)
+    name=stream.read(nameLength).decode('utf-8' if flags&0x800 else 'cp437')
+    extra=stream.read(extraLength)
+    wanted=accept(name)
+    checksum=0
+    if method==8:
+      decompressor=zlib.decompressobj(-zlib.MAX_WBITS)
+      while not decompressor.eof:
+        chunk=stream.next()
+        if not chunk: raise ValueError('The zip file is truncated within '+name+'.')
+        if wanted:
+          data=decompressor.decompress(chunk)
+          if data:
+            checksum=zlib.crc32(data, checksum)
+            yield name, data
+        else:
+          decompressor.decompress(chunk)
+      stream.unread(decompressor.unused_data)
+    elif method==0 and not flags&0x8:
+      remaining=compressedSize
+      while remaining>0:
+        data=stream.read(min(remaining, chunkSize))
+        if not data: raise ValueError('The zip file is truncated within '+name+'.')
+        remaining-=len(data)
+        if wanted:
+          checksum=zlib.crc32(data, checksum)
+          yield name, data
+    else:
+      raise ValueError('Cannot stream '+name+', which uses compression method '+str(method)+'.')
+    if flags&0x8:
+      # The CRC and sizes follow the data in a data descriptor, which may start with a signature.
+      descriptor=stream.read(4)
+      if descriptor==_dataDescriptorSignature: descriptor=stream.read(4)
+      crc=struct.unpack('<I', descriptor)[0]
+      stream.read(16 if _isZip64(extra) else 8)
+    if wanted and checksum!=crc: raise ValueError('The CRC of '+name+' does not match; the download is corrupt.')
+
+_lineEnd=re.compile(rb',?\r?\n')
+
+def cleanLines(chunks):
+  '''
+  Clean CSV text as sed -e 's/,$//g' -e 's/"//g' did: the trailing comma of each line and all double quotes are
+  removed. Line endings become \n and the last line gets one. The work is done on whole chunks rather than line by line.
+  Args:
+    chunks: an iterable of bytes that can split lines anywhere.
+  Yields: yields cleaned bytes, each ending at the end of a line.
+  '''
+  pending=b''
+  for chunk in chunks:
+    if pending: chunk=pending+chunk
+    end=chunk.rfind(b'\n')+1
+    if end==0:
+      pending=chunk
+      continue
+    pending=chunk[end:]
+    yield _lineEnd.sub(b'\n', chunk[:end] if pending else chunk).replace(b'"', b'')
+  if pending: yield _lineEnd.sub(b'\n', pending+b'\n').replace(b'"', b'')
+
+class _CountingWriter(object):
+  '''
+  Counts the bytes written through to a file object.
+  '''
+
+  def __init__(self, output):
+    self._output=output
+    self.numBytes=0
+
+  def write(self, data):
+    self.numBytes+=len(data)
+    return self._output.write(data)
+
+  def flush(self):
+    pass  # The resumable upload sends whole chunks on its own.
+
+  @property
+  def closed(self):
+    return self._output.closed
+
+def folderOf(folder, outputFormat='csv'):
+  '''
+  Returns: returns folder, or the default folder of the format if it is None.
+  '''
+  if folder is not None: return folder
+  return btsParquet.defaultFolder if outputFormat=='parquet' else defaultFolder
+
+def objectName(year, month, folder=None, outputFormat='csv'):
+  '''
+  Returns: returns the name of the object of a month in the bucket. folder defaults to the folder of the format.
+  '''
+  folder=folderOf(folder, outputFormat)
+  if outputFormat=='parquet': return btsParquet.objectName(year, month, folder)
+  return (folder.strip('/')+'/' if folder else '')+'{year:d}-{month:d}.csv.gz'.format(year=year, month=month)
+
+def _writeCSV(chunks, output, name, compressLevel):
+  '''
+  Returns: returns (number of rows, bytes of cleaned CSV text) after writing the cleaned text of chunks to output,
+           gzip-compressed.
+  '''
+  numLines=0
+  numCleanBytes=0
+  with gzip.GzipFile(filename=os.path.basename(name)[:-len('.gz')], mode='wb', fileobj=output,
+                     compresslevel=compressLevel) as compressed:
+    for cleaned in cleanLines(chunks):
+      numLines+=cleaned.count(b'\n')
+      numCleanBytes+=len(cleaned)
+      compressed.write(cleaned)
+  return max(0, numLines-1), numCleanBytes  # Less the header.
+
+def processMonth(year, month, bucket, folder=None, session=None, compressLevel=defaultCompressLevel,
+                 outputFormat='csv', manifest=None, force=False):
+  '''
+  Download, clean and store one month.
+  Args:
+    year, month: the month to process.
+    bucket: the GCS bucket to store the month in.
+    folder: the folder within the bucket. Defaults to data/flightsETL for CSV and data/flightsParquet for Parquet.
+    session: a session from createSession(), shared by the months.
+    compressLevel: the gzip compression level of CSV files, from 1 (fastest) to 9 (smallest).
+    outputFormat: "csv" for a cleaned gzip-compressed CSV file, or "parquet" (see flight.batch.btsParquet).
+    manifest: a btsManifest.Manifest of the folder, to skip the month if it is unchanged and to record it otherwise.
+    force: process the month even if the manifest has it as unchanged.
+  Returns: returns a dict with the year, month, object name, number of rows, bytes downloaded, of CSV text and
+           uploaded, and seconds taken. A month skipped as unchanged has "skipped" set instead of the numbers of bytes.
+  '''
+  if outputFormat not in formats: raise ValueError('Unknown output format '+str(outputFormat))
+  start=time.perf_counter()
+  url=urlTemplate.format(year=year, month=month)
+  name=objectName(year, month, folder, outputFormat)
+  session=session if session is not None else createSession()
+  source=None
+  if manifest is not None:
+    with session.head(url, timeout=downloadTimeout, allow_redirects=True) as head:
+      source=btsManifest.sourceVersion(head.headers) if head.ok else {}
+    entry=None if force else manifest.isCurrent(year, month, source, name)
+    if entry is not None:
+      logs.debug(_logger, 'Skipping %d/%d, unchanged since %s.', month, year, entry['stored'])
+      return {'year':year, 'month':month, 'object':'gs://'+bucket+'/'+name, 'rows':entry['rows'], 'skipped':True,
+              'seconds':round(time.perf_counter()-start, 3)}
+  with session.get(url, stream=True, timeout=downloadTimeout) as response:
+    response.raise_for_status()
+    download=_Chunks(response.iter_content(chunk_size=chunkSize))
+    members=streamZipMembers(iter(download.next, b''), accept=lambda memberName:memberName.lower().endswith('.csv'))
+    data=(data for _, data in members)
+    blob=getStorageClient().bucket(bucket).blob(name)
+    contentType=btsParquet.contentType if outputFormat=='parquet' else 'application/gzip'
+    # Leaving the block with an exception cancels the upload instead of storing part of the month.
+    with blob.open('wb', chunk_size=uploadChunkSize, content_type=contentType, ignore_flush=True) as upload:
+      counter=_CountingWriter(upload)
+      if outputFormat=='parquet':
+        numRows, numCSVBytes=btsParquet.writeMonth(data, counter)
+      else:
+        numRows, numCSVBytes=_writeCSV(data, counter, name, compressLevel)
+      if numCSVBytes==0: raise ValueError('No CSV data was found in '+url)
+  if manifest is not None: manifest.record(year, month, source, blob, numRows, outputFormat)
+  metrics.rowsFetched.labels('btsETL').inc(numRows)
+  metrics.uploadBytes.labels(bucket).inc(counter.numBytes)
+  return {'year':year, 'month':month, 'object':'gs://'+bucket+'/'+name, 'rows':numRows,
+          'downloadedBytes':download.numBytes, 'csvBytes':numCSVBytes, 'uploadedBytes':counter.numBytes,
+          'seconds':round(time.perf_counter()-start, 3)}
+
+def _timedMonth(year, month, bucket, folder, session, compressLevel, outputFormat, manifest, force):
+  with timing.span('month') as processing:
+    result=processMonth(year, month, bucket, folder=folder, session=session, compressLevel=compressLevel,
+                        outputFormat=outputFormat, manifest=manifest, force=force)
+    processing.items=0 if result.get('skipped', False) else result['rows']
+  return result
+
+def run(months, bucket, folder=None, workers=defaultWorkers, compressLevel=defaultCompressLevel, verify=False,
+        session=None, outputFormat='csv', force=False):
+  '''
+  Process months concurrently, skipping those the manifest of the folder has as unchanged.
+  Args:
+    months: a list of (year, month), such as from monthRange().
+    bucket, folder, compressLevel, outputFormat, force: see processMonth.
+    workers: number of months processed at the same time.
+    verify: verify the certificate of the BTS server.
+    session: a session to download with instead of a new one from createSession().
+  Returns: returns a list with the result of each month (see processMonth), in the order of months. Months that failed
+           have an "error" instead.
+  '''
+  if outputFormat not in formats: raise ValueError('Unknown output format '+str(outputFormat))
+  session=session if session is not None else createSession(verify=verify, poolSize=workers)
+  results={}
+  with timing.invocation('btsETL', _logger):
+    manifest=btsManifest.Manifest(getStorageClient().bucket(bucket), folderOf(folder, outputFormat))
+    try:
+      with ThreadPoolExecutor(max_workers=max(1, min(workers, len(months)))) as executor:
+        futures={executor.submit(_timedMonth, year, month, bucket, folder, session, compressLevel, outputFormat,
+                                 manifest, force):(year, month)
+                 for year, month in months}
+        for future in as_completed(futures):
+          year, month=futures[future]
+          try:
+            result=results[(year, month)]=future.result()
+            if result.get('skipped', False): continue
+            logs.info(_logger, 'Stored %d rows of %d/%d in %s (%d bytes downloaded, %d uploaded) in %.1f seconds.',
+                      result['rows'], month, year, result['object'], result['downloadedBytes'],
+                      result['uploadedBytes'], result['seconds'])
+          except Exception as ex:
+            _logger.error('Cannot prepare the data for '+str(month)+'/'+str(year), exc_info=True, stack_info=True)
+            results[(year, month)]={'year':year, 'month':month, 'error':str(ex)}
+    finally:
+      # Also when interrupted, so that the months already stored are not fetched again.
+      try:
+        manifest.save()
+      except:
+        _logger.error('Cannot save the manifest gs://'+bucket+'/'+manifest.name, exc_info=True, stack_info=True)
+  numSkipped=sum(1 for result in results.values() if result.get('skipped', False))
+  if numSkipped: logs.info(_logger, 'Skipped %d unchanged months.', numSkipped)
+  return [results[month] for month in months]
+
+if __name__=='__main__':
+  parser=argparse.ArgumentParser(description='Download the BTS On-Time Performance data of a range of months, clean it '
+                                             'and store it in GCS as gzip-compressed CSV or Parquet files.')
+  parser.add_argument('-start', default='1-2019', help='First month, as month-year or a year. Defaults to 1-2019.')
+  parser.add_argument('-end', default='4-2022', help='Last month, as month-year or a year. Defaults to 4-2022.')
+  parser.add_argument('-bucket', default=os.environ.get('GOOGLE_CLOUD_PROJECT', 'no_project')+'_data',
+                      help='The bucket to store the data in. Defaults to ${GOOGLE_CLOUD_PROJECT}_data.')
+  parser.add_argument('-folder', default=None,
+                      help='The folder within the bucket. Defaults to '+defaultFolder+' for CSV files and '+
+                           btsParquet.defaultFolder+' for Parquet files.')
+  parser.add_argument('-format', default='csv', choices=formats,
+                      help='Store gzip-compressed CSV files, or Parquet files partitioned by year and month.')
+  parser.add_argument('-workers', default=defaultWorkers, type=int, help='Number of months processed at the same time.')
+  parser.add_argument('-compressLevel', default=defaultCompressLevel, type=int,
+                      help='gzip level of CSV files, from 1 to 9.')
+  parser.add_argument('-verify', action='store_true', help='Verify the certificate of the BTS server.')
+  parser.add_argument('-force', action='store_true',
+                      help='Process every month again, even those that have not changed since they were stored.')
+  parser.add_argument('-log', action='store_true', help='Print out debug statements.')
+  args=parser.parse_args()
+  logging.getLogger().setLevel(logging.DEBUG if args.log else logging.INFO)
+
+  results=run(monthRange(parseMonth(args.start), parseMonth(args.end, end=True)), args.bucket, folder=args.folder,
+              workers=args.workers, compressLevel=args.compressLevel, verify=args.verify, outputFormat=args.format,
+              force=args.force)
+  failed=[result for result in results if 'error' in result]
+  numSkipped=sum(1 for result in results if result.get('skipped', False))
+  print('Stored {num:d} months in gs://{bucket}/{folder}; {numSkipped:d} were unchanged, {numFailed:d} failed.'.format(
+    num=len(results)-len(failed)-numSkipped, bucket=args.bucket, folder=folderOf(args.folder, args.format),
+    numSkipped=numSkipped, numFailed=len(failed)))
+  for result in failed:
+    print('  {month:d}/{year:d}: {error}'.format(**result))
+  if failed: raise SystemExit(1)
@@ -0,0 +1,124 @@
+# The manifest of the months flight.batch.btsETL has stored in a folder, so that a later run skips the months whose BTS
+# file has not changed since and whose object is still in the bucket as it was written. It is a JSON object in the
+# folder, gs://{bucket}/{folder}/_manifest.json, with an entry per month:
+#   "2024-1": {"source": {"etag": ..., "lastModified": ..., "size": ...},  <- the headers of the BTS file
+#              "object": "data/flightsETL/2024-1.csv.gz", "crc32c": ..., "size": ..., "generation": ...,  <- the object
+#              "rows": 547271, "format": "csv", "stored": "2024-05-01T10:00:00Z"}
+# A month is processed again when its BTS file reports a different ETag, Last-Modified or size, when the server gives
+# none of them, or when the object is missing or its checksum differs from the one recorded.
+# The manifest is written once at the end of a run, only if the object has not been changed by another run in the
+# meantime (if_generation_match); if it has, the entries are merged into the newer manifest and it is written again.
+import json
+import logging
+import threading
+import time
+
+from common import lazy
+
+_logger=logging.getLogger(__name__)
+
+exceptions=lazy.module('google.api_core.exceptions')
+
+manifestName='_manifest.json'
+maxSaveAttempts=5
+
+def sourceVersion(headers):
+  '''
+  Args:
+    headers: the headers of a response for the BTS file, from a HEAD or GET request.
+  Returns: returns a dict of what identifies the version of the file, empty if the server gave nothing to tell versions
+           apart by.
+  '''
+  version={}
+  for key, header in (('etag', 'ETag'), ('lastModified', 'Last-Modified'), ('size', 'Content-Length')):
+    value=headers.get(header, None)
+    if value: version[key]=value
+  return version
+
+def _key(year, month):
+  return '{year:d}-{month:d}'.format(year=year, month=month)
+
+class Manifest(object):
+  '''
+  The entries of a folder, read from the bucket when created. Safe to use from the threads processing the months.
+  '''
+
+  def __init__(self, bucket, folder):
+    '''
+    Args:
+      bucket: a google.cloud.storage bucket.
+      folder: the folder of the objects within the bucket.
+    '''
+    self._bucket=bucket
+    self.name=(folder.strip('/')+'/' if folder else '')+manifestName
+    self._lock=threading.Lock()
+    self._updated={}
+    self._entries, self._generation=self._load()
+
+  def _load(self):
+    '''
+    Returns: returns (entries, generation of the object), or ({}, 0) if there is no manifest yet.
+    '''
+    blob=self._bucket.get_blob(self.name)
+    if blob is None: return {}, 0
+    try:
+      return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+    except exceptions.PreconditionFailed:
+      return self._load()  # Replaced while being read.
+    except ValueError:
+      _logger.error('Ignoring gs://'+self._bucket.name+'/'+self.name+', which is not valid JSON.', exc_info=True)
+      return {}, blob.generation
+
+  def get(self, year, month):
+    with self._lock:
+      return self._entries.get(_key(year, month), None)
+
+  def isCurrent(self, year, month, source, name):
+    '''
+    Args:
+      year, month: the month.
+      source: the version of the BTS file of the month now, from sourceVersion().
+      name: the name of the object the month would be stored in.
+    Returns: returns the entry of the month if the month was stored from the same version of the BTS file and the
+             object is still as it was written, otherwise None.
+    '''
+    entry=self.get(year, month)
+    if not source or entry is None or entry.get('source', None)!=source or entry.get('object', None)!=name:
+      return None
+    blob=self._bucket.get_blob(name)
+    if blob is None or blob.crc32c!=entry.get('crc32c', None): return None
+    return entry
+
+  def record(self, year, month, source, blob, rows, outputFormat):
+    '''
+    Record a month just stored in blob, which is reloaded for its checksum, size and generation.
+    '''
+    blob.reload()
+    entry={'source':source, 'object':blob.name, 'crc32c':blob.crc32c, 'size':blob.size, 'generation':blob.generation,
+           'rows':rows, 'format':outputFormat, 'stored':time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    with self._lock:
+      self._entries[_key(year, month)]=entry
+      self._updated[_key(year, month)]=entry
+    return entry
+
+  def save(self):
+    '''
+    Write the manifest, if a month has been recorded since it was read.
+    Returns: returns True if it was written.
+    '''
+    with self._lock:
+      if not self._updated: return False
+      for attempt in range(maxSaveAttempts):
+        try:
+          blob=self._bucket.blob(self.name)
+          blob.upload_from_string(json.dumps(self._entries, indent=1, sort_keys=True), content_type='application/json',
+                                  if_generation_match=self._generation)
+          self._generation=blob.generation
+          self._updated={}
+          return True
+        except exceptions.PreconditionFailed:
+          _logger.info('gs://'+self._bucket.name+'/'+self.name+' was changed by another run; merging.')
+          self._entries, self._generation=self._load()
+          self._entries.update(self._updated)
+      raise RuntimeError('Cannot save gs://'+self._bucket.name+'/'+self.name+' after '+str(maxSaveAttempts)+
+                         ' attempts.')
@@ -0,0 +1,142 @@
+# Parquet output of the BTS On-Time Performance data for flight.batch.btsETL (-format parquet), in place of the cleaned
+# gzip-compressed CSV files. The columns have the types defined once below rather than being inferred from the text of
+# every month by every load or query, and each month is stored as
+#   gs://{bucket}/{folder}/year={year}/month={month}/flights.parquet
+# so that BigQuery loads or queries the folder with hive partitioning and reads only the months and columns a query
+# uses. Year and Month are the partition keys and are not repeated in the files. Columns with few distinct values, such
+# as airports, carriers and time blocks, are dictionary encoded.
+# The CSV text is parsed by pyarrow as it is inflated, quotes included, so city names such as "New York, NY" stay in
+# one column. Columns that a month does not have are null; columns not defined below are dropped, with a warning.
+# pyarrow is only needed for this format, and is imported on first use.
+import csv
+import io
+import logging
+
+from common import lazy, logs
+
+_logger=logging.getLogger(__name__)
+
+pa=lazy.module('pyarrow')
+pacsv=lazy.module('pyarrow.csv')
+pq=lazy.module('pyarrow.parquet')
+
+defaultFolder='data/flightsParquet'
+defaultCompression='zstd'
+contentType='application/vnd.apache.parquet'
+partitionColumns=('Year', 'Month')
+rowGroupSize=256*1024  # Rows per row group; about 2 to 4 row groups per month.
+blockSize=4*1024*1024  # Bytes of CSV text parsed at a time.
+
+# The columns, in the order of the BTS files, and their types:
+#   int16, int32, float32: numbers. Times of day (hhmm), such as DepTime, are int16. Delays, durations, distances and
+#     flags such as Cancelled are written with decimals (5.00) and are float32.
+#   date: FlightDate, as yyyy-mm-dd.
+#   category: text with few distinct values, dictionary encoded.
+columns=[
+  ('Year', 'int16'), ('Quarter', 'int16'), ('Month', 'int16'), ('DayofMonth', 'int16'), ('DayOfWeek', 'int16'),
+  ('FlightDate', 'date'),
+  ('Reporting_Airline', 'category'), ('DOT_ID_Reporting_Airline', 'int32'), ('IATA_CODE_Reporting_Airline', 'category'),
+  ('Tail_Number', 'category'), ('Flight_Number_Reporting_Airline', 'int32'),
+  ('OriginAirportID', 'int32'), ('OriginAirportSeqID', 'int32'), ('OriginCityMarketID', 'int32'),
+  ('Origin', 'category'), ('OriginCityName', 'category'), ('OriginState', 'category'), ('OriginStateFips', 'category'),
+  ('OriginStateName', 'category'), ('OriginWac', 'int16'),
+  ('DestAirportID', 'int32'), ('DestAirportSeqID', 'int32'), ('DestCityMarketID', 'int32'),
+  ('Dest', 'category'), ('DestCityName', 'category'), ('DestState', 'category'), ('DestStateFips', 'category'),
+  ('DestStateName', 'category'), ('DestWac', 'int16'),
+  ('CRSDepTime', 'int16'), ('DepTime', 'int16'), ('DepDelay', 'float32'), ('DepDelayMinutes', 'float32'),
+  ('DepDel15', 'float32'), ('DepartureDelayGroups', 'int16'), ('DepTimeBlk', 'category'),
+  ('TaxiOut', 'float32'), ('WheelsOff', 'int16'), ('WheelsOn', 'int16'), ('TaxiIn', 'float32'),
+  ('CRSArrTime', 'int16'), ('ArrTime', 'int16'), ('ArrDelay', 'float32'), ('ArrDelayMinutes', 'float32'),
+  ('ArrDel15', 'float32'), ('ArrivalDelayGroups', 'int16'), ('ArrTimeBlk', 'category'),
+  ('Cancelled', 'float32'), ('CancellationCode', 'category'), ('Diverted', 'float32'),
+  ('CRSElapsedTime', 'float32'), ('ActualElapsedTime', 'float32'), ('AirTime', 'float32'), ('Flights', 'float32'),
+  ('Distance', 'float32'), ('DistanceGroup', 'int16'),
+  ('CarrierDelay', 'float32'), ('WeatherDelay', 'float32'), ('NASDelay', 'float32'), ('SecurityDelay', 'float32'),
+  ('LateAircraftDelay', 'float32'),
+  ('FirstDepTime', 'int16'), ('TotalAddGTime', 'float32'), ('LongestAddGTime', 'float32'),
+  ('DivAirportLandings', 'int16'), ('DivReachedDest', 'float32'), ('DivActualElapsedTime', 'float32'),
+  ('DivArrDelay', 'float32'), ('DivDistance', 'float32')]
+for _num in range(1, 6):
+  columns+=[('Div{num:d}Airport'.format(num=_num), 'category'), ('Div{num:d}AirportID'.format(num=_num), 'int32'),
+            ('Div{num:d}AirportSeqID'.format(num=_num), 'int32'), ('Div{num:d}WheelsOn'.format(num=_num), 'int16'),
+            ('Div{num:d}TotalGTime'.format(num=_num), 'float32'),
+            ('Div{num:d}LongestGTime'.format(num=_num), 'float32'),
+            ('Div{num:d}WheelsOff'.format(num=_num), 'int16'), ('Div{num:d}TailNum'.format(num=_num), 'category')]
+
+def _arrowType(kind):
+  if kind=='category': return pa.dictionary(pa.int32(), pa.string())
+  if kind=='date': return pa.date32()
+  return getattr(pa, kind)()
+
+def schema():
+  '''
+  Returns: returns the pyarrow schema of the files: the columns without the partition columns.
+  '''
+  return pa.schema([(name, _arrowType(kind)) for name, kind in columns if name not in partitionColumns])
+
+def objectName(year, month, folder=defaultFolder):
+  return (folder.strip('/')+'/' if folder else '')+'year={year:d}/month={month:d}/flights.parquet'.format(year=year,
+                                                                                                         month=month)
+
+class _ChunkReader(io.RawIOBase):
+  '''
+  A file to read from an iterable of bytes, counting them.
+  '''
+
+  def __init__(self, chunks):
+    self._chunks=iter(chunks)
+    self._pending=b''
+    self.numBytes=0
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    while not self._pending:
+      self._pending=next(self._chunks, None)
+      if self._pending is None:
+        self._pending=b''
+        return 0
+      self.numBytes+=len(self._pending)
+    size=min(len(buffer), len(self._pending))
+    buffer[:size]=self._pending[:size]
+    self._pending=self._pending[size:]
+    return size
+
+def writeMonth(chunks, output, compression=defaultCompression):
+  '''
+  Convert the CSV text of a month to Parquet.
+  Args:
+    chunks: an iterable of the bytes of the CSV file as downloaded, header included.
+    output: a file object to write the Parquet file to. It is written once, from start to end, and not closed.
+    compression: the compression of the Parquet pages, such as "zstd" or "snappy".
+  Returns: returns (number of rows, bytes of CSV text read).
+  '''
+  raw=_ChunkReader(chunks)
+  text=io.BufferedReader(raw, buffer_size=blockSize)
+  header=next(csv.reader([text.readline().decode('utf-8')]), [])
+  if not header: return 0, raw.numBytes
+  fileSchema=schema()
+  unknown=[name for name in header if name and name not in fileSchema.names and name not in partitionColumns]
+  if unknown: logs.warning(_logger, 'Dropping columns that have no defined type: %s', unknown)
+  reader=pacsv.open_csv(text,
+                        read_options=pacsv.ReadOptions(column_names=header, block_size=blockSize),
+                        convert_options=pacsv.ConvertOptions(column_types=fileSchema, include_columns=fileSchema.names,
+                                                             include_missing_columns=True))
+  dictionaryColumns=[name for name, kind in columns if kind=='category']
+  numRows=0
+  with pq.ParquetWriter(output, fileSchema, compression=compression, use_dictionary=dictionaryColumns) as writer:
+    batches=[]
+    numPending=0
+    for batch in reader:
+      batches.append(batch)
+      numPending+=batch.num_rows
+      if numPending>=rowGroupSize:
+        writer.write_table(pa.Table.from_batches(batches, schema=fileSchema), row_group_size=rowGroupSize)
+        numRows+=numPending
+        batches=[]
+        numPending=0
+    if batches:
+      writer.write_table(pa.Table.from_batches(batches, schema=fileSchema), row_group_size=rowGroupSize)
+      numRows+=numPending
+  return numRows, raw.numBytes
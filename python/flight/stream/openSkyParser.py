@@ -7,6 +7,7 @@
 #   path: path within the bucket to process the data in (defaults to "flights_streaming".)
 #   separateLines: will create a separate file/message for each record instead of a file/message
 #                  for all records returned from the API call if this flag is present.
+#   profile: profiles the invocation and writes the results to the bucket (see common.profiling).
 #
 # You can test out this code from the command-line:
 #   (Make sure to set your PYTHONPATH to include the code, such as the following for a LINUX system, such as from Cloud Shell:
@@ -44,18 +45,20 @@ from argparse import ArgumentParser
 import json
 import logging
 
-from google.cloud import storage
 import datetime
 
-from google.cloud.pubsub_v1 import PublisherClient
-from google.oauth2 import service_account
-
+from common import lazy, logs, metrics, profiling, timing
 from flight.stream.opensky_api import OpenSkyApi
 
 logging.basicConfig(format='%(asctime)s.%(msecs)03dZ,%(pathname)s:%(lineno)d,%(levelname)s,%(module)s,%(funcName)s: %(message)s',
                     datefmt="%Y-%m-%d %H:%M:%S")
 _logger = logging.getLogger(__name__)
 
+# Imported when first used, so that a cold start does not load clients and libraries the invocation does not need.
+storage=lazy.module('google.cloud.storage')
+pubsub_v1=lazy.module('google.cloud.pubsub_v1')
+service_account=lazy.module('google.oauth2.service_account')
+
 numTries=5 # Number of times to try to get data from OpenSky.
 defaultLimit=30
 
@@ -99,7 +102,7 @@ def _getMessageJSON(request):
   message = None
 
   if request.args is not None:
-    _logger.debug('request is ' + str(request) + ' with args ' + str(request.args))
+    logs.debug(_logger, 'request is %s with args %s', request, request.args)
     if 'message' in request.args: message = request.args.get('message')
 
     if any(map(lambda param:param in request.args,['bucket','path','topic','projectId'])):
@@ -107,14 +110,14 @@ def _getMessageJSON(request):
       message = request.args
   if message is None and request_json is not None:
     # If message remains unset (None) then assuming that the request_json holds the contents of the message we are looking for.
-    _logger.debug('request_json is ' + str(request_json))
+    logs.debug(_logger, 'request_json is %s', request_json)
     if 'message' in request_json:
       message = request_json['message']
     else:
       message = request_json
   
   if message is None:
-    _logger.warning('message is empty. request=' + str(request) + ' request_json=' + str(request_json))
+    logs.warning(_logger, 'message is empty. request=%s request_json=%s', request, request_json)
     message = '{}'
   
   if type(message) == str:
@@ -130,7 +133,7 @@ def _getMessageJSON(request):
   else:
     # Else, assuming messageJSON was decoded from a JSON object.
     messageJSON = message
-  return messageJSON
+  return profiling.start(messageJSON)
 
 class Storage(object):
   '''
@@ -168,18 +171,21 @@ class Storage(object):
     '''
     rows = map(lambda row: json.dumps(row), data)
     if self._separateLines:
-      _logger.debug(json.dumps({'log': 'Storing as separate files within {path}.'.format(path=self._path)}))
+      logs.debug(_logger, logs.structured('Storing as separate files within %s.', self._path))
       for row in rows:
         fullpath=self._path + '/' + self._createFileName()
         try:
           self._client.blob(fullpath).upload_from_string(row)
+          metrics.uploadBytes.labels(self._bucket).inc(len(row))
         except Exception as ex:
-          _logger.error('Error writing to {path}'.format(path=fullpath),exc_info=True,stack_info=True)
+          logs.error(_logger, 'Error writing to %s', fullpath, perSecond=1, exc_info=True, stack_info=True)
     else:
       fullpath=self._path + '/' + self._createFileName()
-      _logger.debug('Storing in file {path}.'.format(path=self._path + '/' + self._createFileName()))
+      logs.debug(_logger, 'Storing in file %s.', fullpath)
       try:
-        self._client.blob(fullpath).upload_from_string('\n'.join(rows))
+        contents='\n'.join(rows)
+        self._client.blob(fullpath).upload_from_string(contents)
+        metrics.uploadBytes.labels(self._bucket).inc(len(contents))
       except Exception as ex:
         _logger.error('Error writing to {path}'.format(path=fullpath),exc_info=True,stack_info=True)
 
@@ -200,11 +206,11 @@ class Publish(object):
   def __init__(self, projectId, topic, separateLines=False, credentials=None):
     self._topicPath='projects/{project}/topics/{topic}'.format(project=projectId,topic=topic)
     if credentials is not None:
-      self._publisher=PublisherClient(
+      self._publisher=pubsub_v1.PublisherClient(
         credentials=service_account.Credentials.from_service_account_info(credentials)
       )
     else:
-      self._publisher=PublisherClient()
+      self._publisher=pubsub_v1.PublisherClient()
     self._separateLines = separateLines
   
   def process(self, data):
@@ -218,23 +224,26 @@ class Publish(object):
       for row in rows:
         key=self._createKey()
         try:
-          # Very verbose logging: _logger.debug('Publishing: '+row)
-          futures.append(self._publisher.publish(self._topicPath, data=row.encode('utf-8'), query=key))
+          logs.debug(_logger, 'Publishing: %s', row, every=100)  # Sampled, as it would be very verbose.
+          futures.append(metrics.trackPublish(self._publisher.publish(self._topicPath, data=row.encode('utf-8'), query=key),
+                                              self._topicPath))
         except:
-          _logger.error('Error publishing {key} to {topic}'.format(key=key,topic=self._topicPath),exc_info=True,stack_info=True)
+          logs.error(_logger, 'Error publishing %s to %s', key, self._topicPath, perSecond=1, exc_info=True,
+                     stack_info=True)
       numMessagesPublished=0
       for index,futurePublish in enumerate(futures):
         try:
-          # Very verbose logging: _logger.debug('Published message ID: '+str(futurePublish.result()))
-          futurePublish.result()
+          messageId=futurePublish.result()
+          logs.debug(_logger, 'Published message ID: %s', messageId, every=100)
           numMessagesPublished+=1
         except:
-          _logger.error('Error while publishing message #'+str(index),exc_info=True,stack_info=True)
-      _logger.debug('Published '+str(numMessagesPublished)+' messages.')
+          logs.error(_logger, 'Error while publishing message #%d', index, perSecond=1, exc_info=True, stack_info=True)
+      logs.debug(_logger, 'Published %d messages.', numMessagesPublished)
     else:
       key=self._createKey()
       try:
-        self._publisher.publish(self._topicPath, data=('\n'.join(rows)).encode('utf-8'), query=self._createKey())
+        metrics.trackPublish(self._publisher.publish(self._topicPath, data=('\n'.join(rows)).encode('utf-8'),
+                                                     query=self._createKey()), self._topicPath)
       except:
         _logger.error('Error publishing {key} to {topic}'.format(key=key, topic=self._topicPath),exc_info=True,stack_info=True)
 
@@ -312,7 +321,8 @@ def _getLatestFlightData():
   for trial in range(numTries):
     try:
       _logger.debug('Requesting latest flights from OpenSky.')
-      flightStates = api.get_states()
+      with timing.span('fetch'):
+        flightStates = api.get_states()
       if flightStates is not None: return flightStates
     except:
       _logger.error('Failed in call to OpenSky.',exc_info=True)
@@ -336,43 +346,47 @@ def _scavengeRows(separateLines=False,
   '''
   queryTime = datetime.datetime.now().timestamp()
   if debug is not None:
-    _logger.debug(json.dumps({'log': 'Scavenging rows at {queryTime}.'.format(queryTime=str(queryTime))}))
+    logs.debug(_logger, logs.structured('Scavenging rows at %s.', queryTime))
   flightStates=_getLatestFlightData()
   numProcessed=0
   if flightStates is not None:
+    metrics.rowsFetched.labels('openSkyParser').inc(len(flightStates.states))
     records = []
-    for flightDict in map(lambda flightState: _convertRow(flightState, queryTime), flightStates.states):
-      trimmedRecord = dict(filter(lambda item: item[1] is not None, flightDict.items()))
-      if len(trimmedRecord) > 0:
-        try:
-          # If the record has at least one non-empty field, process it.
-          records.append(trimmedRecord)
-        except:
-          _logger.error('ERROR cannot process record.',exc_info=True,stack_info=True)
-      if limit is not None and len(records)>limit: break
+    with timing.span('convert') as converting:
+      for flightDict in map(lambda flightState: _convertRow(flightState, queryTime), flightStates.states):
+        trimmedRecord = dict(filter(lambda item: item[1] is not None, flightDict.items()))
+        if len(trimmedRecord) > 0:
+          try:
+            # If the record has at least one non-empty field, process it.
+            records.append(trimmedRecord)
+          except:
+            logs.error(_logger, 'ERROR cannot process record.', perSecond=1, exc_info=True, stack_info=True)
+        if limit is not None and len(records)>limit: break
+      converting.items=len(records)
     
     if len(records) > 0:
-      if debug is not None: _logger.debug(json.dumps({'log': 'Found {num:d} records to process.'.format(num=len(records))}))
+      if debug is not None: logs.debug(_logger, logs.structured('Found %d records to process.', len(records)))
       # Found records to process and/or publish.
       if bucket is not None:
         storage = Storage(bucket, folder=path, separateLines=separateLines,project=projectId,credentials=credentials)
-        storage.process(records)
+        with timing.span('store', items=len(records)):
+          storage.process(records)
         numProcessed+=len(records)
-        if debug is not None: _logger.debug(json.dumps({
-          'log': 'Stored {num:d} records in folder {path} of bucket {bucket}'.format(
-            num=len(records), path=path, bucket=bucket)}))
+        if debug is not None: logs.debug(_logger, logs.structured(
+          'Stored %d records in folder %s of bucket %s', len(records), path, bucket))
       
       if topic is not None and projectId is not None:
         publisher=Publish(projectId,topic,separateLines=separateLines,credentials=credentials)
-        publisher.process(records)
+        with timing.span('publish', items=len(records)):
+          publisher.process(records)
         numProcessed+=len(records)
-        if debug is not None: _logger.debug(json.dumps({
-          'log': 'Published {num:d} records to topic {topic}'.format(
-            num=len(records), topic=topic)}))
+        if debug is not None: logs.debug(_logger, logs.structured('Published %d records to topic %s', len(records), topic))
   else:
-    if debug is not None: _logger.debug(json.dumps({'log': 'No flight records were found.'}))
+    if debug is not None: logs.debug(_logger, logs.structured('No flight records were found.'))
   return numProcessed
 
+@profiling.profiled('openSkyParser')
+@timing.timed('openSkyParser', _logger)
 def parse(request,credentials=None):
   """Responds to any HTTP request.
   :request (flask.Request): HTTP request object, the request passed into a Cloud Function when triggered.
@@ -427,11 +441,11 @@ def parse(request,credentials=None):
       limit=None
   if limit is None: limit=defaultLimit
   
-  _logger.info(json.dumps({'log': 'Parsed message is ' + json.dumps(messageJSON)}))
+  logs.info(_logger, logs.structured('Parsed message is %s', logs.lazy(lambda: json.dumps(messageJSON))))
   if publish:
-    _logger.info(json.dumps({'log':'Will publish to projectID:{project} topic:{topic}'.format(project=projectId,topic=topic)}))
+    logs.info(_logger, logs.structured('Will publish to projectID:%s topic:%s', projectId, topic))
   if store:
-    _logger.info(json.dumps({'log':'Will store in GCS at bucket:{bucket} path:{path}'.format(bucket=bucket,path=path)}))
+    logs.info(_logger, logs.structured('Will store in GCS at bucket:%s path:%s', bucket, path))
   numProcessed=_scavengeRows(separateLines=separateLines,
                 bucket=bucket,path=path,
                 projectId=projectId,topic=topic,
@@ -30,6 +30,8 @@ from datetime import datetime
 from collections import defaultdict
 import time
 
+from common import metrics
+
 logger = logging.getLogger('opensky_api')
 logger.addHandler(logging.NullHandler())
 
@@ -129,9 +131,12 @@ class OpenSkyApi(object):
         :param func: the API function to evaluate
         """
         if len(self._auth) < 2:
-            return abs(time.time() - self._last_requests[func]) >= time_diff_noauth
+            allowed = abs(time.time() - self._last_requests[func]) >= time_diff_noauth
         else:
-            return abs(time.time() - self._last_requests[func]) >= time_diff_auth
+            allowed = abs(time.time() - self._last_requests[func]) >= time_diff_auth
+        if not allowed:
+            metrics.rateLimited.labels('opensky', func.__name__).inc()
+        return allowed
 
     @staticmethod
     def _check_lat(lat):
@@ -0,0 +1,220 @@
+# Flattens tweets into rows of tweet data.
+# The field tables of MyListener are compiled once into a dict that maps each field of a tweet to the function that
+# handles it, so each field of a tweet costs one dict lookup instead of a chain of membership tests against lists.
+# decodeTweet parses a tweet and keeps its original JSON text, which becomes the raw field of its row instead of
+# encoding the parsed tweet back into JSON.
+import json
+import logging
+import re
+from json.decoder import scanstring
+
+from common import logs
+
+_logger=logging.getLogger(__name__)
+_decoder=json.JSONDecoder()
+_whitespace=re.compile(r'[ \t\n\r]*')
+_wrappers=('tweet', 'data')  # Objects that a tweet may be wrapped in, in the order they are unwrapped.
+
+def _decodeWrapper(text, index):
+  '''
+  Decode the members of the object starting at index one at a time to find where the wrapped tweet starts and ends.
+  :return: returns (the parsed object, dict mapping each wrapper member to its JSON text).
+  '''
+  parsed={}
+  raws={}
+  index=_whitespace.match(text, index+1).end()
+  while text[index]!='}':
+    if text[index]!='"': raise json.JSONDecodeError('Expecting property name enclosed in double quotes', text, index)
+    key, index=scanstring(text, index+1)
+    index=_whitespace.match(text, index).end()
+    if text[index]!=':': raise json.JSONDecodeError("Expecting ':' delimiter", text, index)
+    start=_whitespace.match(text, index+1).end()
+    parsed[key], index=_decoder.raw_decode(text, start)
+    if key in _wrappers: raws[key]=text[start:index]
+    index=_whitespace.match(text, index).end()
+    if text[index]==',':
+      index=_whitespace.match(text, index+1).end()
+    elif text[index]!='}':
+      raise json.JSONDecodeError("Expecting ',' delimiter", text, index)
+  if _whitespace.match(text, index+1).end()!=len(text): raise json.JSONDecodeError('Extra data', text, index+1)
+  return parsed, raws
+
+def decodeTweet(payload):
+  '''
+  Parse a tweet received as JSON and keep the JSON text of the tweet, so that it does not need to be encoded again.
+  :param payload: the JSON bytes or string of one tweet, optionally wrapped in a "tweet" or "data" object, as sent by
+                  the stream.
+  :return: returns (the parsed payload, the JSON text of the tweet within the payload or None if it is not known).
+  '''
+  text=payload.decode('utf-8') if type(payload)==bytes else payload
+  start=_whitespace.match(text).end()
+  if text.startswith('{"data"', start) or text.startswith('{"tweet"', start):
+    try:
+      parsed, raws=_decodeWrapper(text, start)
+      for wrapper in _wrappers:
+        if wrapper in parsed:
+          tweet=parsed[wrapper]
+          nested=type(tweet)==dict and any(nestedWrapper in tweet for nestedWrapper in _wrappers)
+          return parsed, (None if nested else raws[wrapper])
+    except (ValueError, IndexError):
+      pass  # json.loads reports the error.
+  parsed=json.loads(text)
+  if type(parsed)==dict and any(wrapper in parsed for wrapper in _wrappers): return parsed, None
+  return parsed, text.strip()
+
+class TweetFlattener(object):
+  '''
+  Produces the same rows as MyListener.extractTweet did field by field. Build one with the field tables and reuse it for
+  every tweet.
+  '''
+  
+  def __init__(self, tweetFields, tweetReferences, objectFields, coordinateFields, multivalueFields,
+               singleReferences=('user', 'retweeted_status')):
+    '''
+    :param tweetFields: fields copied as is.
+    :param tweetReferences: maps each field that references other entities to the field of the entity to extract.
+    :param objectFields: maps each field with an object value to the inner fields to pull out of the object.
+    :param coordinateFields: maps each coordinate field to the names of its components, in order.
+    :param multivalueFields: fields that are set to an empty list when missing, since BigQuery REPEATED fields cannot be
+                             null.
+    :param singleReferences: reference fields that hold only one entity.
+    '''
+    self._multivalueFields=tuple(multivalueFields)
+    self._referenceFields=dict(tweetReferences)
+    dispatch={'entities':self._extractEntities}
+    # Later tables take precedence, so the order follows the precedence of the checks in extractTweet, reversed.
+    for field in coordinateFields:
+      dispatch[field]=self._coordinateHandler(tuple(coordinateFields[field]))
+    for field in objectFields:
+      dispatch[field]=self._objectHandler(field, tuple(objectFields[field]))
+    for field, subfield in tweetReferences.items():
+      dispatch[field]=self._referencesHandler(subfield)
+    for field in singleReferences:
+      dispatch[field]=self._referenceHandler(tweetReferences.get(field, None))
+    for field in frozenset(tweetFields):
+      dispatch[field]=self._copy
+    self._dispatch=dispatch
+  
+  @staticmethod
+  def _copy(row, field, value):
+    row[field]=value
+  
+  @staticmethod
+  def _references(subfield, element, entities):
+    '''
+    Append the subfield of every entity in element, which is an entity or a list of (lists of) entities, to entities.
+    '''
+    if type(element)==dict:
+      if subfield in element: entities.append(element[subfield])
+    elif type(element)==list:
+      for subelement in element:
+        TweetFlattener._references(subfield, subelement, entities)
+    return entities
+  
+  def _referenceHandler(self, subfield):
+    references=self._references
+    def handle(row, field, value):
+      if subfield is None: return
+      entities=references(subfield, value, [])
+      if len(entities)>0: row[field]=entities[0]
+    return handle
+  
+  def _referencesHandler(self, subfield):
+    references=self._references
+    def handle(row, field, value):
+      entities=references(subfield, value, [])
+      if len(entities)>0: row[field]=entities
+    return handle
+  
+  @staticmethod
+  def _objectHandler(field, innerFields):
+    names=tuple((innerField, field+'_'+innerField) for innerField in innerFields)
+    def handle(row, field, value):
+      for innerField, name in names:
+        if innerField in value: row[name]=value[innerField]
+    return handle
+  
+  @staticmethod
+  def _coordinateHandler(names):
+    def handle(row, field, value):
+      # All coordinate fields have a property named "coordinates".
+      coordinates=value.get('coordinates', None) if type(value)==dict else None
+      if coordinates is not None and len(coordinates)==len(names):
+        row.update(zip(names, coordinates))
+    return handle
+  
+  def _extractEntities(self, row, field, value):
+    referenceFields=self._referenceFields
+    references=self._references
+    for entityType, entity in value.items():
+      subfield=referenceFields.get(entityType, None)
+      if subfield is not None:
+        entities=references(subfield, entity, [])
+        if len(entities)>0: row[entityType]=entities
+  
+  @staticmethod
+  def _unwrap(tweet):
+    '''
+    :return: returns the tweet without the "tweet" and "data" objects that it may be wrapped in.
+    '''
+    if type(tweet) in [bytes, str]: tweet=json.loads(tweet)
+    while True:
+      if 'tweet' in tweet:
+        tweet=tweet['tweet']
+      elif 'data' in tweet:
+        tweet=tweet['data']
+      else:
+        return tweet
+  
+  def _flatten(self, tweet, query, delim, rows, raw=None):
+    tweet=self._unwrap(tweet)
+    dispatch=self._dispatch
+    row={}
+    for field, value in tweet.items():
+      if value is None: continue
+      handle=dispatch.get(field, None)
+      if handle is not None: handle(row, field, value)
+      if field=='retweeted_status':
+        try:
+          self._flatten(value, query, delim, rows)  # The retweeted tweet goes before the retweet.
+        except:
+          logs.error(_logger, 'SKIPPING Cannot parse nested tweet %s', value, perSecond=1, exc_info=True,
+                     stack_info=True)
+    row['query']=query
+    if delim is None:
+      for multivalueField in self._multivalueFields:
+        if row.get(multivalueField, None) is None: row[multivalueField]=[]
+    row['raw']=raw if raw is not None else json.dumps(tweet)
+    if delim is not None:
+      for key, value in row.items():
+        if type(value)==list:
+          row[key]=delim.join(map(str, value))  # Convert arrays to delimited string.
+        elif type(value)==dict:
+          row[key]=json.dumps(value)  # Convert objects to a JSON string.
+    rows.append(row)
+    return rows
+  
+  def flatten(self, tweet, query, delim=None, raw=None):
+    '''
+    :param tweet: a dict or the JSON bytes or string of one tweet, optionally wrapped in a "tweet" or "data" object.
+    :param query: query that the tweet is a search result for.
+    :param delim: if given, lists are joined into strings with delim and objects are converted into JSON strings.
+    :param raw: the JSON text of the (unwrapped) tweet if it is given as a dict, as returned by decodeTweet.
+    :return: returns a list with a row for the retweeted tweet, if there is one, followed by the row for the tweet.
+    '''
+    if type(tweet) in [bytes, str]: tweet, raw=decodeTweet(tweet)
+    return self._flatten(tweet, query, delim, [], raw=raw)
+  
+  def flattenAll(self, tweets, query, delim=None):
+    '''
+    :param tweets: an iterable of tweets (see flatten).
+    :return: returns the rows of all the tweets in one list. Tweets that cannot be flattened are logged and skipped.
+    '''
+    rows=[]
+    for tweet in tweets:
+      try:
+        rows.extend(self.flatten(tweet, query, delim=delim))
+      except:
+        logs.error(_logger, 'SKIPPING Cannot parse tweet %s', logs.truncated(tweet, 1000), perSecond=1, exc_info=True,
+                   stack_info=True)
+    return rows
@@ -18,16 +18,19 @@
 #     This example will search for 25 twitters mentioning olympics and "swim-dive set" and will write the filtered tweets to mgmt59000_twitter_tweets
 #     and any twitter users who wrote the tweets have metadata written to mgmt59000_twitter_users.
 import argparse
-import datetime
 import json
 import logging
 import re
+import threading
 import time
 
 import tweepy
-from google.cloud import storage
-from google.cloud.exceptions import Forbidden
-from google.cloud.pubsub_v1 import PublisherClient
+
+from common import logs, metrics, profiling, timing
+from common.cache import LRUCache
+from common.sinks import BackgroundWriter, BatchPublisher, JsonlWriter, toAttributes
+from common.workQueue import WorkQueue
+from twitter.tweetFlattener import TweetFlattener, decodeTweet
 
 logging.basicConfig(
   format='%(asctime)s.%(msecs)03dZ,%(pathname)s:%(lineno)d,%(levelname)s,%(module)s,%(funcName)s: %(message)s',
@@ -63,13 +66,13 @@ def _getMessageJSON(request):
   request_json=request.get_json(force=True)
   message=None
   if request.args is not None:
-    _logger.info('request is '+str(request)+' with args '+str(request.args))
+    logs.info(_logger, 'request is %s with args %s', request, request.args)
     if 'message' in request.args:
       message=request.args.get('message')
     elif 'query' in request.args:
       message=request.args
   if message is None and request_json is not None:
-    _logger.debug('request_json is '+str(request_json))
+    logs.debug(_logger, 'request_json is %s', request_json)
     if 'message' in request_json:
       message=request_json['message']
     elif 'query' in request_json:
@@ -86,7 +89,7 @@ def _getMessageJSON(request):
       messageJSON={"query":[message]}
   else:
     messageJSON=message
-  return messageJSON
+  return profiling.start(messageJSON)
 
 class MyListener(tweepy.StreamingClient):
   """Custom StreamListener for streaming data."""
@@ -127,155 +130,116 @@ class MyListener(tweepy.StreamingClient):
   _userFields=["id", "id_str", "name", "screen_name", "location", "description", "followers_count", "friends_count",
                "listed_count", "favourites_count", "statuses_count", "created_at", "following", "follow_request_sent",
                "notifications"]
+  _userFieldSet=frozenset(_userFields)
+  # Fields of a user that can change over time, such as the counters. A user is output again when one of them changes.
+  _mutableUserFields=tuple(field for field in _userFields if field not in ['id', 'id_str', 'created_at'])
   # _multivalueTweetFields are fields that potentially have more than one value.
   _multivalueTweetFields=["hashtags", "user_mentions", "symbols", "extended_tweet"]
+  # The tables above compiled into one dispatch table, which extractTweet uses to flatten tweets in a single pass.
+  _flattener=TweetFlattener(_tweetFields, _tweetReferences, _objectFields, _coordinateFields, _multivalueTweetFields)
   
   @classmethod
-  def extractFromObject(cls, field, objectValue):
+  def extractTweet(cls, tweet, query, delim=None, raw=None):
     '''
-    Extract the list of inner fields in cls._objectFields for the given field.
-    :param field: the field that has an object value.
-    :param objectValue: the actual value found in a tweet.
-    :return: the list of values for the inner fields.
+    Will process a single tweet and produce one or more records of tweet data. A single tweet may reference a tweet that it is retweeting, in which case this method returns both as tweet data records.
+    :param tweet: the JSON from twitter representing one tweet.
+    :param query: query that the tweet is a search result for.
+    :param raw: the original JSON text of the tweet when tweet has already been parsed (see tweetFlattener.decodeTweet).
+    :return: returns one or more records of tweet data.
     '''
-    extractions=[]
-    if objectValue is not None:
-      extractions.extend(filter(lambda item:item is not None,
-                                map(lambda objectField:
-                                    (field+'_'+objectField,
-                                     objectValue[objectField]) if objectField in objectValue else None,
-                                    cls._objectFields.get(field, []))
-                                ))
-    return extractions
-  
-  @classmethod
-  def extractExactLocation(cls, field, coordinates):
-    if coordinates is not None and field in cls._coordinateFields and len(cls._coordinateFields[field])==len(
-        coordinates):
-      return list(zip(cls._coordinateFields[field], coordinates))
+    return cls._flattener.flatten(tweet, query, delim=delim, raw=raw)
   
   @classmethod
-  def extractReference(cls, outerField, element):
+  def extractTweets(cls, tweets, query, delim=None):
     '''
-
-    :param outerField: the field name of a nested field which holds information for entities the tweet is referencing.
-    :param element: either a dict representing one referenced entity or a list of referenced entities.
-    :return: returns a list of 0,1, or more entities referenced within element.
+    Process a batch of tweets.
+    :param tweets: a list of tweets, each as given to extractTweet.
+    :param query: query that the tweets are search results for.
+    :return: returns the records of tweet data of all the tweets. Tweets that cannot be processed are skipped.
     '''
-    entities=[]
-    if outerField in cls._tweetReferences:
-      subfield=cls._tweetReferences[outerField]
-      if type(element)==dict:
-        if subfield in element: entities.append(element[subfield])
-      elif type(element)==list:
-        for subelement in element:
-          entities.extend(cls.extractReference(outerField, subelement))
-    return entities
+    return cls._flattener.flattenAll(tweets, query, delim=delim)
   
   @classmethod
-  def _cleanTweet(cls, tweet, delim=None):
-    if delim is None: return tweet
-    cleaned={}
-    for key, value in tweet.items():
-      if type(value)==list:
-        cleaned[key]=delim.join(map(str, value))  # Convert arrays to delimited string.
-      elif type(value)==dict:
-        cleaned[key]=json.dumps(value)  # Convert objects to a JSON string.
-      else:
-        cleaned[key]=value
-    return cleaned
-  
-  @classmethod
-  def extractTweet(cls, tweet, query, delim=None):
+  def _userState(cls, user):
     '''
-    Will process a single tweet and produce one or more records of tweet data. A single tweet may reference a tweet that it is retweeting, in which case this method returns both as tweet data records.
-    :param tweet: the JSON from twitter representing one tweet.
-    :param query: query that the tweet is a search result for.
-    :return: returns one or more records of tweet data.
+    :param user: the user object of a tweet, or the record extracted from it.
+    :return: returns a hash of the fields of the user that can change.
     '''
-    if type(tweet)==bytes: return cls.extractTweet(json.loads(tweet.decode('utf-8')),query,delim=delim)
-    if 'tweet' in tweet: return cls.extractTweet(tweet['tweet'], query,delim=delim)
-    if 'data' in tweet: return cls.extractTweet(tweet['data'],query,delim=delim)
-    tweetRows=[]
-    tweetRow={}
-    for field, value in tweet.items():
-      if value is not None:
-        if field in cls._tweetFields:
-          tweetRow[field]=value
-        elif field in ['user', 'retweeted_status']:
-          # These nested elements only contain one object.
-          referencedEntities=cls.extractReference(field, value)
-          if len(referencedEntities)>0: tweetRow[field]=referencedEntities[0]
-        elif field in cls._tweetReferences:
-          # Capture potentially multiple references.
-          referencedEntities=cls.extractReference(field, value)
-          if len(referencedEntities)>0: tweetRow[field]=referencedEntities
-        elif field in cls._objectFields.keys():
-          # Flatten the field that has an object value.
-          itemsFromObject=cls.extractFromObject(field, value)
-          if len(itemsFromObject)>0: tweetRow.update(itemsFromObject)
-        elif field in cls._coordinateFields.keys():
-          # Pull out the components of the coordinates and store as separate fields.
-          if 'coordinates' in value:
-            coordinates=cls.extractExactLocation(field, value[
-              'coordinates'])  # All coordinate fields have a property named "coordinates".
-            if len(coordinates)>0: tweetRow.update(coordinates)
-        elif field=='entities':
-          # Unnest the entities object.
-          for entityType, entity in value.items():
-            # Capture each referenced entity.
-            referencedEntities=cls.extractReference(entityType, entity)
-            if len(referencedEntities)>0: tweetRow[entityType]=referencedEntities
-        
-        if field=='retweeted_status':
-          try:
-            nestedTweets=cls.extractTweet(tweet['retweeted_status'], query, delim=delim)
-            tweetRows.extend(nestedTweets)
-          except:
-            _logger.error('SKIPPING Cannot parse nested tweet '+str(tweet['retweeted_status']), exc_info=True,
-                          stack_info=True)
-    tweetRow['query']=query
-    if delim is None:
-      # Convert empty fields for the multivalue fields into empty arrays for BigQuery since REPEATED type fields cannot be null.
-      for multivalueField in MyListener._multivalueTweetFields:
-        if multivalueField not in tweetRow or tweetRow[multivalueField] is None: tweetRow[multivalueField]=[]
-    tweetRow['raw']=json.dumps(tweet)
-    tweetRows.append(cls._cleanTweet(tweetRow, delim=delim))
-    return tweetRows
+    return hash(tuple(user.get(field, None) for field in cls._mutableUserFields))
   
   @classmethod
-  def _extractUser(cls, userData):
+  def _extractUser(cls, userData, userCache=None):
+    '''
+    :param userData: the user object of a tweet.
+    :param userCache: an LRUCache of the users already output, or None to output every user.
+    :return: returns the user record, or None if the user is in userCache and has not changed.
+    '''
+    if userCache is not None and 'id' in userData and \
+        userCache.get(userData['id'], None)==cls._userState(userData): return None
     userRow={}
     for field, value in userData.items():
       if value is not None:
-        if field in cls._userFields:
+        if field in cls._userFieldSet:
           userRow[field]=value
     userRow['text']=json.dumps(userData)
     return userRow
   
   @classmethod
-  def extractUsers(cls, tweet):
-    userRows=[]
+  def _findUsers(cls, tweet):
+    '''
+    :param tweet: a tweet, or any part of a tweet, in which to find the users.
+    :return: yields the user object of each user found in the tweet.
+    '''
     if type(tweet)==dict:
-      if 'tweet' in tweet: return cls.extractUser(tweet['tweet'])
+      if 'tweet' in tweet:
+        yield from cls._findUsers(tweet['tweet'])
+        return
       for field, value in tweet.items():
         if value is not None:
           if field=='user':
-            userRows.append(cls._extractUser(value))
+            yield value
           elif type(value) in [dict, list]:
-            userRows.extend(cls.extractUsers(value))
+            yield from cls._findUsers(value)
     elif type(tweet)==list:
       for element in tweet:
-        userRows.extend(cls.extractUsers(element))
+        yield from cls._findUsers(element)
+  
+  @classmethod
+  def extractUsers(cls, tweet, userCache=None):
+    '''
+    :param tweet: a tweet, or any part of a tweet, in which to find the users.
+    :param userCache: an LRUCache of the users already output, or None to output every user every time. It is not
+                      updated; call rememberUsers once the records have been output.
+    :return: returns a record for each user found in the tweet, leaving out users in userCache that have not changed
+             and, with a userCache, users found more than once.
+    '''
+    userRows=[]
+    userIds=set()
+    for userData in cls._findUsers(tweet):
+      if userCache is not None and 'id' in userData:
+        if userData['id'] in userIds: continue
+        userIds.add(userData['id'])
+      userRow=cls._extractUser(userData, userCache=userCache)
+      if userRow is not None: userRows.append(userRow)
     return userRows
   
+  @classmethod
+  def rememberUsers(cls, userRecords, userCache):
+    '''
+    Add users that have been output to userCache, so that extractUsers leaves them out until they change.
+    :param userRecords: records returned by extractUsers.
+    :param userCache: the LRUCache given to extractUsers.
+    '''
+    for userRecord in userRecords:
+      if 'id' in userRecord: userCache.put(userRecord['id'], cls._userState(userRecord))
+  
   def __init__(self, bearer_token, projectId, query, limit, topic=None, userTopic=None, bucket=None, userBucket=None,
-               pathInBucket=None, delim=None, debug=None):
+               pathInBucket=None, delim=None, debug=None, numWorkers=4, maxQueued=1000, userCache=None):
     '''
     :param bearer_token:
     :param projectId:
     :param query:
-    :param limit:
+    :param limit: the number of tweets to receive before disconnecting.
     :param topic:
     :param userTopic:
     :param bucket:
@@ -283,138 +247,204 @@ class MyListener(tweepy.StreamingClient):
     :param pathInBucket:
     :param delim:
     :param debug:
+    :param numWorkers: number of threads that parse and output the tweets.
+    :param maxQueued: the most tweets waiting to be parsed before the stream is slowed down.
+    :param userCache: an LRUCache of the users already output to userTopic and userBucket, which maps the id of each
+                      user to a hash of the user's mutable fields (see getUserCache). None to only skip the users
+                      output by this listener.
     '''
     super().__init__(bearer_token,wait_on_rate_limit=True,return_type=dict)
     if debug is not None: _logger.setLevel(min(debug, _logger.level))
     
     self.query=query
     self.limit=limit
-    self._topic=None
-    self._userTopic=None
+    self._projectId=projectId
+    self._topic=topic
+    self._userTopic=userTopic
     
     if topic is not None:
       if projectId is None: raise Exception(
         'Must supply a project ID if you want to publish to topic "{topic}".'.format(topic=topic))
-      self._topic=('projects/'+projectId+'/topics/'+topic)
-      _logger.debug('Output to Pub/Sub: '+self._topic)
+      logs.debug(_logger, 'Output to Pub/Sub: %s', self._topic)
     
     if userTopic is not None:
       if projectId is None: raise Exception(
         'Must supply a project ID if you want to publish to topic "{topic}".'.format(topic=userTopic))
-      self._userTopic=('projects/'+projectId+'/topics/'+userTopic)
-      _logger.debug('Output user data to Pub/Sub: '+self._userTopic)
+      logs.debug(_logger, 'Output user data to Pub/Sub: %s', self._userTopic)
     
+    # Messages are published in batches and followed until they are acknowledged; close() waits for them. The
+    # publishers are created by the first worker that needs them.
     self._publisher=None
     self._userPublisher=None
+    self._publisherLock=threading.Lock()
+    # Numbers of tweet and user messages acknowledged, set by close().
+    self.numTweetsPublished=0
+    self.numUsersPublished=0
+    self._numReceived=0
+    # The stream thread only queues each tweet; the workers parse and output them.
+    self._workQueue=WorkQueue(self._handleTweet, numWorkers=numWorkers, maxQueued=maxQueued, name='tweets')
     
+    # Records are written to GCS on background threads, in gzip-compressed JSONL files that are uploaded once a minute
+    # or once they are full, so that slow uploads do not hold up the stream.
     self._path=pathInBucket
-    self._bucketClient=None
-    self._userBucketClient=None
+    self._tweetWriter=None
+    self._userWriter=None
     self._bucket=bucket
     if bucket is not None:
-      _logger.debug('Output to bucket: '+self._bucket)
+      logs.debug(_logger, 'Output to bucket: %s', self._bucket)
+      self._tweetWriter=self._createWriter(bucket)
     self._userBucket=userBucket
     if userBucket is not None:
-      _logger.debug('Output user data to bucket: '+self._userBucket)
+      logs.debug(_logger, 'Output user data to bucket: %s', self._userBucket)
+      self._userWriter=self._createWriter(userBucket)
     
     self._delim=delim
-  
-  def _writeToBucket(self, bucketClient, bucket, records):
-    key=self._createObjectKey()
-    try:
-      if bucketClient is None: bucketClient=storage.Client().bucket(bucket)
-      for record in records:
-        recordKey=key+(('_'+str(record['id'])) if 'id' in record else '')
-        bucketClient.blob(recordKey).upload_from_string(json.dumps(record))
-        _logger.debug('Wrote to '+recordKey)
-    except Forbidden as fe:
-      try:
-        _logger.error(
-          'Failed to write to GCS bucket {bucket} because access to object {objectName} is forbidden. Error code={code}, response content={response}'.format(
-            bucket=self._bucket,
-            objectName=key,
-            code=str(fe.code),
-            response=fe.response.content
-          ), exc_info=True, stack_info=True)
-      except:
-        _logger.error(
-          'Failed to write to GCS bucket {bucket} because access to object {objectName} is forbidden.'.format(
-            bucket=self._bucket,
-            objectName=key
-          ), exc_info=True, stack_info=True)
-    except:
-      _logger.error('Failed to write to GCS bucket {bucket}, object {objectName}.'.format(
-        bucket=self._bucket,
-        objectName=key
-      ), exc_info=True, stack_info=True)
-    return bucketClient
-  
-  def _createObjectKey(self):
-    key=''
-    if type(self.query)==str:
-      key+=self.query
-    else:
-      key+='_'.join(self.query)
-    key+='_'+str(datetime.datetime.now())+'.json'
-    return ('' if self._path is None else self._path+'/')+re.sub(r'[^A-Za-z0-9_.-]', '_', key)
-  
-  # tweets -- a dict representing a tweet (parsed with a JSON parser)
+    self._userCache=userCache if userCache is not None else LRUCache(maxSize=100000)
+    # Users written to userBucket without a userTopic, mapping each id to the hash of the user's mutable fields. The
+    # uploads finish in the background, so they are only added to the user cache by close() once all have succeeded.
+    self._unconfirmedUsers={}
+    self._numUsersQueued=0
+    self._userLock=threading.Lock()
+  
+  def _createWriter(self, bucket):
+    prefix=re.sub(r'[^A-Za-z0-9_.-]', '_', self.query if type(self.query)==str else '_'.join(self.query))[:64]
+    return BackgroundWriter(JsonlWriter(bucket, self._path, prefix=prefix, maxSeconds=60, uploadThreads=4))
+  
+  def close(self):
+    '''
+    Handle the tweets still queued, wait until every message has been acknowledged, and write the records still queued
+    or buffered to GCS. Sets numTweetsPublished and numUsersPublished.
+    :return: returns (number of tweets stored, number of users stored).
+    '''
+    _logger.info('Work queue: '+json.dumps(self._workQueue.close()))
+    if self._publisher is not None:
+      self.numTweetsPublished+=self._publisher.wait()
+      _logger.info('Publishing tweets: '+json.dumps(self._publisher.stats()))
+    if self._userPublisher is not None:
+      self.numUsersPublished+=self._userPublisher.wait()
+      _logger.info('Publishing users: '+json.dumps(self._userPublisher.stats()))
+    numTweetsStored=self._tweetWriter.close() if self._tweetWriter is not None else 0
+    numUsersStored=self._userWriter.close() if self._userWriter is not None else 0
+    with self._userLock:
+      unconfirmedUsers,self._unconfirmedUsers=self._unconfirmedUsers,{}
+      numUsersQueued,self._numUsersQueued=self._numUsersQueued,0
+    # A failed upload is not traced back to its users, so none are remembered: they are output again next time.
+    if numUsersStored>=numUsersQueued:
+      for userId, state in unconfirmedUsers.items():
+        self._userCache.put(userId, state)
+    elif unconfirmedUsers:
+      _logger.warning('Stored {numStored:d} of {numQueued:d} users; they will be output again.'.format(
+        numStored=numUsersStored, numQueued=numUsersQueued))
+    return (numTweetsStored, numUsersStored)
+  
+  # tweets -- a dict representing a tweet (parsed with a JSON parser), or the JSON bytes or string of a tweet as received.
+  # Returns (number of tweets stored, number of users stored, number of tweets published, number of users published),
+  # counting the messages handed to the publishers; close() counts those acknowledged.
   def parseData(self, tweets):
     numTweetsStored=0
     numTweetsPublished=0
     numUsersStored=0
     numUsersPublished=0
-    withinLimit=True
-    try:
-      tweetRecords=self.extractTweet(tweets, self.query, delim=self._delim)
-      userRecords=self.extractUsers(tweets)
-      
-      if self._bucket is not None:
-        self._bucketClient=self._writeToBucket(self._bucketClient, self._bucket, tweetRecords)
-        numTweetsStored+=len(tweetRecords)
-      if self._userBucket is not None:
-        self._userBucketClient=self._writeToBucket(self._userBucketClient, self._userBucket, userRecords)
-        numUsersStored+=len(userRecords)
-      
-      if self._topic is not None:
-        if self._publisher is None: self._publisher=PublisherClient()
-        for record in tweetRecords:
-          try:
-            cleanedRecord=dict(map(lambda key_value:(
-              key_value[0], key_value[1] if type(key_value[1]) in [int, float, bool, str] else str(key_value[1])),
-                                   record.items()))
-            self._publisher.publish(self._topic, data=json.dumps(record).encode("utf-8"), **cleanedRecord)
-          except:
-            self._publisher.publish(self._topic, data=json.dumps(record).encode("utf-8"), query=str(self.query))
-          numTweetsPublished+=1
-      
-      if self._userTopic is not None:
-        if self._userPublisher is None: self._userPublisher=PublisherClient()
-        for record in userRecords:
-          try:
-            self._userPublisher.publish(self._userTopic, data=json.dumps(record).encode("utf-8"), **record)
-          except:
-            self._userPublisher.publish(self._userTopic, data=json.dumps(record).encode("utf-8"))
-          numUsersPublished+=1
-      
-      self.limit-=1
-      if self.limit<=0: withinLimit=False
-    except:
-      _logger.error('Error in on_data. Sleeping for 5 seconds.', exc_info=True, stack_info=True)
-      time.sleep(5)
-    return (withinLimit, numTweetsStored, numUsersStored, numTweetsPublished, numUsersPublished)
+    # Parse the tweet once, keeping its original JSON text as the raw field of its record.
+    raw=None
+    if type(tweets) in [bytes, str]:
+      with timing.span('decode'):
+        tweets, raw=decodeTweet(tweets)
+    with timing.span('convert'):
+      tweetRecords=self.extractTweet(tweets, self.query, delim=self._delim, raw=raw)
+      metrics.rowsFetched.labels('twitterParser').inc(len(tweetRecords))
+      userRecords=[]
+      if self._userBucket is not None or self._userTopic is not None:
+        userRecords=self.extractUsers(tweets, userCache=self._userCache)  # Only users who are new or have changed.
+        if self._userTopic is None: userRecords=self._claimUsers(userRecords)
+    # Encode each record once for both storage and Pub/Sub.
+    with timing.span('serialize'):
+      encodedTweets=[]
+      if self._bucket is not None or self._topic is not None:
+        encodedTweets=[json.dumps(record).encode('utf-8') for record in tweetRecords]
+      encodedUsers=[]
+      if self._userBucket is not None or self._userTopic is not None:
+        encodedUsers=[json.dumps(record).encode('utf-8') for record in userRecords]
+    
+    if self._tweetWriter is not None:
+      for encodedRecord in encodedTweets:
+        self._tweetWriter.write(encodedRecord)
+      numTweetsStored+=len(encodedTweets)
+    if self._userWriter is not None:
+      for encodedRecord in encodedUsers:
+        self._userWriter.write(encodedRecord)
+      numUsersStored+=len(encodedUsers)
+      with self._userLock:
+        self._numUsersQueued+=len(encodedUsers)
+    
+    if self._topic is not None or self._userTopic is not None:
+      with self._publisherLock:
+        if self._topic is not None and self._publisher is None:
+          self._publisher=BatchPublisher(self._projectId, self._topic)
+        if self._userTopic is not None and self._userPublisher is None:
+          self._userPublisher=BatchPublisher(self._projectId, self._userTopic)
+    
+    if self._topic is not None:
+      for record, encodedRecord in zip(tweetRecords, encodedTweets):
+        self._publisher.publish(encodedRecord, **toAttributes(record))
+        numTweetsPublished+=1
+    
+    if self._userTopic is not None:
+      for record, encodedRecord in zip(userRecords, encodedUsers):
+        future=self._userPublisher.publish(encodedRecord, **toAttributes(record))
+        # The user is only remembered once the message is acknowledged, so a failed publish is output again.
+        future.add_done_callback(self._userPublished(record))
+        numUsersPublished+=1
+    
+    return (numTweetsStored, numUsersStored, numTweetsPublished, numUsersPublished)
+  
+  def _claimUsers(self, userRecords):
+    '''
+    :param userRecords: records returned by extractUsers.
+    :return: returns the records of the users not already written by this listener in the same state.
+    '''
+    claimed=[]
+    with self._userLock:
+      for userRecord in userRecords:
+        if 'id' in userRecord:
+          state=self._userState(userRecord)
+          if self._unconfirmedUsers.get(userRecord['id'], None)==state: continue
+          self._unconfirmedUsers[userRecord['id']]=state
+        claimed.append(userRecord)
+    return claimed
+  
+  def _userPublished(self, userRecord):
+    def done(future):
+      if future.exception() is None: self.rememberUsers([userRecord], self._userCache)
+    return done
+  
+  def on_data(self, raw_data):
+    '''
+    Hand each tweet to on_tweet as the bytes received from the stream, instead of letting tweepy parse it into a Tweet.
+    '''
+    start=raw_data[:16].decode('utf-8', 'ignore') if type(raw_data)==bytes else raw_data[:16]
+    if '"data"' in start:
+      self.on_tweet(raw_data)
+    else:
+      super().on_data(raw_data)  # Errors and other messages without a tweet.
+  
+  def _handleTweet(self, data):
+    '''
+    Runs on the workers of the work queue. Exceptions are logged and counted by the work queue.
+    '''
+    self.parseData(data)
   
   def on_tweet(self, data):
-    print('on_data Found tweet')
-    _logger.debug('Found tweet for '+str(self.query))
-    withinLimit=True
-    try:
-      tweets=json.loads(data) if type(data)==str else data
-      withinLimit, numTweetsStored, numUsersStored, numTweetsPublished, numUsersPublished=self.parseData(tweets)
-    except:
-      _logger.error('Error in on_data. Sleeping for 5 seconds.', exc_info=True, stack_info=True)
-      time.sleep(5)
-    return withinLimit
+    '''
+    Only queues the tweet, so that the stream is never held up by parsing, output or errors. Disconnects once limit
+    tweets have been received.
+    '''
+    if self._numReceived>=self.limit: return  # Received while disconnecting.
+    self._numReceived+=1
+    self._workQueue.put(data.data if isinstance(data, tweepy.Tweet) else data)  # A Tweet holds the parsed JSON in data.
+    if self._numReceived>=self.limit:
+      _logger.info('Received {num:d} tweets for {query}. Disconnecting.'.format(num=self._numReceived, query=self.query))
+      self.disconnect()
   
   def on_error(self, status):
     if status==420:
@@ -426,6 +456,22 @@ class MyListener(tweepy.StreamingClient):
     time.sleep(10)
     return True
 
+# The users output recently by this instance, by destination (see getUserCache). Kept between invocations of a warm
+# instance, so that a user who tweets again is only output again once one of the user's fields has changed.
+_userCaches={}
+_userCachesLock=threading.Lock()
+
+def getUserCache(projectId, userTopic, userBucket, path):
+  '''
+  :return: returns the LRUCache of the users output to the user topic and bucket, for MyListener.
+  '''
+  destination=(projectId, userTopic, userBucket, path)
+  with _userCachesLock:
+    if destination not in _userCaches: _userCaches[destination]=LRUCache(maxSize=100000)
+    return _userCaches[destination]
+
+@profiling.profiled('twitterParser')
+@timing.timed('twitterParser', _logger)
 def parseTweets(request):
   """Responds to any HTTP request.
   Args:
@@ -444,6 +490,7 @@ def parseTweets(request):
   
   limit=messageJSON.get('limit', None)
   if limit is None or str(limit)=='': limit=10
+  limit=int(limit)
   
   rawQuery=messageJSON.get('query', ['The Fast Dog'])
   if type(rawQuery)==str:
@@ -504,7 +551,8 @@ def parseTweets(request):
       'Cannot read required keys from twitterKeys.json. This file must exist and have the format {"consumer_key":"...","consumer_secret":"...","access_token":"...","access_secret":"..."}.')
     return 'Cannot read required keys from twitterKeys.json'
   twitterQuery=' OR '.join(map(lambda term:'"'+term+'"',query))
-  listener=MyListener(keys['bearer_token'],projectId,twitterQuery,limit,topic=topic,userTopic=userTopic,bucket=bucket,userBucket=userBucket,pathInBucket=pathInBuckets,delim=None,debug=10)
+  listener=MyListener(keys['bearer_token'],projectId,twitterQuery,limit,topic=topic,userTopic=userTopic,bucket=bucket,userBucket=userBucket,pathInBucket=pathInBuckets,delim=None,debug=10,
+                      userCache=getUserCache(projectId, userTopic, userBucket, pathInBuckets))
   response=listener.filter(track=','.join(query),languages='en')
   #stats=list(map(lambda tweet:listener.parseData(tweet._json),tweepy.Cursor(tweepyAPI.search,q=query).items(limit)))
   
@@ -512,16 +560,10 @@ def parseTweets(request):
   #results=tweepyClient.search_recent_tweets(,next_token=nextToken)
   
   _logger.debug('Querying for {term}'.format(term=','.join(query)))
-  stats=(0,0,0,0,0)
-  totalTweetsStored=0
-  totalUsersStored=0
-  totalTweetsPublished=0
-  totalUsersPublished=0
-  for withinLimit, numTweetsStored, numUsersStored, numTweetsPublished, numUsersPublished in stats:
-    totalTweetsStored+=numTweetsStored
-    totalUsersStored+=numUsersStored
-    totalTweetsPublished+=numTweetsPublished
-    totalUsersPublished+=numUsersPublished
+  # Wait for the records still being written to GCS.
+  totalTweetsStored, totalUsersStored=listener.close()
+  totalTweetsPublished=listener.numTweetsPublished
+  totalUsersPublished=listener.numUsersPublished
   #  twitter_stream = Stream(twitterAuth, MyListener(projectId, query, limit, topic=topic, userTopic=userTopic, bucket=bucket,
   #                                           userBucket=userBucket,pathInBucket=pathInBuckets,delim=delim,debug=debug))
   #  twitter_stream.filter(track=query)
@@ -561,9 +603,12 @@ if __name__=='__main__':
                       help='Place all tweets and users within the given path (in the tweet and user buckets).',
                       default=None)
   parser.add_argument('-debug', help='Print out log statements.', default=None, type=int)
+  parser.add_argument('-metricsPort', help='Serve Prometheus metrics on this port while the stream runs.', default=None,
+                      type=int)
   
   # parse the arguments
   args=parser.parse_args()
+  if args.metricsPort is not None: metrics.serve(args.metricsPort)
   
   exampleRequest=ExampleRequest(args.projectId, args.query, limit=args.limit, topic=args.topic,
                                 userTopic=args.userTopic, bucket=args.bucket, userBucket=args.userBucket,
@@ -30,10 +30,12 @@ then
   cp ${HOME}/${CODE_HOME}/python/main_${FUNCTION}.py main.py
   mkdir flight
   cp -r ${HOME}/${CODE_HOME}/python/flight/stream flight
+  cp -r ${HOME}/${CODE_HOME}/python/common .
   # Create a folder that contains all the files needed for the Cloud Function:
   #   requirements... -- lists the libraries and versions the code depends on.
   #   flightStreamingRunner.py -- the entry point for the Cloud Function to call when triggered.
   #   flight/stream/* -- the code
+  #   common/* -- code shared by the functions, such as the timing of their stages.
   zip -r ../${FUNCTION}.zip .
   #   outputs a zip file in ${CODE_HOME}.
   gsutil cp ../${FUNCTION}.zip gs://${BUCKET}/function/
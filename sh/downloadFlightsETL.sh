@@ -58,68 +58,24 @@ else
     echo "Using bucket ${BUCKET}."
 fi
 
-prepareMonthData() {
-    # Given a year and month, will download the file for the month and clean it.
-    MONTH=$1
-    YEAR=$2
-    echo "Preparing data for ${MONTH}/${YEAR}"
-
-    echo -n "Downloading..."
-    URL="https://transtats.bts.gov/PREZIP/On_Time_Reporting_Carrier_On_Time_Performance_1987_present_${YEAR}_${MONTH}.zip"
-    DOWNLOADED_FILE=${YEAR}-${MONTH}.zip
-    curl -k --ciphers 'HIGH:!DH:!aNULL' -o ${DOWNLOADED_FILE} ${URL}
-    if [ ! -f ${DOWNLOADED_FILE} ]
-    then
-        echo "ERROR: Cannot download data."
-	return 1
-    fi
-
-    echo "Unzipping..."
-    unzip ${DOWNLOADED_FILE}
-    rm -f readme.html
-    rm -f ${DOWNLOADED_FILE}
-
-    echo -n "Cleaning..."
-    cat *_${YEAR}_${MONTH}.csv | sed -e 's/,$//g' -e 's/"//g' > ${YEAR}-${MONTH}.csv
-    rm -f *_${YEAR}_${MONTH}.csv
-    
-    if [ ! -f ${YEAR}-${MONTH}.csv ]
-    then
-	echo "ERROR: No cleaned data file exists."
-        return 2
-    fi
-
-    echo "Storing..."
-    gsutil cp ${YEAR}-${MONTH}.csv gs://${BUCKET}/data/flightsETL/
-    rm -f ${YEAR}-${MONTH}.csv # This is the missing line!
-    return 0
-}
-
-if (( ${STARTYEAR} == ${ENDYEAR} ))
+# Download, clean and store several months at the same time. Each month is streamed from the BTS site through the
+# unzip and the cleaning into a gzipped upload, so nothing is written to the local disk.
+# Set FORMAT=parquet to store typed Parquet files partitioned by year and month instead of CSV files.
+# Months already stored are skipped unless their BTS file has changed since; set FORCE=true to process them again.
+# google-cloud-storage 3.0 is the first release whose blob.open() takes ignore_flush and cancels the upload on an error.
+FORMAT=${FORMAT:-csv}
+if [ "${FORMAT}" == "parquet" ]
 then
-    year=${STARTYEAR}
-    for (( month=${STARTMONTH}; month <= ${ENDMONTH}; month++ ))
-    do
-	prepareMonthData ${month} ${year}
-    done
+    FOLDER=data/flightsParquet
+    pip3 install --user --quiet 'google-cloud-storage>=3.0' requests pyarrow
 else
-    year=${STARTYEAR}
-    for (( month=${STARTMONTH}; month <= 12; month++ ))
-    do
-	    prepareMonthData ${month} ${year}
-    done
-    for (( year=${STARTYEAR}+1; year <= ${ENDYEAR}-1; year++ ))
-    do
-	    for (( month=1; month <= 12; month++ ))
-	    do
-	        prepareMonthData ${month} ${year}
-	    done
-    done
-    year=${ENDYEAR}
-    for (( month=1; month <= ${ENDMONTH}; month++ ))
-    do
-	prepareMonthData ${month} ${year}
-    done
+    FOLDER=data/flightsETL
+    pip3 install --user --quiet 'google-cloud-storage>=3.0' requests
 fi
-echo "Uploaded the following to gs://${BUCKET}/data/flightsETL"
-gsutil ls -l gs://${BUCKET}/data/flightsETL
+FORCEFLAG=
+[ "${FORCE}" == "true" ] && FORCEFLAG=-force
+cd "$(dirname $0)/../python"
+python3 -m flight.batch.btsETL -start ${STARTMONTH}-${STARTYEAR} -end ${ENDMONTH}-${ENDYEAR} -bucket ${BUCKET} -format ${FORMAT} \
+    ${FORCEFLAG}
+echo "Uploaded the following to gs://${BUCKET}/${FOLDER}"
+gsutil ls -l -r gs://${BUCKET}/${FOLDER}
@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+from requests import Response
+from api import genericRest
+from common.httpClient import HostLimiter, HttpClient
+
+class FakeSession(object):
+  '''
+  Answers each URL with its content after a delay, or with a 500 response if it has none, and records the most requests
+  running at once.
+  '''
+  def __init__(self, contents, delay=0.05):
+    self.contents=contents
+    self.delay=delay
+    self.urls=[]
+    self.running=0
+    self.maxRunning=0
+    self._lock=threading.Lock()
+
+  def get(self, url, params=None, headers=None, timeout=None):
+    with self._lock:
+      self.urls.append((url, params, headers))
+      self.running+=1
+      self.maxRunning=max(self.maxRunning, self.running)
+    time.sleep(self.delay)
+    with self._lock:
+      self.running-=1
+    response=Response()
+    response.url=url
+    response.status_code=200 if url in self.contents else 500
+    response._content=self.contents.get(url, b'')
+    return response
+
+class TestEndpoints(unittest.TestCase):
+  def test_toEndpoints(self):
+    self.assertEqual(genericRest._toEndpoints('http://a.example.com/x', {'Key':'k'}, {'q':1}),
+                     [{'url':'http://a.example.com/x', 'headers':{'Key':'k'}, 'params':{'q':1}, 'pagination':None}])
+    endpoints=genericRest._toEndpoints(['http://a.example.com/x',
+                                        {'url':'http://a.example.com/y', 'headers':{'Key':'other'}, 'parameters':{'q':2}},
+                                        {'url':'http://a.example.com/z', 'pagination':{'type':'link'}}],
+                                       {'Key':'k'}, None)
+    self.assertEqual([endpoint['headers'] for endpoint in endpoints], [{'Key':'k'}, {'Key':'other'}, {'Key':'k'}])
+    self.assertEqual([endpoint['params'] for endpoint in endpoints], [None, {'q':2}, None])
+    self.assertEqual([endpoint['pagination'] for endpoint in endpoints], [None, None, {'type':'link'}])
+
+  def test_fetchAllConcurrently(self):
+    urls=['http://a.example.com/'+str(index) for index in range(6)]
+    session=FakeSession({url:b'{}' for url in urls[:5]})  # The last one fails.
+    client=HttpClient(session=session, limiter=HostLimiter(maxConcurrent=3))
+    with self.assertLogs(genericRest._logger, 'ERROR'):
+      fetched=list(genericRest.fetchAll(genericRest._toEndpoints(urls), client))
+    self.assertEqual(sorted(endpoint['url'] for endpoint, _ in fetched), urls[:5])
+    self.assertEqual(session.maxRunning, 3)
+
+class TestCallAPI(unittest.TestCase):
+  def test_paginatedEndpointsConcurrently(self):
+    contents={'http://single.example.com/':b'{"value":1}'}
+    for host in ['a', 'b', 'c']:
+      url='http://'+host+'.example.com/'
+      contents[url]=('{"data":[{"page":1}],"next":"'+url+'2"}').encode()
+      contents[url+'2']=b'{"data":[{"page":2}]}'
+    session=FakeSession(contents)
+    endpoints=[{'url':url, 'pagination':{'type':'cursor', 'recordsPath':'data'}}
+               for url in ['http://a.example.com/', 'http://b.example.com/', 'http://c.example.com/']]
+    processed={}
+    def processRecords(processor, records, source=None):
+      processed[source]=list(records)
+      return len(processed[source])
+    with patch('common.httpClient.getSession', return_value=session), \
+         patch.object(genericRest.DataProcessor, 'processRecords', autospec=True, side_effect=processRecords):
+      genericRest.callAPI(endpoints+['http://single.example.com/'], None, None, None, None, None, None, False)
+    # The three endpoints are paged through at the same time as each other and as the single page.
+    self.assertEqual(session.maxRunning, 4)
+    self.assertEqual(processed, {endpoint['url']:[{'page':1}, {'page':2}] for endpoint in endpoints})
+    self.assertEqual(len(session.urls), 7)
+  
+  def test_paginatedRecordsPath(self):
+    requested=[]
+    def get(url, params=None, headers=None, timeout=None):
+      requested.append(params)
+      response=Response()
+      response.status_code=200
+      response._content=json.dumps({'data':[{'id':n} for n in range(params['start'], min(params['start']+2, 6))]}).encode()
+      return response
+    processed=[]
+    def processRecords(processor, records, source=None):
+      processed.extend(records)
+      return len(processed)
+    with patch('common.httpClient.getSession', return_value=Mock(get=Mock(side_effect=get))), \
+         patch.object(genericRest.DataProcessor, 'processRecords', autospec=True, side_effect=processRecords):
+      genericRest.callAPI('http://a.example.com/', None, None, None, None, None, None, False,
+                          pagination={'type':'offset', 'limit':2}, recordsPath='$.data[*]')
+    # The records of each page are found with recordsPath, so full pages are told apart from the last, short one.
+    self.assertEqual(processed, [{'id':n} for n in range(1, 6)])
+    self.assertEqual(len(requested), 3)
+  
+  def test_cachedResponses(self):
+    session=FakeSession({'http://a.example.com/':b'{"value":1}'}, delay=0)
+    with patch('common.httpClient.getSession', return_value=session), patch.dict(genericRest._responseCaches, clear=True):
+      for key in ['one', 'one', 'two']:
+        genericRest.callAPI('http://a.example.com/', {'X-RapidAPI-Key':key}, None, None, None, None, None, False,
+                            cache={'ttl':60})
+      self.assertEqual(len(genericRest._responseCaches), 1)
+    # The second call is answered from the cache; the third uses another API key and is not.
+    self.assertEqual([headers['X-RapidAPI-Key'] for _, _, headers in session.urls], ['one', 'two'])
+
+class TestDataProcessor(unittest.TestCase):
+  def setUp(self):
+    genericRest.DataProcessor._seenIDs.clear()
+  
+  def _output(self, records, path='records', publisher=None):
+    processor=genericRest.DataProcessor(path=path)
+    processor._batchPublisher=publisher
+    try:
+      numOutput=processor.processRecords(records)
+    finally:
+      processor.close()
+    return numOutput
+  
+  def test_dedupePerDestination(self):
+    records=[{'id':1}, {'id':2}, {'id':1}]
+    self.assertEqual(self._output(records), 2)
+    self.assertEqual(self._output(records), 0)
+    self.assertEqual(self._output(records, path='other'), 2)
+  
+  def test_seenOnlyOnceOutput(self):
+    failing=Mock(publish=Mock(side_effect=RuntimeError('unavailable')), wait=Mock(return_value=0),
+                 stats=Mock(return_value={'failed':0}))
+    with self.assertRaises(RuntimeError):
+      self._output([{'id':1}], publisher=failing)
+    unacknowledged=Mock(wait=Mock(return_value=0), stats=Mock(return_value={'failed':1}))
+    with self.assertLogs(genericRest._logger, 'WARNING'):
+      self.assertEqual(self._output([{'id':1}], publisher=unacknowledged), 1)
+    acknowledged=Mock(wait=Mock(return_value=1), stats=Mock(return_value={'failed':0}))
+    self.assertEqual(self._output([{'id':1}], publisher=acknowledged), 1)
+    self.assertEqual(self._output([{'id':1}], publisher=acknowledged), 0)
+  
+  def test_dedupeParsedAsBoolean(self):
+    for value, expected in [('false', False), (False, False), ('0', False), ('true', True), (True, True)]:
+      with patch.object(genericRest, 'callAPI') as callAPI, self.assertLogs(genericRest._logger):
+        genericRest.cloudFunctionMain(Mock(args=None, get_json=Mock(return_value={'url':'http://a.example.com/',
+                                                                                  'dedupe':value})))
+      self.assertEqual(callAPI.call_args.kwargs['dedupe'], expected)
+  
+  def test_cacheParsedAsBoolean(self):
+    for value, expected in [('false', False), (None, False), ('true', True), (True, True), ({'ttl':30}, {'ttl':30})]:
+      with patch.object(genericRest, 'callAPI') as callAPI, self.assertLogs(genericRest._logger):
+        genericRest.cloudFunctionMain(Mock(args=None, get_json=Mock(return_value={'url':'http://a.example.com/',
+                                                                                  'cache':value})))
+      self.assertEqual(callAPI.call_args.kwargs['cache'], expected)
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from api.pagination import extractRecords, getPagination, paginate
+
+class FakeResponse(object):
+  def __init__(self, data, nextLink=None):
+    self._data=data
+    self.links={'next':{'url':nextLink}} if nextLink is not None else {}
+  
+  def raise_for_status(self):
+    pass
+  
+  def json(self):
+    return self._data
+
+class TestPagination(unittest.TestCase):
+  def test_offset(self):
+    requested=[]
+    def fetch(url, params):
+      requested.append(params)
+      start=params['start']
+      return FakeResponse({'data':[{'n':n} for n in range(start, min(start+params['limit'], 6))]})
+    pagination=getPagination({'type':'offset', 'limit':2, 'recordsPath':'data'})
+    records=list(paginate(fetch, 'http://example.com', {'convert':'USD'}, pagination))
+    self.assertEqual([record['n'] for record in records], [1,2,3,4,5])
+    self.assertEqual(requested[0], {'convert':'USD', 'start':1, 'limit':2})
+    self.assertEqual(len(requested), 3)
+  
+  def test_defaultRecordsPath(self):
+    self.assertEqual(getPagination({'type':'offset'}, recordsPath='data').recordsPath, 'data')
+    self.assertEqual(getPagination({'type':'offset', 'recordsPath':'items'}, recordsPath='data').recordsPath, 'items')
+    self.assertEqual(getPagination(None, recordsPath='data').recordsPath, 'data')
+  
+  def test_cursor(self):
+    pages={None:{'items':[1,2], 'meta':{'next':'b'}}, 'b':{'items':[3], 'meta':{'next':None}}}
+    fetch=lambda url, params:FakeResponse(pages[(params or {}).get('page', None)])
+    pagination=getPagination({'type':'cursor', 'cursorPath':'meta.next', 'cursorParam':'page', 'recordsPath':'items'})
+    self.assertEqual(list(paginate(fetch, 'http://example.com', None, pagination)), [1,2,3])
+  
+  def test_linkHeader(self):
+    pages={'http://example.com/1':FakeResponse([1,2], nextLink='http://example.com/2'),
+           'http://example.com/2':FakeResponse([3], nextLink='http://example.com/3'),
+           'http://example.com/3':FakeResponse([4])}
+    fetch=lambda url, params:pages[url]
+    self.assertEqual(list(paginate(fetch, 'http://example.com/1', None, getPagination('link'))), [1,2,3,4])
+    self.assertEqual(list(paginate(fetch, 'http://example.com/1', None, getPagination({'type':'link', 'maxPages':2}))),
+                     [1,2,3])
+  
+  def test_extractRecords(self):
+    data={'data':[{'id':1, 'tags':['a','b']}, {'id':2, 'tags':['c']}], 'meta':{'count':2}}
+    self.assertEqual([record['id'] for record in extractRecords(data, '$.data[*]')], [1,2])
+    self.assertEqual(extractRecords(data, 'data'), data['data'])
+    self.assertEqual(extractRecords(data, '$.data[*].tags[*]'), ['a','b','c'])
+    self.assertEqual(extractRecords(data, '$.data[1].id'), [2])
+    self.assertEqual(extractRecords(data, '$.missing[*]'), [])
+    self.assertEqual(extractRecords(data, '$'), [data])
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+from api.traffic import mapquestIncidents
+
+class TestMapquestIncidents(unittest.TestCase):
+  _bounds=[39.95,-105.25,39.52,-104.71]
+  
+  def test_toRegions(self):
+    self.assertEqual(mapquestIncidents._toRegions(self._bounds), [((39.95,-105.25),(39.52,-104.71))])
+    self.assertEqual(len(mapquestIncidents._toRegions([self._bounds,[[40,-106],[42,-104]]])), 2)
+  
+  def test_tileBounds(self):
+    tiles=mapquestIncidents._tileBounds(((40,-106),(42,-104)), maxTileSize=1.0)
+    self.assertEqual(len(tiles), 4)
+    self.assertEqual(tiles[0], ((40.0,-106.0),(41.0,-105.0)))
+    self.assertEqual(tiles[-1], ((41.0,-105.0),(42.0,-104.0)))
+    # A small bounding box is requested as a single tile even when its corners are given in any order.
+    self.assertEqual(mapquestIncidents._tileBounds(((39.95,-105.25),(39.52,-104.71))), [((39.52,-105.25),(39.95,-104.71))])
+  
+  def test_getTiledDataDeduplicates(self):
+    def getData(key, tile, filters):
+      return ([{'id':1},{'id':2}] if tile[0][0]<41 else [{'id':2},{'id':3},{'type':1}]), tile[0][1]<-105
+    with patch.object(mapquestIncidents, '_getData', side_effect=getData):
+      incidents,numTiles,numFailed,numUnchanged=mapquestIncidents._getTiledData('key', [[40,-106],[42,-104]], ['incidents'])
+    self.assertEqual(numTiles, 4)
+    self.assertEqual(numFailed, 0)
+    self.assertEqual(numUnchanged, 2)
+    # Incidents without an id cannot be matched across tiles, so each copy is kept.
+    self.assertEqual(incidents, [{'id':1},{'id':2},{'id':3},{'type':1},{'type':1}])
+  
+  def test_incidentStateChanges(self):
+    with tempfile.TemporaryDirectory() as stateDir:
+      statePath=os.path.join(stateDir, 'incidents.json')
+      state=mapquestIncidents.IncidentState(statePath)
+      changes=state.changes([{'id':'1','severity':2},{'id':'2','severity':1}])
+      self.assertEqual([change['changeType'] for change in changes], ['new','new'])
+      state.save()
+      
+      state=mapquestIncidents.IncidentState(statePath)
+      changes=state.changes([{'severity':3,'id':'1'},{'id':'3','severity':1}])
+      self.assertEqual(changes, [{'id':'1','severity':3,'changeType':'updated'},
+                                 {'id':'3','severity':1,'changeType':'new'},
+                                 {'id':'2','changeType':'cleared'}])
+      # Nothing changed, so nothing is output.
+      self.assertEqual(state.changes([{'id':'1','severity':3},{'id':'3','severity':1}]), [])
+      # Incidents missing from an incomplete run are not reported as cleared.
+      self.assertEqual(state.changes([{'id':'1','severity':3}], complete=False), [])
+
+  def test_stateSavedOnlyOnceOutput(self):
+    incidents=[{'id':'1','severity':2},{'id':'2','severity':1}]
+    with tempfile.TemporaryDirectory() as stateDir, \
+         patch.object(mapquestIncidents, '_getTiledData', return_value=(incidents, 1, 0, 0)), \
+         patch.object(mapquestIncidents, 'JsonlWriter'), patch.object(mapquestIncidents, 'BatchPublisher'):
+      statePath=os.path.join(stateDir, 'incidents.json')
+      # One message was not acknowledged: the state is not saved and both incidents are output again.
+      with patch.object(mapquestIncidents, 'writeAndPublish', return_value=(2, 1)), \
+           self.assertLogs(mapquestIncidents._logger, 'WARNING'):
+        mapquestIncidents.parseAll('key', self._bounds, ['incidents'], statePath=statePath)
+      self.assertFalse(os.path.exists(statePath))
+      with patch.object(mapquestIncidents, 'writeAndPublish', return_value=(2, 2)) as writeAndPublish:
+        mapquestIncidents.parseAll('key', self._bounds, ['incidents'], statePath=statePath)
+      self.assertEqual(len(writeAndPublish.call_args.args[0]), 2)
+      self.assertEqual(mapquestIncidents.IncidentState(statePath).changes(incidents), [])
+  
+  def test_changesOnlyParsedAsBoolean(self):
+    statePaths=[]
+    def parseAll(*args, **kwargs):
+      statePaths.append(kwargs['statePath'])
+      return 0
+    with patch.object(mapquestIncidents, 'parseAll', side_effect=parseAll), self.assertLogs(mapquestIncidents._logger):
+      for value in ['true', True, 'false', False, '0', 'no']:
+        request=Mock(args=None, get_json=Mock(return_value={'key':'k', 'bucket':'b', 'changesOnly':value}))
+        mapquestIncidents.entry(request)
+    self.assertEqual([statePath is not None for statePath in statePaths], [True, True, False, False, False, False])
+    self.assertEqual(statePaths[0], 'gs://b/traffic/_state/incidents.json')
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,13 @@
+import unittest
+from benchmark import suite
+
+class TestSuite(unittest.TestCase):
+  def test_measure(self):
+    for case in suite.cases:
+      result=suite.measure(case, 20, repeat=1)
+      self.assertGreaterEqual(result['rows'], 20, case)  # Retweets add a row for the retweeted tweet.
+      self.assertGreater(result['rowsPerSecond'], 0, case)
+      self.assertGreater(result['allocatedBytesPerRow'], 0, case)
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+from common.cache import LRUCache
+
+class TestLRUCache(unittest.TestCase):
+  def test_evictsLeastRecentlyUsed(self):
+    cache=LRUCache(maxSize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    self.assertEqual(cache.get('a'), 1)  # a is now more recently used than b.
+    cache.put('c', 3)
+    self.assertNotIn('b', cache)
+    self.assertEqual(cache.get('a'), 1)
+    self.assertEqual(cache.get('c'), 3)
+    self.assertEqual(len(cache), 2)
+  
+  def test_add(self):
+    cache=LRUCache(maxSize=2)
+    self.assertTrue(cache.add('a'))
+    self.assertFalse(cache.add('a'))
+    self.assertTrue(cache.add('b'))
+    self.assertTrue(cache.add('c'))
+    self.assertTrue(cache.add('a'))  # a was evicted when c was added.
+
+if __name__=='__main__':
+  unittest.main()
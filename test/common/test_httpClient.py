@@ -0,0 +1,149 @@
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from requests import Response
+from common.httpClient import HostLimiter, HttpClient, ResponseCache, isNotModified
+
+class FakeSession(object):
+  '''
+  Answers with the queued responses and records the headers of each request.
+  '''
+  def __init__(self, responses):
+    self.responses=responses
+    self.sentHeaders=[]
+  
+  def get(self, url, params=None, headers=None, timeout=None):
+    self.sentHeaders.append(headers)
+    status, responseHeaders, content=self.responses.pop(0)
+    response=Response()
+    response.status_code=status
+    response.headers.update(responseHeaders)
+    response._content=content
+    return response
+
+class TestHttpClient(unittest.TestCase):
+  def test_conditionalRequests(self):
+    session=FakeSession([(200, {'ETag':'"v1"'}, b'{"incidents":[]}'), (304, {}, b'')])
+    client=HttpClient(conditional=True, session=session)
+    first=client.get('http://example.com/api', params={'b':2, 'a':1})
+    self.assertFalse(isNotModified(first))
+    self.assertNotIn('If-None-Match', session.sentHeaders[0])
+    
+    second=client.get('http://example.com/api', params={'a':1, 'b':2})
+    self.assertEqual(session.sentHeaders[1]['If-None-Match'], '"v1"')
+    self.assertTrue(isNotModified(second))
+    self.assertEqual(second.json(), {'incidents':[]})
+  
+  def test_unconditionalRequests(self):
+    session=FakeSession([(200, {'ETag':'"v1"'}, b'{}'), (200, {'ETag':'"v1"'}, b'{}')])
+    client=HttpClient(session=session)
+    client.get('http://example.com/api')
+    client.get('http://example.com/api')
+    self.assertEqual(session.sentHeaders, [{}, {}])
+
+class SlowSession(object):
+  '''
+  Answers every request after a delay, recording when each request started and the most requests running at once against
+  each host.
+  '''
+  def __init__(self, delay=0.05):
+    self.delay=delay
+    self.starts={}
+    self.running={}
+    self.maxRunning={}
+    self._lock=threading.Lock()
+  
+  def get(self, url, params=None, headers=None, timeout=None):
+    host=url.split('/')[2]
+    with self._lock:
+      self.starts.setdefault(host, []).append(time.monotonic())
+      self.running[host]=self.running.get(host, 0)+1
+      self.maxRunning[host]=max(self.maxRunning.get(host, 0), self.running[host])
+    time.sleep(self.delay)
+    with self._lock:
+      self.running[host]-=1
+    response=Response()
+    response.status_code=200
+    response._content=b'{}'
+    return response
+
+class TestHostLimiter(unittest.TestCase):
+  def _getAll(self, client, urls):
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+      list(executor.map(client.get, urls))
+  
+  def test_maxConcurrentPerHost(self):
+    session=SlowSession()
+    client=HttpClient(session=session, limiter=HostLimiter(maxConcurrent=2))
+    self._getAll(client, ['http://a.example.com/'+str(index) for index in range(6)]+
+                         ['http://b.example.com/'+str(index) for index in range(3)])
+    self.assertEqual(session.maxRunning, {'a.example.com':2, 'b.example.com':2})  # Each host has its own limit.
+    self.assertEqual(len(session.starts['a.example.com']), 6)
+  
+  def test_requestsPerSecond(self):
+    session=SlowSession(delay=0)
+    client=HttpClient(session=session, limiter=HostLimiter(maxConcurrent=10, requestsPerSecond=20))
+    self._getAll(client, ['http://a.example.com/'+str(index) for index in range(5)]+['http://b.example.com/'])
+    starts=sorted(session.starts['a.example.com'])
+    self.assertGreaterEqual(starts[-1]-starts[0], 0.19)  # 1/20 of a second apart, less the timer's resolution.
+    self.assertLess(session.starts['b.example.com'][0], starts[2])  # Not held back by the other host.
+
+class TestResponseCache(unittest.TestCase):
+  def test_freshResponsesAreCached(self):
+    session=FakeSession([(200, {'Cache-Control':'max-age=60'}, b'{"n":1}')])
+    cache=ResponseCache()
+    client=HttpClient(session=session, cache=cache)
+    client.get('http://example.com/api', params={'b':2, 'a':1})
+    second=client.get('http://example.com/api', params={'a':1, 'b':2})
+    self.assertEqual(second.json(), {'n':1})
+    self.assertEqual(len(session.sentHeaders), 1)
+    self.assertEqual(cache.stats()['hits'], 1)
+    self.assertEqual(cache.stats()['hitRate'], 0.5)
+  
+  def test_noStoreAndVaryHeaders(self):
+    session=FakeSession([(200, {'Cache-Control':'no-store'}, b'{}'), (200, {}, b'{}'), (200, {}, b'{}')])
+    client=HttpClient(session=session, cache=ResponseCache(), cacheTTL=60)
+    client.get('http://example.com/a')
+    client.get('http://example.com/a')  # The first response was not stored.
+    client.get('http://example.com/a', headers={'Authorization':'other'})  # A different key.
+    client.get('http://example.com/a')
+    self.assertEqual(len(session.sentHeaders), 3)
+  
+  def test_keyedOnEveryHeader(self):
+    cache=ResponseCache()
+    self.assertNotEqual(cache.key('http://example.com/a', headers={'X-RapidAPI-Key':'one'}),
+                        cache.key('http://example.com/a', headers={'X-RapidAPI-Key':'two'}))
+    self.assertEqual(cache.key('http://example.com/a', headers={'X-RapidAPI-Key':'one', 'Accept':'*/*'}),
+                     cache.key('http://example.com/a', headers={'accept':'*/*', 'x-rapidapi-key':'one'}))
+    cache=ResponseCache(ignoreHeaders=['X-Request-ID'])
+    self.assertEqual(cache.key('http://example.com/a', headers={'X-Request-ID':'1'}),
+                     cache.key('http://example.com/a', headers={'X-Request-ID':'2'}))
+  
+  def test_staleWhileRevalidate(self):
+    session=FakeSession([(200, {'ETag':'"v1"', 'Cache-Control':'max-age=0, stale-while-revalidate=60'}, b'{"n":1}'),
+                         (304, {'Cache-Control':'max-age=60'}, b'')])
+    cache=ResponseCache()
+    client=HttpClient(session=session, cache=cache)
+    client.get('http://example.com/api')
+    stale=client.get('http://example.com/api')  # Answered from the cache while revalidating in the background.
+    self.assertEqual(stale.json(), {'n':1})
+    client.wait()
+    self.assertEqual(session.sentHeaders[1]['If-None-Match'], '"v1"')
+    fresh=client.get('http://example.com/api')
+    self.assertEqual(fresh.json(), {'n':1})
+    self.assertEqual(len(session.sentHeaders), 2)
+    self.assertEqual(cache.stats()['staleHits'], 1)
+    self.assertEqual(cache.stats()['revalidated'], 1)
+  
+  def test_diskTier(self):
+    with tempfile.TemporaryDirectory() as location:
+      session=FakeSession([(200, {}, b'{"n":1}')])
+      HttpClient(session=session, cache=ResponseCache(location=location), cacheTTL=60).get('http://example.com/api')
+      restarted=HttpClient(session=session, cache=ResponseCache(location=location), cacheTTL=60)
+      self.assertEqual(restarted.get('http://example.com/api').json(), {'n':1})
+      self.assertEqual(len(session.sentHeaders), 1)
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+from common import lazy
+
+class TestLazy(unittest.TestCase):
+  def setUp(self):
+    sys.modules.pop('colorsys', None)
+
+  def test_importsOnFirstUse(self):
+    colorsys=lazy.module('colorsys')
+    self.assertFalse(lazy.isLoaded(colorsys))
+    self.assertNotIn('colorsys', sys.modules)
+    self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+    self.assertTrue(lazy.isLoaded(colorsys))
+    self.assertIn('colorsys', sys.modules)
+
+  def test_returnsImportedModule(self):
+    self.assertIs(lazy.module('os'), os)
+
+  def test_seesPatchesOfRealModule(self):
+    colorsys=lazy.module('colorsys')
+    import colorsys as realColorsys
+    with mock.patch.object(realColorsys, 'rgb_to_hsv', lambda r, g, b:'patched'):
+      self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), 'patched')
+    self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+
+  def test_missingModuleFailsOnUse(self):
+    missing=lazy.module('noSuchModuleForTesting')
+    with self.assertRaises(ImportError):
+      missing.anything
+
+  def test_entryPointDoesNotImportClients(self):
+    pythonFolder=os.path.dirname(os.path.dirname(os.path.abspath(lazy.__file__)))
+    process=subprocess.run([sys.executable, '-c', 'import sys; import api.streamVaccinations; '
+                            'print("google.cloud.pubsub_v1" in sys.modules, "google.cloud.storage" in sys.modules)'],
+                           env=dict(os.environ, PYTHONPATH=pythonFolder), capture_output=True, text=True)
+    self.assertEqual(process.returncode, 0, process.stderr)
+    self.assertEqual(process.stdout.split(), ['False', 'False'])
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+import logging
+import unittest
+from unittest import mock
+
+from common import logs
+
+class Unprintable(object):
+  def __str__(self):
+    raise AssertionError('Formatted although the level is disabled.')
+
+class ListHandler(logging.Handler):
+  def __init__(self):
+    super().__init__()
+    self.records=[]
+
+  def emit(self, record):
+    self.records.append(record)
+
+class TestLogs(unittest.TestCase):
+  def setUp(self):
+    self.logger=logging.getLogger('test_logs')
+    self.logger.propagate=False
+    self.handler=ListHandler()
+    self.logger.addHandler(self.handler)
+    self.logger.setLevel(logging.INFO)
+
+  def tearDown(self):
+    self.logger.removeHandler(self.handler)
+
+  def test_disabledLevelFormatsNothing(self):
+    self.assertFalse(logs.debug(self.logger, 'Received data. %s', Unprintable()))
+    self.assertFalse(logs.debug(self.logger, logs.structured('Found %s.', Unprintable())))
+    self.assertEqual(self.handler.records, [])
+
+  def test_recordKeepsCallSite(self):
+    self.assertTrue(logs.info(self.logger, 'Parsing %s', 'GOOG'))
+    record=self.handler.records[0]
+    self.assertEqual(record.getMessage(), 'Parsing GOOG')
+    self.assertEqual(record.funcName, 'test_recordKeepsCallSite')
+    self.assertEqual(record.module, 'test_logs')
+
+  def test_deferredValues(self):
+    logs.info(self.logger, 'Received data. %s', logs.truncated('x'*150, 100))
+    logs.info(self.logger, logs.structured('Found %d records.', 3, bucket='b'))
+    logs.info(self.logger, 'Stats: %s', logs.lazy(lambda:{'acked':1}))
+    self.assertEqual([record.getMessage() for record in self.handler.records],
+                     ['Received data. '+'x'*100+'...', '{"log": "Found 3 records.", "bucket": "b"}', "Stats: {'acked': 1}"])
+
+  def test_every(self):
+    for index in range(25):
+      logs.info(self.logger, 'Row %d', index, every=10)
+    self.assertEqual([record.getMessage() for record in self.handler.records],
+                     ['Row 0', '(9 similar messages suppressed) Row 10', '(9 similar messages suppressed) Row 20'])
+
+  def test_perSecond(self):
+    def parseRow(index):
+      logs.error(self.logger, 'Cannot parse row %d', index, perSecond=1, burst=2)  # One call site.
+    with mock.patch.object(logs.time, 'monotonic', return_value=100.0):
+      for index in range(5):
+        parseRow(index)
+    self.assertEqual(len(self.handler.records), 2)
+    with mock.patch.object(logs.time, 'monotonic', return_value=101.0):
+      for index in range(5, 7):
+        parseRow(index)
+    self.assertEqual(self.handler.records[-1].getMessage(), '(3 similar messages suppressed) Cannot parse row 5')
+    self.assertEqual(len(self.handler.records), 3)
+
+  def test_excInfo(self):
+    try:
+      raise ValueError('bad row')
+    except ValueError:
+      logs.error(self.logger, 'Cannot parse row %d', 1, exc_info=True, stack_info=True)
+    record=self.handler.records[0]
+    self.assertIs(record.exc_info[0], ValueError)
+    self.assertIn('test_excInfo', record.stack_info)
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+import gc
+import unittest
+import weakref
+from concurrent.futures import Future
+from common import metrics
+from common.workQueue import WorkQueue
+from flight.stream.opensky_api import OpenSkyApi
+
+@unittest.skipIf(metrics.registry is None, 'prometheus_client is not installed.')
+class TestMetrics(unittest.TestCase):
+  def _value(self, name, **labels):
+    return metrics.registry.get_sample_value(name, labels) or 0
+  
+  def test_trackPublish(self):
+    before=self._value('ingest_rows_published_total', topic='projects/p/topics/t')
+    future=metrics.trackPublish(Future(), 'projects/p/topics/t')
+    self.assertEqual(self._value('ingest_rows_published_total', topic='projects/p/topics/t'), before)
+    future.set_result('1')
+    self.assertEqual(self._value('ingest_rows_published_total', topic='projects/p/topics/t'), before+1)
+    self.assertGreater(self._value('ingest_publish_latency_seconds_count', topic='projects/p/topics/t'), 0)
+    failed=Future()
+    metrics.trackPublish(failed, 'projects/p/topics/t')
+    failed.set_exception(ConnectionError())
+    self.assertEqual(self._value('ingest_publish_failures_total', topic='projects/p/topics/t'), 1)
+  
+  def test_rateLimited(self):
+    api=OpenSkyApi()
+    self.assertTrue(api._check_rate_limit(10, 5, api.get_states))
+    api._last_requests[api.get_states]=__import__('time').time()
+    self.assertFalse(api._check_rate_limit(10, 5, api.get_states))
+    self.assertEqual(self._value('ingest_rate_limited_total', api='opensky', function='get_states'), 1)
+  
+  def test_queueDepth(self):
+    workQueue=WorkQueue(lambda item:None, numWorkers=1, name='metricsTest')
+    self.assertEqual(self._value('ingest_queue_depth', queue='metricsTest'), 0)
+    workQueue.close()
+  
+  def test_queueDepthDoesNotKeepQueuesAlive(self):
+    class Queue(object):
+      def __init__(self, depth):
+        self.items=depth
+    queues=[Queue(2), Queue(3)]
+    for queue in queues:
+      metrics.trackQueue('weakTest', queue, lambda queue:queue.items)
+    self.assertEqual(self._value('ingest_queue_depth', queue='weakTest'), 5)  # Every live queue is counted.
+    dropped=weakref.ref(queues.pop(0))
+    gc.collect()
+    self.assertIsNone(dropped())
+    self.assertEqual(self._value('ingest_queue_depth', queue='weakTest'), 3)
+  
+  def test_pushWithoutGateway(self):
+    self.assertFalse(metrics.push('test', gateway=''))
+
+class TestWithoutPrometheus(unittest.TestCase):
+  def test_noMetric(self):
+    metric=metrics._NoMetric()
+    metric.labels('a').inc()
+    metric.labels(topic='b').observe(1.0)
+    metric.labels('c').set_function(lambda:1)
+
+if __name__=='__main__':
+  unittest.main()
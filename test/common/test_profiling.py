@@ -0,0 +1,40 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from common import profiling
+
+class TestProfiling(unittest.TestCase):
+  def test_notProfiled(self):
+    message={'bucket':'data'}
+    self.assertIs(profiling.start(message), message)
+    self.assertIsNone(profiling._active)
+    self.assertIsNone(profiling.start({'profile':'false'}) and profiling._active)
+    self.assertIsNone(profiling.finish('test'))
+  
+  def _run(self, profile, expected):
+    with tempfile.TemporaryDirectory() as location:
+      @profiling.profiled('test')
+      def entry(message):
+        profiling.start(message)
+        worker=threading.Thread(target=lambda:[bytearray(1000) for _ in range(2000)] and time.sleep(0.05))
+        worker.start()
+        worker.join()
+        return 'done'
+      self.assertEqual(entry({'profile':dict(profile, location=location)}), 'done')
+      self.assertIsNone(profiling._active)
+      names=sorted(os.listdir(location))
+      self.assertEqual([name.rsplit('.', 1)[1] for name in names], expected)
+      self.assertTrue(all(name.startswith('test_') for name in names))
+      with open(os.path.join(location, names[-1])) as summaryFile:
+        self.assertIn('Top allocation sites', summaryFile.read())
+  
+  def test_cprofile(self):
+    self._run({}, ['pstats', 'txt'])
+  
+  def test_sample(self):
+    self._run({'mode':'sample', 'interval':0.001}, ['folded', 'txt'])
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+import gzip
+import io
+import os
+import tempfile
+import time
+import unittest
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+from common.replay import Cassette, ReplayError
+
+def fakeSend(adapter, request, **kwargs):
+  '''
+  Answers every request with a gzip-compressed body that echoes the path.
+  '''
+  body=gzip.compress(('line 1 '+request.path_url+'\nline 2\n').encode('utf-8'))
+  raw=HTTPResponse(body=io.BytesIO(body), headers={'Content-Encoding':'gzip', 'Content-Type':'text/plain'}, status=200,
+                   reason='OK', preload_content=False)
+  return adapter.build_response(request, raw)
+
+def failingSend(adapter, request, **kwargs):
+  raise AssertionError('The network must not be used during replay.')
+
+class TestCassette(unittest.TestCase):
+  def setUp(self):
+    self._originalSend=HTTPAdapter.send
+    self._directory=tempfile.TemporaryDirectory()
+    self._path=os.path.join(self._directory.name, 'test.jsonl.gz')
+  
+  def tearDown(self):
+    HTTPAdapter.send=self._originalSend
+    self._directory.cleanup()
+  
+  def test_recordAndReplay(self):
+    HTTPAdapter.send=fakeSend
+    with Cassette(self._path, mode='record'):
+      recorded=requests.get('http://example.com/states?b=2&a=1&key=secret').text
+      streamed=list(requests.Session().get('http://example.com/stream', stream=True).iter_lines())
+    with gzip.open(self._path, 'rt') as cassetteFile:
+      self.assertNotIn('secret', cassetteFile.read())
+    
+    HTTPAdapter.send=failingSend
+    with Cassette(self._path, mode='replay'):
+      self.assertEqual(requests.get('http://example.com/states?a=1&b=2&key=other').text, recorded)
+      self.assertEqual(list(requests.Session().get('http://example.com/stream', stream=True).iter_lines()), streamed)
+      with self.assertRaises(ReplayError):
+        requests.get('http://example.com/unknown')
+    self.assertEqual(HTTPAdapter.send, failingSend)  # Restored after the cassette.
+  
+  def test_replaySpeed(self):
+    HTTPAdapter.send=fakeSend
+    with Cassette(self._path, mode='record') as cassette:
+      requests.get('http://example.com/')
+    cassette._interactions[0]['chunks'][0][0]=0.2  # As if the body took 0.2 seconds to arrive.
+    cassette.save()
+    with Cassette(self._path, mode='replay', speed=2):
+      start=time.monotonic()
+      requests.get('http://example.com/')
+      self.assertGreaterEqual(time.monotonic()-start, 0.09)
+
+if __name__=='__main__':
+  unittest.main()
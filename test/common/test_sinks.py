@@ -0,0 +1,125 @@
+import gzip
+import json
+import threading
+import unittest
+from concurrent.futures import Future
+from common.sinks import BackgroundWriter, BatchPublisher, DeliveryTracker, JsonlWriter, writeAndPublish
+
+class FakeBlob(object):
+  def __init__(self, bucket, name):
+    self._bucket=bucket
+    self.name=name
+  
+  def upload_from_string(self, data, content_type=None):
+    if self._bucket.failures>0:
+      self._bucket.failures-=1
+      raise ConnectionError('Upload failed.')
+    self._bucket.objects[self.name]=data
+
+class FakeBucket(object):
+  def __init__(self):
+    self.objects={}
+    self.failures=0  # Number of uploads to fail before succeeding.
+  
+  def blob(self, name):
+    return FakeBlob(self, name)
+
+class FakeStorageClient(object):
+  def __init__(self):
+    self.fakeBucket=FakeBucket()
+  
+  def bucket(self, name):
+    return self.fakeBucket
+
+class FakePublisherClient(object):
+  def __init__(self):
+    self.messages=[]
+  
+  def publish(self, topic, data, **attributes):
+    self.messages.append((topic, data, attributes))
+    future=Future()
+    future.set_result(str(len(self.messages)))
+    return future
+
+class PendingPublisherClient(object):
+  '''
+  Returns futures that are only completed by the test. Rejects messages with attributes that are not strings.
+  '''
+  def __init__(self):
+    self.futures=[]
+  
+  def publish(self, topic, data, **attributes):
+    if any(type(value)!=str for value in attributes.values()): raise TypeError('Attributes must be strings.')
+    future=Future()
+    self.futures.append(future)
+    return future
+
+class TestSinks(unittest.TestCase):
+  def test_jsonlWriterRolls(self):
+    client=FakeStorageClient()
+    writer=JsonlWriter('bucket', 'traffic', prefix='incidents', maxRecords=2, client=client)
+    self.assertEqual(writer.writeAll([{'id':1},{'id':2},{'id':3}]), 3)
+    names=sorted(client.fakeBucket.objects)
+    self.assertEqual(len(names), 2)
+    self.assertTrue(names[0].startswith('traffic/dt='))
+    self.assertTrue(names[0].endswith('_0000.jsonl.gz'))
+    lines=gzip.decompress(client.fakeBucket.objects[names[0]]).decode('utf-8').splitlines()
+    self.assertEqual(list(map(json.loads, lines)), [{'id':1},{'id':2}])
+  
+  def test_jsonlWritersDoNotOverwriteEachOther(self):
+    client=FakeStorageClient()
+    for _ in range(2):  # Started in the same second, as by two instances of a Cloud Function.
+      JsonlWriter('bucket', 'traffic', prefix='incidents', client=client).writeAll([{'id':1}])
+    self.assertEqual(len(client.fakeBucket.objects), 2)
+  
+  def test_backgroundWriter(self):
+    client=FakeStorageClient()
+    client.fakeBucket.failures=1
+    writer=BackgroundWriter(JsonlWriter('bucket', 'tweets', maxRecords=2, client=client, uploadThreads=2, retries=1),
+                            pollSeconds=0.01)
+    for n in range(5):
+      writer.write({'n':n})
+    self.assertEqual(writer.close(), 5)
+    lines=[json.loads(line) for name in sorted(client.fakeBucket.objects)
+           for line in gzip.decompress(client.fakeBucket.objects[name]).splitlines()]
+    self.assertEqual(sorted(line['n'] for line in lines), [0, 1, 2, 3, 4])
+  
+  def test_rollIfDue(self):
+    client=FakeStorageClient()
+    writer=JsonlWriter('bucket', 'tweets', client=client, maxSeconds=0)
+    writer.write({'n':1})
+    writer.rollIfDue()
+    self.assertEqual(len(client.fakeBucket.objects), 1)
+  
+  def test_writeAndPublish(self):
+    storageClient=FakeStorageClient()
+    publisherClient=FakePublisherClient()
+    numWritten,numPublished=writeAndPublish([{'id':1},{'id':2}],
+                                            writer=JsonlWriter('bucket', 'path', client=storageClient),
+                                            publisher=BatchPublisher('project', 'topic', client=publisherClient))
+    self.assertEqual((numWritten, numPublished), (2, 2))
+    self.assertEqual(publisherClient.messages[0][0], 'projects/project/topics/topic')
+    self.assertEqual(publisherClient.messages[1][1], b'{"id": 2}')
+  
+  def test_deliveryTrackerBoundsOutstandingMessages(self):
+    client=PendingPublisherClient()
+    tracker=DeliveryTracker(maxMessages=2)
+    publisher=BatchPublisher('project', 'topic', client=client, tracker=tracker)
+    publisher.publish({'id':1})
+    publisher.publish({'id':2}, count=2)  # Rejected by the client, published again without attributes.
+    third=threading.Thread(target=publisher.publish, args=({'id':3},))
+    third.start()
+    third.join(0.1)
+    self.assertTrue(third.is_alive())  # Blocked until a message is done.
+    client.futures[0].set_result('1')
+    third.join(1)
+    self.assertFalse(third.is_alive())
+    client.futures[1].set_exception(RuntimeError('failed'))
+    client.futures[2].set_result('3')
+    self.assertEqual(publisher.wait(), 2)
+    stats=tracker.stats()
+    self.assertEqual((stats['published'], stats['acked'], stats['failed'], stats['retried']), (3, 2, 1, 1))
+    self.assertEqual(stats['outstandingMessages'], 0)
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,41 @@
+import json
+import threading
+import unittest
+from common import timing
+
+class TestTiming(unittest.TestCase):
+  def test_spansOutsideOfAnInvocation(self):
+    with timing.span('fetch') as fetching:
+      fetching.items=3
+    self.assertIsNone(timing.current())
+  
+  def test_invocation(self):
+    with timing.invocation('test') as timings:
+      with timing.span('fetch'):
+        pass
+      worker=threading.Thread(target=lambda:timing.span('store', items=2).__enter__().__exit__(None, None, None))
+      worker.start()
+      worker.join()
+      with self.assertRaises(ValueError):
+        with timing.span('convert') as converting:
+          converting.items=5
+          raise ValueError()
+      timings.record('fetch', 0.3)
+    self.assertIsNone(timing.current())
+    stages=timings.summary()['stages']
+    self.assertEqual(stages['fetch']['count'], 2)
+    self.assertEqual(stages['fetch']['histogram']['500'], 1)
+    self.assertEqual(stages['store']['items'], 2)  # Spans on other threads count towards the invocation.
+    self.assertEqual(stages['convert']['items'], 5)
+  
+  def test_timed(self):
+    @timing.timed('test')
+    def entry(request):
+      with timing.span('fetch'):
+        return 'handled '+request
+    response=json.loads(entry('3 items'))
+    self.assertEqual(response['message'], 'handled 3 items')
+    self.assertEqual(response['timings']['stages']['fetch']['count'], 1)
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,29 @@
+import threading
+import unittest
+from common.workQueue import WorkQueue
+
+class TestWorkQueue(unittest.TestCase):
+  def test_handlesAndCountsFailures(self):
+    handled=[]
+    def handler(item):
+      if item<0: raise ValueError('bad item')
+      handled.append(item)
+    workQueue=WorkQueue(handler, numWorkers=2)
+    for item in [1, -1, 2, 3]:
+      self.assertTrue(workQueue.put(item))
+    stats=workQueue.close()
+    self.assertEqual(sorted(handled), [1, 2, 3])
+    self.assertEqual((stats['queued'], stats['handled'], stats['failed'], stats['dropped']), (4, 3, 1, 0))
+  
+  def test_dropsWhenFull(self):
+    release=threading.Event()
+    workQueue=WorkQueue(lambda item:release.wait(), numWorkers=1, maxQueued=1, maxWait=0.01)
+    results=[workQueue.put(item) for item in range(4)]  # One being handled, one queued, the rest dropped.
+    release.set()
+    stats=workQueue.close()
+    self.assertEqual(results.count(False), stats['dropped'])
+    self.assertGreaterEqual(stats['dropped'], 1)
+    self.assertGreaterEqual(stats['blockedPuts'], 1)
+
+if __name__=='__main__':
+  unittest.main()
@@ -0,0 +1,221 @@
+import gzip
+import importlib.util
+import io
+import json
+import unittest
+import zipfile
+import zlib
+from unittest import mock
+
+from google.api_core import exceptions
+
+from flight.batch import btsETL
+
+class Unseekable(io.RawIOBase):
+  '''
+  Output that zipfile cannot seek back in, so that it writes data descriptors after the members.
+  '''
+
+  def __init__(self):
+    self.output=io.BytesIO()
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    return self.output.write(data)
+
+def createZip(csv, seekable=True):
+  output=io.BytesIO() if seekable else Unseekable()
+  with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as zipFile:
+    zipFile.writestr('readme.html', '<html>About the data.</html>')
+    zipFile.writestr('On_Time_Reporting_Carrier_On_Time_Performance_(1987_present)_2024_1.csv', csv)
+  return (output if seekable else output.output).getvalue()
+
+class FakeResponse(object):
+  def __init__(self, content, headers=None):
+    self._content=content
+    self.headers=headers or {}
+    self.ok=True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    return False
+
+  def raise_for_status(self):
+    pass
+
+  def iter_content(self, chunk_size=None):
+    for start in range(0, len(self._content), 1000):  # Small chunks, to split headers and lines.
+      yield self._content[start:start+1000]
+
+class FakeSession(object):
+  def __init__(self, contents):
+    self.contents=contents
+    self.urls=[]
+
+  def head(self, url, timeout=None, allow_redirects=False):
+    content=self.contents[url]
+    return FakeResponse(b'', headers={'ETag':'"'+str(zlib.crc32(content))+'"', 'Content-Length':str(len(content))})
+
+  def get(self, url, stream=False, timeout=None):
+    self.urls.append(url)
+    return FakeResponse(self.contents[url])
+
+class FakeUpload(io.BytesIO):
+  def __init__(self, client, name):
+    super().__init__()
+    self._client=client
+    self._name=name
+
+  def __exit__(self, excType, excValue, traceback):
+    if excType is None: self._client.store(self._name, self.getvalue())  # Otherwise the upload is cancelled.
+    self.close()
+    return False
+
+class FakeBlob(object):
+  def __init__(self, client, name):
+    self._client=client
+    self.name=name
+    self.reload()
+
+  def reload(self):
+    content, self.generation=self._client.objects.get(self.name, None), self._client.generations.get(self.name, 0)
+    self.size=len(content) if content is not None else None
+    self.crc32c=str(zlib.crc32(content)) if content is not None else None
+
+  def open(self, mode, **kwargs):
+    return FakeUpload(self._client, self.name)
+
+  def download_as_bytes(self, if_generation_match=None):
+    return self._client.objects[self.name]
+
+  def upload_from_string(self, data, content_type=None, if_generation_match=None):
+    if if_generation_match is not None and if_generation_match!=self._client.generations.get(self.name, 0):
+      raise exceptions.PreconditionFailed('Generation mismatch.')
+    self._client.store(self.name, data.encode('utf-8'))
+    self.reload()
+
+class FakeStorageClient(object):
+  def __init__(self):
+    self.objects={}
+    self.generations={}
+    self.name='bucket'
+
+  def store(self, name, content):
+    self.objects[name]=content
+    self.generations[name]=self.generations.get(name, 0)+1
+
+  def bucket(self, name):
+    return self
+
+  def blob(self, name):
+    return FakeBlob(self, name)
+
+  def get_blob(self, name):
+    return FakeBlob(self, name) if name in self.objects else None
+
+csv=('"Year","Month","Reporting_Airline","Origin",\r\n'+
+     ''.join('2024,1,"AA","DEN{num:d}",\r\n'.format(num=index) for index in range(2000)))
+cleanCSV=('Year,Month,Reporting_Airline,Origin\n'+
+          ''.join('2024,1,AA,DEN{num:d}\n'.format(num=index) for index in range(2000))).encode('utf-8')
+
+class TestBTSETL(unittest.TestCase):
+  def test_monthRange(self):
+    self.assertEqual(btsETL.parseMonth('4-2022'), (2022, 4))
+    self.assertEqual(btsETL.parseMonth('2022', end=True), (2022, 12))
+    self.assertEqual(btsETL.monthRange((2019, 11), (2020, 2)), [(2019, 11), (2019, 12), (2020, 1), (2020, 2)])
+
+  def test_cleanLinesAcrossChunks(self):
+    data=csv.encode('utf-8')
+    chunks=[data[start:start+7] for start in range(0, len(data), 7)]
+    self.assertEqual(b''.join(btsETL.cleanLines(chunks)), cleanCSV)
+    self.assertEqual(b''.join(btsETL.cleanLines([b'"a",b,\n1,"2",'])), b'a,b\n1,2\n')
+
+  def test_streamZipMembers(self):
+    for seekable in [True, False]:
+      data=createZip(csv, seekable=seekable)
+      chunks=[data[start:start+100] for start in range(0, len(data), 100)]
+      members=list(btsETL.streamZipMembers(chunks, accept=lambda name:name.endswith('.csv')))
+      self.assertEqual(b''.join(data for _, data in members), csv.encode('utf-8'))
+
+  def test_corruptZip(self):
+    data=bytearray(createZip(csv))
+    data[len(data)//2]^=0xff
+    with self.assertRaises(Exception):
+      list(btsETL.streamZipMembers([bytes(data)]))
+    with self.assertRaises(ValueError):
+      list(btsETL.streamZipMembers([b'<html>Not found</html>']))
+
+  def test_run(self):
+    months=[(2024, 1), (2024, 2)]
+    session=FakeSession({btsETL.urlTemplate.format(year=2024, month=1):createZip(csv, seekable=False),
+                         btsETL.urlTemplate.format(year=2024, month=2):b'<html>Not found</html>'})
+    client=FakeStorageClient()
+    with mock.patch.object(btsETL, 'getStorageClient', lambda:client), self.assertLogs(btsETL._logger, 'ERROR'):
+      results=btsETL.run(months, 'bucket', workers=2, session=session)
+    self.assertEqual(results[0]['rows'], 2000)
+    self.assertEqual(results[0]['object'], 'gs://bucket/data/flightsETL/2024-1.csv.gz')
+    self.assertIn('error', results[1])
+    # The failed month is not stored.
+    self.assertEqual(sorted(client.objects), ['data/flightsETL/2024-1.csv.gz', 'data/flightsETL/_manifest.json'])
+    self.assertEqual(gzip.decompress(client.objects['data/flightsETL/2024-1.csv.gz']), cleanCSV)
+
+  def test_runSkipsUnchangedMonths(self):
+    months=[(2024, 1), (2024, 2)]
+    urls=[btsETL.urlTemplate.format(year=year, month=month) for year, month in months]
+    session=FakeSession({url:createZip(csv) for url in urls})
+    client=FakeStorageClient()
+    with mock.patch.object(btsETL, 'getStorageClient', lambda:client):
+      btsETL.run(months, 'bucket', session=session)
+      self.assertEqual(len(session.urls), 2)
+      manifest=json.loads(client.objects['data/flightsETL/_manifest.json'])
+      self.assertEqual((manifest['2024-1']['rows'], manifest['2024-1']['object']),
+                       (2000, 'data/flightsETL/2024-1.csv.gz'))
+
+      results=btsETL.run(months, 'bucket', session=session)
+      self.assertEqual(len(session.urls), 2)  # Nothing is downloaded again.
+      self.assertEqual([result.get('skipped', False) for result in results], [True, True])
+      self.assertEqual(results[0]['rows'], 2000)
+
+      session.contents[urls[1]]=createZip(csv+'2024,2,"DL","ATL",\r\n')  # BTS revised February.
+      del client.objects['data/flightsETL/2024-1.csv.gz']  # January was deleted from the bucket.
+      results=btsETL.run(months, 'bucket', session=session)
+      self.assertEqual(sorted(session.urls[2:]), sorted(urls))  # The months are fetched concurrently.
+      self.assertEqual([result['rows'] for result in results], [2000, 2001])
+
+      btsETL.run(months, 'bucket', session=session, force=True)
+      self.assertEqual(len(session.urls), 6)
+
+  def test_manifestMergesConcurrentRuns(self):
+    client=FakeStorageClient()
+    first=btsETL.btsManifest.Manifest(client, 'folder')
+    second=btsETL.btsManifest.Manifest(client, 'folder')
+    client.store('folder/2024-1.csv.gz', b'January')
+    client.store('folder/2024-2.csv.gz', b'February')
+    first.record(2024, 1, {'etag':'a'}, client.blob('folder/2024-1.csv.gz'), 10, 'csv')
+    second.record(2024, 2, {'etag':'b'}, client.blob('folder/2024-2.csv.gz'), 20, 'csv')
+    self.assertTrue(first.save())
+    with self.assertLogs(btsETL.btsManifest._logger, 'INFO'):
+      self.assertTrue(second.save())  # The first run wrote the manifest since the second read it.
+    self.assertEqual(sorted(json.loads(client.objects['folder/_manifest.json'])), ['2024-1', '2024-2'])
+    self.assertIsNotNone(btsETL.btsManifest.Manifest(client, 'folder').isCurrent(2024, 2, {'etag':'b'},
+                                                                                 'folder/2024-2.csv.gz'))
+
+  @unittest.skipIf(importlib.util.find_spec('pyarrow') is None, 'pyarrow is not installed.')
+  def test_runParquet(self):
+    import pyarrow.parquet as pq
+    session=FakeSession({btsETL.urlTemplate.format(year=2024, month=1):createZip(csv)})
+    client=FakeStorageClient()
+    with mock.patch.object(btsETL, 'getStorageClient', lambda:client):
+      results=btsETL.run([(2024, 1)], 'bucket', session=session, outputFormat='parquet')
+    name='data/flightsParquet/year=2024/month=1/flights.parquet'
+    self.assertEqual((results[0]['rows'], results[0]['object']), (2000, 'gs://bucket/'+name))
+    table=pq.read_table(io.BytesIO(client.objects[name]))
+    self.assertEqual(table.column('Origin').to_pylist()[1999], 'DEN1999')
+    self.assertEqual(results[0]['uploadedBytes'], len(client.objects[name]))
+
+if __name__=='__main__':
+  unittest.main()
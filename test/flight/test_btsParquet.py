@@ -0,0 +1,40 @@
+import datetime
+import importlib.util
+import io
+import unittest
+
+from flight.batch import btsParquet
+
+csv=(b'"Year","Month","DayofMonth","FlightDate","Reporting_Airline","OriginCityName","DepTime","DepDelay","Cancelled",'
+     b'"NewColumn",\r\n'+
+     b''.join(b'2024,1,%d,2024-01-%02d,"AA","New York, NY","0705",%d.00,0.00,x,\r\n' % (day, day, day)
+              for day in range(1, 29))+
+     b'2024,1,29,2024-01-29,"DL","Denver, CO",,,1.00,y,\r\n')
+
+@unittest.skipIf(importlib.util.find_spec('pyarrow') is None, 'pyarrow is not installed.')
+class TestBTSParquet(unittest.TestCase):
+  def _write(self, chunks):
+    import pyarrow.parquet as pq
+    output=io.BytesIO()
+    with self.assertLogs(btsParquet._logger, 'WARNING'):
+      numRows, numBytes=btsParquet.writeMonth(chunks, output)
+    return numRows, numBytes, pq.read_table(io.BytesIO(output.getvalue()))
+
+  def test_writeMonth(self):
+    numRows, numBytes, table=self._write([csv[start:start+50] for start in range(0, len(csv), 50)])
+    self.assertEqual((numRows, numBytes, table.num_rows), (29, len(csv), 29))
+    self.assertEqual(table.schema, btsParquet.schema())
+    self.assertNotIn('Year', table.column_names)  # A partition key.
+    self.assertNotIn('NewColumn', table.column_names)
+    rows=table.to_pylist()
+    self.assertEqual(rows[0]['FlightDate'], datetime.date(2024, 1, 1))
+    self.assertEqual((rows[0]['OriginCityName'], rows[0]['DepTime'], rows[0]['DepDelay']), ('New York, NY', 705, 1.0))
+    self.assertEqual((rows[28]['OriginCityName'], rows[28]['DepTime'], rows[28]['Cancelled']), ('Denver, CO', None, 1.0))
+    self.assertIsNone(rows[0]['Dest'])  # Not in this month.
+    self.assertEqual(str(table.schema.field('Origin').type), 'dictionary<values=string, indices=int32, ordered=0>')
+
+  def test_objectName(self):
+    self.assertEqual(btsParquet.objectName(2024, 3), 'data/flightsParquet/year=2024/month=3/flights.parquet')
+
+if __name__=='__main__':
+  unittest.main()
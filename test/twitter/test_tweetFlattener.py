@@ -0,0 +1,49 @@
+import json
+import unittest
+from twitter.tweetFlattener import decodeTweet
+from twitter.twitterParser import MyListener
+
+class TestTweetFlattener(unittest.TestCase):
+  _retweeted={'id':1, 'text':'original', 'user':{'id':10, 'name':'Ten'}, 'entities':{'hashtags':[{'text':'cars'}]}}
+  _tweet={'id':2, 'text':'RT original', 'user':{'id':20}, 'retweeted_status':_retweeted, 'unknown':'skipped',
+          'place':{'name':'Chicago', 'country_code':'US', 'id':'abc'},
+          'coordinates':{'type':'Point', 'coordinates':[-87.6, 41.9]}, 'geo':None,
+          'entities':{'user_mentions':[{'id':10}, {'id':11}], 'urls':[{'url':'http://t.co'}]}}
+  
+  def test_extractTweet(self):
+    rows=MyListener.extractTweet({'data':self._tweet}, 'cars')
+    self.assertEqual([row['id'] for row in rows], [1, 2])  # The retweeted tweet goes first.
+    self.assertEqual(rows[0]['hashtags'], ['cars'])
+    self.assertEqual(rows[0]['user'], 10)
+    retweet=rows[1]
+    self.assertEqual(retweet['retweeted_status'], 1)
+    self.assertEqual((retweet['place_name'], retweet['place_country_code']), ('Chicago', 'US'))
+    self.assertEqual((retweet['longitude'], retweet['latitude']), (-87.6, 41.9))
+    self.assertEqual(retweet['user_mentions'], [10, 11])
+    self.assertEqual((retweet['hashtags'], retweet['symbols'], retweet['extended_tweet']), ([], [], []))
+    self.assertNotIn('unknown', retweet)
+    self.assertNotIn('urls', retweet)
+    self.assertEqual(retweet['query'], 'cars')
+    self.assertEqual(json.loads(retweet['raw']), self._tweet)
+  
+  def test_delimited(self):
+    rows=MyListener.extractTweet(json.dumps(self._tweet).encode('utf-8'), 'cars', delim='|')
+    self.assertEqual(rows[1]['user_mentions'], '10|11')
+    self.assertNotIn('hashtags', rows[1])  # Missing multivalue fields are only filled in without a delimiter.
+  
+  def test_extractTweets(self):
+    rows=MyListener.extractTweets([self._retweeted, {'tweet':self._tweet}, b'not json'], 'cars')
+    self.assertEqual([row['id'] for row in rows], [1, 1, 2])
+  
+  def test_decodeTweet(self):
+    payload=b'{"data":{"id":2,"text":"caf\\u00e9"},"matching_rules":[{"id":"1"}]}'
+    parsed, raw=decodeTweet(payload)
+    self.assertEqual(parsed['data'], {'id':2, 'text':'caf\u00e9'})
+    self.assertEqual(raw, '{"id":2,"text":"caf\\u00e9"}')  # The original text of the tweet, not encoded again.
+    self.assertEqual(decodeTweet('{"id":3}'), ({'id':3}, '{"id":3}'))
+    self.assertEqual(decodeTweet('{"data":{"data":{"id":4}}}')[1], None)
+    with self.assertRaises(ValueError):
+      decodeTweet(b'{"data":{"id":1}')
+
+if __name__=='__main__':
+  unittest.main()
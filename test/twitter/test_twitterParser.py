@@ -1,21 +1,134 @@
+import gzip
+import json
+import threading
 import unittest
-from twitter.twitterParser import ExampleRequest,parseTweets
+from concurrent.futures import Future
+from unittest.mock import Mock
+from benchmark import fakes
+from benchmark.tweetFlattening import loadCorpus
+from common.cache import LRUCache
+from common.sinks import BatchPublisher
+from twitter.twitterParser import MyListener
+
+class FakePublisherClient(object):
+  def __init__(self):
+    self.messages=[]
+  
+  def publish(self, topic, data=None, **attributes):
+    if any(type(value)!=str or len(value)>1024 for value in attributes.values()): raise ValueError('Bad attribute.')
+    self.messages.append((data, attributes))
+    future=Future()
+    future.set_result(str(len(self.messages)))
+    return future
 
 class TestTwitterParser(unittest.TestCase):
   _projectId='prof-big-data'
-  _limit=10
   _topic='tweets-carsharing'
   _query=['zipcar','turo','getaround','gig car share','carshare']
-  _delim=''
-  
-  def test_parseTweets(self):
-    exampleRequest=ExampleRequest(self._projectId, self._query, limit=self._limit, topic=self._topic,
-                                  userTopic=self._topic+'_user', bucket=self._projectId+'_data',
-                                  pathInBuckets=self._topic,
-                                  delim=self._delim,
-                                  debug=10)
-    parseTweets(exampleRequest)
-    self.assertEqual(True, False)  # add assertion here
+  
+  def tearDown(self):
+    fakes.reset()
+  
+  def test_parseData(self):
+    tweets=loadCorpus()[:20]
+    with fakes.installed(keepMessages=True) as publisher:
+      listener=MyListener('token', self._projectId, self._query, len(tweets), topic=self._topic,
+                          bucket=self._projectId+'_data', pathInBucket=self._topic)
+      numPublished=sum(listener.parseData(tweet)[2] for tweet in tweets)
+      numStored,_=listener.close()
+    self.assertGreaterEqual(numPublished, len(tweets))  # Retweets also output the retweeted tweet.
+    self.assertEqual(numStored, numPublished)
+    self.assertEqual({topic for topic, _, _ in publisher.messages},
+                     {'projects/'+self._projectId+'/topics/'+self._topic})
+    bucket=fakes.FakeStorageClient().bucket(self._projectId+'_data')
+    rows=[json.loads(line) for contents in bucket.objects.values() for line in gzip.decompress(contents).splitlines()]
+    self.assertEqual(sorted(row['id'] for row in rows), sorted(json.loads(data)['id'] for _, data, _ in publisher.messages))
+    self.assertTrue(all(row['query']==self._query for row in rows))
+
+class TestMyListener(unittest.TestCase):
+  _retweeted={'id':1, 'text':'original', 'user':{'id':10, 'name':'Ten'}, 'entities':{'hashtags':[{'text':'cars'}]}}
+  _tweet={'id':2, 'text':'RT original', 'user':{'id':20}, 'retweeted_status':_retweeted,
+          'entities':{'user_mentions':[{'id':10}, {'id':11}]}}
+  
+  def test_parseDataEncodesOnce(self):
+    listener=MyListener('token', 'project', 'cars', 10, topic='tweets')
+    listener._publisher=BatchPublisher('project', 'tweets', client=FakePublisherClient())
+    payload=json.dumps({'data':dict(self._tweet, text='x'*2000)}, separators=(',', ':')).encode('utf-8')
+    _, _, numTweetsPublished, _=listener.parseData(payload)
+    self.assertEqual(numTweetsPublished, 2)
+    data, attributes=listener._publisher._client.messages[1]
+    self.assertEqual(json.loads(data)['raw'], payload[len(b'{"data":'):-1].decode('utf-8'))
+    self.assertNotIn('text', attributes)  # Too long for an attribute.
+    self.assertEqual(attributes['id'], '2')
+  
+  def test_onTweetQueuesUntilLimit(self):
+    listener=MyListener('token', 'project', 'cars', 2, topic='tweets')
+    client=FakePublisherClient()
+    listener._publisher=BatchPublisher('project', 'tweets', client=client)
+    for tweetId in range(3):
+      listener.on_tweet(json.dumps({'data':{'id':tweetId}}).encode('utf-8'))
+    listener.on_tweet(b'not json')  # Ignored: received after the limit.
+    listener.close()
+    self.assertEqual(sorted(json.loads(data)['id'] for data, _ in client.messages), [0, 1])
+    self.assertEqual(listener.numTweetsPublished, 2)
+  
+  def test_closeWaitsForAcknowledgements(self):
+    listener=MyListener('token', 'project', 'cars', 10, topic='tweets')
+    futures=[]
+    def publish(topic, data=None, **attributes):
+      futures.append(Future())
+      return futures[-1]
+    listener._publisher=BatchPublisher('project', 'tweets', client=Mock(publish=Mock(side_effect=publish)))
+    self.assertEqual(listener.parseData(self._tweet)[2], 2)
+    timer=threading.Timer(0.05, lambda:[future.set_result('1') for future in futures])
+    timer.start()
+    listener.close()
+    self.assertTrue(all(future.done() for future in futures))
+    self.assertEqual(listener.numTweetsPublished, 2)  # Counted once acknowledged.
+  
+  def test_extractUsersOnlyWhenChanged(self):
+    userCache=LRUCache()
+    users=MyListener.extractUsers(self._tweet, userCache=userCache)
+    self.assertEqual([user['id'] for user in users], [20, 10])
+    self.assertEqual(len(MyListener.extractUsers(self._tweet, userCache=userCache)), 2)  # Not output yet.
+    MyListener.rememberUsers(users, userCache)
+    self.assertEqual(MyListener.extractUsers(self._tweet, userCache=userCache), [])
+    changed=dict(self._tweet, user={'id':20, 'followers_count':5})
+    self.assertEqual([user['id'] for user in MyListener.extractUsers(changed, userCache=userCache)], [20])
+    self.assertEqual(len(MyListener.extractUsers(self._tweet)), 2)  # Without a cache, every user is output.
+  
+  def test_usersRememberedOncePublished(self):
+    listener=MyListener('token', 'project', 'cars', 10, userTopic='users')
+    futures=[]
+    def publish(topic, data=None, **attributes):
+      futures.append(Future())
+      return futures[-1]
+    listener._userPublisher=BatchPublisher('project', 'users', client=Mock(publish=Mock(side_effect=publish)))
+    self.assertEqual(listener.parseData(self._tweet)[3], 2)
+    self.assertEqual(len(listener.extractUsers(self._tweet, userCache=listener._userCache)), 2)  # Not acknowledged yet.
+    with self.assertLogs('common.sinks', 'ERROR'):
+      futures[0].set_exception(RuntimeError('unavailable'))
+    futures[1].set_result('1')
+    self.assertEqual([user['id'] for user in listener.extractUsers(self._tweet, userCache=listener._userCache)], [20])
+    self.assertIsNot(MyListener('token', 'project', 'cars', 10)._userCache, listener._userCache)
+  
+  def _storeUsers(self, numStored):
+    listener=MyListener('token', 'project', 'cars', 10)
+    listener._userBucket='users'
+    listener._userWriter=Mock(close=Mock(return_value=numStored))
+    self.assertEqual(listener.parseData(self._tweet)[1], 2)
+    self.assertEqual(listener.parseData(self._tweet)[1], 0)  # Already being written.
+    self.assertEqual(len(listener._userCache), 0)  # Not uploaded yet.
+    return listener
+  
+  def test_storedUsersRememberedOnceUploaded(self):
+    listener=self._storeUsers(2)
+    listener.close()
+    self.assertEqual(len(listener.extractUsers(self._tweet, userCache=listener._userCache)), 0)
+    listener=self._storeUsers(1)  # An upload failed.
+    with self.assertLogs('twitter.twitterParser', 'WARNING'):
+      listener.close()
+    self.assertEqual(len(listener.extractUsers(self._tweet, userCache=listener._userCache)), 2)
 
 if __name__=='__main__':
   unittest.main()